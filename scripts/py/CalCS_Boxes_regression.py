@@ -18,7 +18,8 @@ import os
 import glob
 import numpy as np
 import xarray as xr
-import esmtools as et
+from vectorized_stats import effective_linear_regression
+from climate_indices import load_index, moving_average, lag_pair
 
 def load_residuals(b, v):
     """
@@ -29,6 +30,8 @@ def load_residuals(b, v):
                 b.lower() + '/' + v + '/CalCS.' + v + '.' + b.lower() + '.residuals.nc')
     da = xr.open_dataarray(filepath)
     da.name = v
+    # Members line up with the climate indices by position.
+    da = da.drop_vars('ensemble', errors='ignore')
     return da
 
 def main():
@@ -40,28 +43,8 @@ def main():
     print("Working on " + VARX + " predicting " + VARY + " in the " +
          LOC.lower() + " region of the CalCS with " + str(LAG) +
          " mo. lag and " + str(SMOOTH) + " mo. smoothing...")
-    # Load in the X variable.
-    if VARX == 'NPGO':
-        """
-        This was a custom EOF procedure, so the NC files are very different
-        from the way Adam Phillips set his up.
-        """
-        filepath = '/glade/p/work/rbrady/EBUS_BGC_Variability/NPGO/'
-        ds_x = xr.open_mfdataset(filepath + '*.nc', concat_dim='ensemble')
-        ds_x = ds_x['pc']
-    else:
-        """
-        This assumes the variable can be found in Adam Phillip's climate
-        diagnostics output. Need to edit this loading if that's not the
-        case.
-        """
-        filepath = '/glade/p/work/rbrady/cesmLE_CVDP/processed/'
-        filename = 'cvdp_detrended_BGC.nc'
-        ds_x = xr.open_dataset(filepath + filename)
-        ds_x = ds_x[VARX.lower()]
-        if VARX == 'AMOC':
-            # Account for the time dimension labeling.
-            ds_x = ds_x.rename({'TIME': 'time'})
+    # Load in the X variable (see climate_indices.py).
+    ds_x = load_index(VARX)
     # Load in the Y variable.
     ds_y = load_residuals(LOC, VARY)
     # Resample to annual resolution if dealing with AMOC, since it is only at
@@ -70,43 +53,18 @@ def main():
         ds_y = ds_y.resample(freq='AS', dim='time')
         ds_y['time'] = np.arange(1920, 2016, 1)
     # Smooth if necessary.
-    if SMOOTH != 0:
-            ds_x = ds_x.rolling(time=SMOOTH).mean().dropna('time')
-            ds_y = ds_y.rolling(time=SMOOTH).mean().dropna('time')
+    ds_x = moving_average(ds_x, SMOOTH)
+    ds_y = moving_average(ds_y, SMOOTH)
     # Combine into one dataset.
     ds_x.name = 'x'
     ds_y.name = 'y'
     ds = ds_x.to_dataset()
     ds['y'] = ds_y
-    # Run the correlation (Here can definitely be improved..)
-    m, r, p, n = ([] for i in range(4))
-    for label, group in ds.groupby('ensemble'):
-        """
-        Run a simple correlation/regression, but need to check for all of the
-        optional lag and smoothing settings.
-        Updated to use new esmtools pearsonr which accounts for autocorrelation
-        when smoothing.
-        """
-        if LAG == 0:
-            M, _, _, _, _ = et.stats.linear_regression(group.x, group.y)
-            R, P, N = et.stats.pearsonr(group.x, group.y)
-            m.append(M)
-            r.append(R)
-            p.append(P)
-            n.append(N)
-        else:
-            M, _, _, _, _ = et.stats.linear_regression(group.x[:-LAG],
-                                                       group.y[LAG:])
-            R, P, N = et.stats.pearsonr(group.x[:-LAG], group.y[LAG:])
-            m.append(M)
-            r.append(R)
-            p.append(P)
-            n.append(N)
-    # Set up in dataset.
-    ds = xr.Dataset({'m': ('ensemble', m),
-                     'r': ('ensemble', r),
-                     'p': ('ensemble', p),
-                     'n_eff': ('ensemble', n)})
+    # Run the correlation/regression for every ensemble member at once,
+    # with the p-value accounting for autocorrelation (e.g. from smoothing)
+    # through the effective degrees of freedom.
+    x, y = lag_pair(ds.x, ds.y, LAG)
+    ds = effective_linear_regression(x, y)
     print("Finished regional correlations.")
     directory = ('/glade/p/work/rbrady/EBUS_BGC_Variability/CalCS_Boxes/' +
                 LOC.lower() + '/regression_results/' + VARY + '/' + VARX + '/')
@@ -4,73 +4,54 @@
 # Purpose: Take in a global netCDF, extract an upwelling system, save as a netCDF all cleaned up with datetime
 # axis and so on. Meant to be used with HTC (e.g. with GNU Parallel).
 
+# Each input file is opened once, lazily and chunked in time, and only the 1920-2015
+# record and the nlat/nlon window of each requested region are actually read off
+# disk. Unit conversion and attribute cleanup then only touch those regional
+# subsets, never the full global record.
+
 # INPUT 1 : NetCDF of ensemble member to be worked on. (Ideally global; should be full path name, e.g. /glade/scratch/.../001.nc)
-# INPUT 2 : Variable name (shell string).
-# INPUT 3 : EBUS identifier : CalCS, BenCS, CanCS, HumCS
+# INPUT 2 : Variable name (shell string). Can be a comma-separated list (e.g. DIC,ALK) if the file holds several.
+# INPUT 3 : EBUS identifier : CalCS, BenCS, CanCS, HumCS. Can be a comma-separated list, or "all" for all four.
 # INPUT 4 : Output directory, where processed .nc files will land. The directory should end in a backslash.
+#           It can contain {VAR} and {EBU} placeholders (e.g. /glade/work/.../{VAR}/{EBU}/) when extracting
+#           several variables or regions at once.
 
 # Allow a file input to be referenced.
+import os
 import sys
 
 # Matrix Analysis
 import numpy as np
 import pandas as pd
 import xarray as xr
+from ebus_regions import EBUS, region_slices
 
-def detect_EBUS(x):
-    # Will return latitude and longitude boundings for the selected region.
-    # x should be a string from the following:
-        # CalCS : California Current
-        # BenCS : Benguela Current
-        # CanCS : Canary Current
-        # HumCS : Humboldt Current
-    if x == "CalCS":
-        lat1 = 25
-        lat2 = 46
-        lon1 = 215
-        lon2 = 260
-    elif x == "BenCS":
-        lat1 = -30
-        lat2 = -16
-        lon1 = 0
-        lon2 = 20
-    elif x == "CanCS":
-        lat1 = 19 
-        lat2 = 33 
-        lon1 = 330
-        lon2 = 359
-    elif x == "HumCS":
-        lat1 = -20
-        lat2 = 0
-        lon1 = 260
-        lon2 = 290
-    else:
-        raise ValueError('\n' + 'Must select from the following EBUS strings:'
-                         + '\n' + 'CalCS' + '\n' + 'CanCS' + '\n' + 'BenCS' +
-                         '\n' + 'HumCS')
-    return lat1, lat2, lon1, lon2
+FLUX_VARS = ['FG_CO2', 'FG_ALT_CO2']
+NTIME = 1152 # Months from 1920-01 through 2015-12.
 
-def find_indices(latGrid, lonGrid, latPoint, lonPoint):
-    dx = lonGrid - lonPoint
-    dy = latGrid - latPoint
-    reducedGrid = abs(dx) + abs(dy)
-    min_ix = np.nanargmin(reducedGrid)
-    i, j = np.unravel_index(min_ix, reducedGrid.shape)
-    return i, j
+def open_lazy(fileName):
+    """
+    Opens a 1920-2100 ensemble member file without reading any data, trims it
+    (by position) to 1920-2015 per Adam Phillip's climate indices, and puts a
+    datetime axis on the trimmed record. Everything stays a chunked dask array
+    until a regional subset is loaded.
+    """
+    ds = xr.open_dataset(fileName, decode_times=False, chunks={'time': 120})
+    ds = ds.isel(time=slice(0, NTIME))
+    ds.coords['time'] = pd.date_range('1920-01', '2016-01', freq='M')
+    ds = ds.squeeze() # Get rid of any 1D leftovers from a depth variable.
+    return ds
 
-def main():
-    fileName = sys.argv[1] # System input (filename placed after script name on command line)
-    print("Operating on : {}".format(fileName))
-    pandaTimes = pd.date_range('1920-01', '2101-01', freq='M')
-    ds = xr.open_dataset(fileName, decode_times=False)
-    ds.coords['time'] = pandaTimes
+def clean_region(ds, dataVars, EBUS_NAME):
+    """
+    Unit conversions and metadata for a single (loaded) regional subset.
+    """
     ds.attrs = {} # Clear out the legacy attributes from CESM and NCO.
-    ds = ds.squeeze() # Get rid of any 1D leftovers from a depth variable.
     # Convert to sea-air flux in mol/m2/yr
-    dataVar = sys.argv[2] # Variable name (e.g. FG_CO2) 
-    if (dataVar == "FG_CO2") or (dataVar == "FG_ALT_CO2"):
-        ds[dataVar] = ds[dataVar] * ((-1 * 3600 * 24 * 365.25) / (1000 * 100))
-        ds.attrs['carbon flux units'] = "mol/m2/yr"
+    for dataVar in dataVars:
+        if dataVar in FLUX_VARS:
+            ds[dataVar] = ds[dataVar] * ((-1 * 3600 * 24 * 365.25) / (1000 * 100))
+            ds.attrs['carbon flux units'] = "mol/m2/yr"
     # Convert area to m2
     ds['TAREA'] = ds['TAREA'] / (100 * 100)
     ds['UAREA'] = ds['UAREA'] / (100 * 100)
@@ -78,25 +59,44 @@ def main():
 #    del ds['time_bound']
     # Add in some metadata
     ds.attrs['area units'] = "m2"
-    # Get region bounds for EBU. If Benguela, need to convert the longitude
-    # grid to go over the equator.
-    EBUS_NAME = sys.argv[3]
+    # If Benguela, need to convert the longitude grid to go over the equator.
     if EBUS_NAME == "BenCS":
-        lon = np.asarray(ds['TLONG'])
+        lon = np.array(ds['TLONG'])
         mask = (lon > 180)
         lon[mask] = lon[mask] - 360
         ds['TLONG'] = (('nlat','nlon'), lon) # Now -180 to 180 range.
-    lat1, lat2, lon1, lon2 = detect_EBUS(EBUS_NAME)
-    a, c = find_indices(ds['TLAT'].values, ds['TLONG'].values, lat1, lon1)
-    b, d = find_indices(ds['TLAT'].values, ds['TLONG'].values, lat2, lon2)
-    # Slice out EBUS, cover 1920 to 2015 per Adam Phillip's climate indices.
-    ds = ds.sel(time=slice('1920-01', '2015-12'))
-    ds = ds.isel(nlat=slice(a, b), nlon=slice(c, d))
-    # File output as netCDF
-    ens = fileName[-20:-17] # This works if you maintain the standard naming convention of VAR.ENS.192001-210012.nc
-    newFile = dataVar + '.' + ens + '.' + EBUS_NAME + '.192001-201512.nc'
+    return ds
+
+def main():
+    fileName = sys.argv[1] # System input (filename placed after script name on command line)
+    print("Operating on : {}".format(fileName))
+    dataVars = sys.argv[2].split(',') # Variable name(s) (e.g. FG_CO2)
+    if sys.argv[3] == 'all':
+        EBUS_NAMES = EBUS
+    else:
+        EBUS_NAMES = sys.argv[3].split(',')
     outDir = sys.argv[4]
-    ds.to_netcdf(outDir + newFile)
+    ds = open_lazy(fileName)
+    # Slice indices are looked up on the native 0-360 grid (and cached per
+    # grid by ebus_regions, which handles the BenCS rewrap itself). Only the
+    # 2D grid variables are read here.
+    TLAT = ds['TLAT'].values
+    TLONG = ds['TLONG'].values
+    ens = fileName[-20:-17] # This works if you maintain the standard naming convention of VAR.ENS.192001-210012.nc
+    for EBUS_NAME in EBUS_NAMES:
+        # Slice out EBUS. This is the only hyperslab that gets read.
+        ds_ebus = ds.isel(**region_slices(TLAT, TLONG, EBUS_NAME)).load()
+        ds_ebus = clean_region(ds_ebus, dataVars, EBUS_NAME)
+        for dataVar in dataVars:
+            others = [v for v in dataVars if v != dataVar]
+            ds_out = ds_ebus.drop_vars(others)
+            # File output as netCDF
+            newFile = dataVar + '.' + ens + '.' + EBUS_NAME + '.192001-201512.nc'
+            directory = outDir.format(VAR=dataVar, EBU=EBUS_NAME)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            print("Saving " + dataVar + " for the " + EBUS_NAME + "...")
+            ds_out.to_netcdf(directory + newFile)
 
 if  __name__ == '__main__':
     main()
@@ -22,9 +22,9 @@ NOTE: To compare with an EOF of CO2 flux, just use EOF1, EOF2, or EOF3 for the
 VARY argument. However, beware that this is only operational for FG_ALT_CO2
 EOFs currently.
 
-NOTE: There is probably a way to do this with "apply" but I can't figure out
-how. It isn't as simple as doing .groupby('ensemble') and then calling
-ds.x and ds.y in the apply function.
+NOTE: Every ensemble member is regressed at once along the ensemble dimension
+(see effective_linear_regression in vectorized_stats.py) rather than looping
+over .groupby('ensemble').
 
 NOTE: This script is also written to handle PDO, ENSO, AMO, etc. from the
 climate diagnostics package as well as NPGO. You will have to add functionality
@@ -43,7 +43,9 @@ import sys
 import os
 import numpy as np
 import xarray as xr
-import esmtools as et
+from vectorized_stats import (remove_polynomial_fit,
+                              effective_linear_regression)
+from climate_indices import load_index, moving_average, lag_pair
 
 def load_AW_residuals(e, v):
     """
@@ -55,51 +57,22 @@ def load_AW_residuals(e, v):
     filename = e.lower() + '-' + v + '-residuals-AW-chavez-800km.nc'
     ds = xr.open_dataset(filepath + filename)
     ds = ds[v + '_AW']
+    # Members line up with the climate indices by position.
+    ds = ds.drop_vars('ensemble', errors='ignore')
     return ds
 
-def main():
-    EBU = sys.argv[1]
-    VARX = sys.argv[2]
-    VARY = sys.argv[3]
-    LAG = int(sys.argv[4])
-    SMOOTH = int(sys.argv[5])
-    print("Working on " + VARX + " regressions over the " + EBU + 
-          " with " + str(LAG) + "mo. lag and " + str(SMOOTH) +
-          " mo. smoothing...")
-    if VARX == 'NPGO':
-        """
-        This was a custom EOF procedure, so the NC files are very different 
-        from the way Adam Phillips set his up.
-        """
-        filepath = '/glade/p/work/rbrady/EBUS_BGC_Variability/NPGO/'
-        ds_x = xr.open_mfdataset(filepath + '*.nc', concat_dim='ensemble')
-        ds_x = ds_x['pc']
-    elif VARX == 'NPH':
-        """
-        This is another custom procedure. A simple box over the Northeast
-        Pacific that represents anomalies in the standard position of the
-        NPH.
-        """
-        filepath = '/glade/p/work/rbrady/EBUS_BGC_Variability/indices/NPH/'
-        filename = 'NPH.full_ensemble.192001-201512.nc'
-        ds_x = xr.open_dataset(filepath + filename)
-        ds_x = ds_x['NPH']
-    else:
-        """
-        This assumes the variable can be found in Adam Phillip's climate
-        diagnostics output. Need to edit this loading if that's not the
-        case.
-        """
-        filepath = '/glade/p/work/rbrady/cesmLE_CVDP/processed/'
-        filename = 'cvdp_detrended_BGC.nc'
-        ds_x = xr.open_dataset(filepath + filename)
-        ds_x = ds_x[VARX.lower()]
-        if VARX == 'AMOC':
-            """
-            Account for the time dimension labeling.
-             """
-            ds_x = ds_x.rename({'TIME': 'time'})
-    # Load in the Y variable.
+def load_predictor(VARX):
+    """
+    Loads the climate index (VARX) time series for the full ensemble. NPGO
+    and NPH are our own custom procedures; everything else comes from Adam
+    Phillip's climate diagnostics output (see climate_indices.py).
+    """
+    return load_index(VARX)
+
+def load_response(EBU, VARY):
+    """
+    Loads the dependent variable (VARY) in the EBU for the full ensemble.
+    """
     if VARY in ['EOF1', 'EOF2', 'EOF3']:
         filepath = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' +
                     'regional_EOFs/' + EBU + '/FG_ALT_CO2/')
@@ -112,54 +85,55 @@ def main():
         else:
             ds_y = ds_y['pc'].sel(mode=2)
         # Remove any trend (should be very slight).
-        ds_y = ds_y.groupby('ensemble', squeeze=True) \
-                   .apply(et.ufunc.remove_polynomial_fit)
+        ds_y = remove_polynomial_fit(ds_y, order=4)
     else:
         ds_y = load_AW_residuals(EBU, VARY)
-    # Resample to annual resolution if dealing with AMOC, since it is only at
-    # annual resolution.
-    if VARX == 'AMOC':
-        ds_y = ds_y.resample(freq='AS', dim='time')
-        ds_y['time'] = np.arange(1920, 2016, 1)
+    return ds_y
+
+def to_annual(ds_y):
+    """
+    Resample to annual resolution if dealing with AMOC, since it is only at
+    annual resolution.
+    """
+    ds_y = ds_y.resample(freq='AS', dim='time')
+    ds_y['time'] = np.arange(1920, 2016, 1)
+    return ds_y
+
+def regional_correlation(ds_x, ds_y, LAG, SMOOTH):
+    """
+    Smooths (if SMOOTH != 0) and lags (x leads y by LAG) the two time series
+    and regresses y onto x for every ensemble member at once. Returns a
+    Dataset of m, r, p, and n_eff along the ensemble dimension.
+    """
     # Smooth if necessary.
-    if SMOOTH != 0:
-            ds_x = ds_x.rolling(time=SMOOTH).mean().dropna('time')
-            ds_y = ds_y.rolling(time=SMOOTH).mean().dropna('time')
+    ds_x = moving_average(ds_x, SMOOTH)
+    ds_y = moving_average(ds_y, SMOOTH)
     # Combine into one dataset.
     ds_x.name = 'x'
     ds_y.name = 'y'
     ds = ds_x.to_dataset()
     ds['y'] = ds_y
-    # Run the correlation (Here can definitely be improved..)
-    m, r, p, n = ([] for i in range(4))
-    for label, group in ds.groupby('ensemble'):
-        """
-        Run a simple correlation/regression, but need to check for all of the
-        optional lag and smoothing settings.
+    # Run the correlation/regression for every ensemble member at once,
+    # with the p-value accounting for autocorrelation (e.g. from smoothing)
+    # through the effective degrees of freedom.
+    x, y = lag_pair(ds.x, ds.y, LAG)
+    return effective_linear_regression(x, y)
 
-        Updated to use new esmtools pearsonr which accounts for autocorrelation
-        when smoothing.
-        """
-        if LAG == 0:
-            M, _, _, _, _ = et.stats.linear_regression(group.x, group.y)
-            R, P, N = et.stats.pearsonr(group.x, group.y)
-            m.append(M)
-            r.append(R)
-            p.append(P)
-            n.append(N)
-        else:
-            M, _, _, _, _ = et.stats.linear_regression(group.x[:-LAG],
-                                                       group.y[LAG:])
-            R, P, N = et.stats.pearsonr(group.x[:-LAG], group.y[LAG:])
-            m.append(M)
-            r.append(R)
-            p.append(P)
-            n.append(N)
-    # Set up in dataset.
-    ds = xr.Dataset({'m': ('ensemble', m),
-                     'r': ('ensemble', r),
-                     'p': ('ensemble', p),
-                     'n_eff': ('ensemble', n)})
+def main():
+    EBU = sys.argv[1]
+    VARX = sys.argv[2]
+    VARY = sys.argv[3]
+    LAG = int(sys.argv[4])
+    SMOOTH = int(sys.argv[5])
+    print("Working on " + VARX + " regressions over the " + EBU + 
+          " with " + str(LAG) + "mo. lag and " + str(SMOOTH) +
+          " mo. smoothing...")
+    ds_x = load_predictor(VARX)
+    # Load in the Y variable.
+    ds_y = load_response(EBU, VARY)
+    if VARX == 'AMOC':
+        ds_y = to_annual(ds_y)
+    ds = regional_correlation(ds_x, ds_y, LAG, SMOOTH)
     print("Finished regional correlations.")
     OUT_DIR = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' +
                'area_weighted_regional_regressions/' + EBU + '/' + VARY + '/' + 
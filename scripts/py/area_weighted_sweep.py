@@ -0,0 +1,144 @@
+"""
+Area Weighted Sweep
+-------------------
+
+Runs area_weighted_ebus_correlation.py over every combination of EBUS,
+predictor, dependent variable, lag, and smoothing window in one go, rather than
+one process (and one set of file reads) per combination from a shell loop.
+
+Each climate index and each regional residual time series is read from disk
+once, and smoothed once per window (every window from one prefix sum), into
+an in-memory cache. That cache is handed to a pool of worker processes that
+run the (batched over the ensemble) regressions, so the smoothed series are
+reused across every lag and pairing. Everything lands in one netCDF with
+dimensions (ebus, varx, vary, lag, smooth, ensemble).
+
+Lists are comma-separated. Lags and smoothing windows can also be inclusive
+ranges, e.g. "0..24".
+
+INPUT 1: EBUS ('CalCS', 'CanCS', 'HumCS', 'BenCS'), or "all"
+INPUT 2: Predictor climate variables (e.g. 'NPGO,PDO,NINO34')
+INPUT 3: Dependent variables in the EBUS (e.g. 'FG_ALT_CO2,SST,EOF1')
+INPUT 4: Lags in months (e.g. '0..12')
+INPUT 5: Smoothing windows in months (0 is no smoothing) (e.g. '0,12')
+INPUT 6: (Optional) Output filename. Defaults to a name built from the inputs
+         in the area_weighted_regional_regressions/sweeps/ directory.
+INPUT 7: (Optional) Number of worker processes (defaults to all CPUs).
+"""
+import os
+import sys
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import xarray as xr
+from ebus_regions import EBUS
+from climate_indices import moving_averages
+from area_weighted_ebus_correlation import (load_predictor, load_response,
+                                            to_annual, regional_correlation)
+
+# Filled in the main process, and in each worker by _init_worker.
+_cache = {}
+
+
+def parse_list(arg, cast=str):
+    """
+    Splits a comma-separated input, expanding inclusive "a..b" ranges.
+    """
+    out = []
+    for item in arg.split(','):
+        if '..' in item:
+            a, b = item.split('..')
+            out.extend(range(int(a), int(b) + 1))
+        else:
+            out.append(cast(item))
+    return out
+
+
+def load_inputs(EBUS_NAMES, VARXS, VARYS, SMOOTHS):
+    """
+    Reads every predictor and dependent variable once, into memory, along
+    with their running means for every smoothing window.
+    """
+    cache = {}
+    for VARX in VARXS:
+        smoothed = moving_averages(load_predictor(VARX).load(), SMOOTHS)
+        for SMOOTH in SMOOTHS:
+            cache[('x', VARX, SMOOTH)] = smoothed[SMOOTH]
+    for EBU in EBUS_NAMES:
+        for VARY in VARYS:
+            ds_y = load_response(EBU, VARY).load()
+            smoothed = moving_averages(ds_y, SMOOTHS)
+            if 'AMOC' in VARXS:
+                annual = moving_averages(to_annual(ds_y), SMOOTHS)
+            for SMOOTH in SMOOTHS:
+                cache[('y', EBU, VARY, SMOOTH)] = smoothed[SMOOTH]
+                if 'AMOC' in VARXS:
+                    cache[('y_annual', EBU, VARY, SMOOTH)] = annual[SMOOTH]
+    return cache
+
+
+def _init_worker(cache):
+    _cache.update(cache)
+
+
+def _run(key):
+    EBU, VARX, VARY, LAG, SMOOTH = key
+    ds_x = _cache[('x', VARX, SMOOTH)]
+    if VARX == 'AMOC':
+        ds_y = _cache[('y_annual', EBU, VARY, SMOOTH)]
+    else:
+        ds_y = _cache[('y', EBU, VARY, SMOOTH)]
+    # Already smoothed.
+    return key, regional_correlation(ds_x, ds_y, LAG, 0)
+
+
+def sweep(EBUS_NAMES, VARXS, VARYS, LAGS, SMOOTHS, nprocs=None):
+    """
+    Runs every combination and returns one Dataset of m, r, p, and n_eff
+    with dimensions (ebus, varx, vary, lag, smooth, ensemble).
+    """
+    cache = load_inputs(EBUS_NAMES, VARXS, VARYS, SMOOTHS)
+    keys = list(itertools.product(EBUS_NAMES, VARXS, VARYS, LAGS, SMOOTHS))
+    with ProcessPoolExecutor(max_workers=nprocs, initializer=_init_worker,
+                             initargs=(cache,)) as pool:
+        results = dict(pool.map(_run, keys, chunksize=8))
+    ds = xr.combine_nested(
+        [[[[[results[(e, x, y, l, s)] for s in SMOOTHS] for l in LAGS]
+           for y in VARYS] for x in VARXS] for e in EBUS_NAMES],
+        concat_dim=['ebus', 'varx', 'vary', 'lag', 'smooth'])
+    ds['ebus'] = EBUS_NAMES
+    ds['varx'] = VARXS
+    ds['vary'] = VARYS
+    ds['lag'] = LAGS
+    ds['smooth'] = SMOOTHS
+    return ds.transpose('ebus', 'varx', 'vary', 'lag', 'smooth', 'ensemble')
+
+
+def main():
+    if sys.argv[1] == 'all':
+        EBUS_NAMES = EBUS
+    else:
+        EBUS_NAMES = parse_list(sys.argv[1])
+    VARXS = parse_list(sys.argv[2])
+    VARYS = parse_list(sys.argv[3])
+    LAGS = parse_list(sys.argv[4], int)
+    SMOOTHS = parse_list(sys.argv[5], int)
+    nprocs = int(sys.argv[7]) if len(sys.argv) > 7 else None
+    print("Sweeping " + str(len(EBUS_NAMES) * len(VARXS) * len(VARYS) *
+          len(LAGS) * len(SMOOTHS)) + " combinations...")
+    ds = sweep(EBUS_NAMES, VARXS, VARYS, LAGS, SMOOTHS, nprocs=nprocs)
+    print("Finished regional correlations.")
+    if len(sys.argv) > 6:
+        out_file = sys.argv[6]
+    else:
+        OUT_DIR = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' +
+                   'area_weighted_regional_regressions/sweeps/')
+        if not os.path.exists(OUT_DIR):
+            os.makedirs(OUT_DIR)
+        out_file = (OUT_DIR + '-'.join(VARXS) + '.' + '-'.join(VARYS) + '.' +
+                    '-'.join(EBUS_NAMES) + '.area_weighted_sweep.nc')
+    print("Saving to netCDF...")
+    ds.to_netcdf(out_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Area Weighting
+--------------
+
+One area-weighted-mean reduction for the regional time series, in place of
+writing out `(ds * TAREA).sum('nlat').sum('nlon') / TAREA.sum()` in every
+script. That version builds the full (ensemble, time, nlat, nlon) product
+before reducing it, and divides by the area of every cell in the region
+whether or not it has data at that time step.
+
+Here the spatial dims are collapsed with a single matrix product against a
+(region, cell) weight matrix, so any number of masks (the whole EBUS, onshore
+and offshore boxes, ...) come out of the same pass over the data. Only cells
+that fall in at least one mask are touched, and the denominator is the area
+of the cells that actually have data at each step, so NaNs inside a mask
+(land, or gaps) drop out of both the sum and the area.
+
+Import this from a script in the same directory, e.g.
+`from area_weighting import area_weighted_mean`.
+"""
+import numpy as np
+import xarray as xr
+
+
+def _weighted_mean_kernel(x, weights):
+    """
+    x is (..., nlat, nlon) and weights is (region, nlat, nlon), zero outside
+    each region. Returns the NaN-aware weighted mean with shape
+    (..., region).
+    """
+    nreg = weights.shape[0]
+    w = weights.reshape(nreg, -1)
+    cells = (w != 0).any(axis=0)
+    w = w[:, cells]
+    x = x.reshape(x.shape[:-2] + (-1,))[..., cells]
+    valid = np.isfinite(x)
+    num = np.where(valid, x, 0).dot(w.T)
+    den = valid.astype(float).dot(w.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return num / den
+
+
+def _on_grid(x, dims):
+    """
+    Plain array of x laid out over dims (transposed first if it's a
+    DataArray).
+    """
+    if isinstance(x, xr.DataArray):
+        x = x.transpose(*dims)
+    return np.asarray(x)
+
+
+def area_weighted_mean(da, area, masks=None, dims=('nlat', 'nlon')):
+    """
+    Area-weighted mean of da over the spatial dims, for every other
+    coordinate (ensemble, time, ...) at once.
+
+    area is the cell area over dims (e.g. TAREA); NaN area counts as zero
+    weight. masks can be:
+        None : one mean over every cell with area.
+        a boolean DataArray over dims : one mean over that mask.
+        a dict of name -> boolean mask : one mean per mask, returned along a
+            new `region` dimension labeled by name.
+    """
+    area = _on_grid(area, dims).astype(float)
+    if isinstance(masks, dict):
+        names = list(masks.keys())
+        stacked = [_on_grid(masks[n], dims).astype(bool) for n in names]
+    elif masks is None:
+        names = None
+        stacked = [np.ones(area.shape, dtype=bool)]
+    else:
+        names = None
+        stacked = [_on_grid(masks, dims).astype(bool)]
+    weights = np.nan_to_num(np.stack(stacked) * area)
+    weights = xr.DataArray(weights, dims=('region',) + tuple(dims))
+    aw = xr.apply_ufunc(_weighted_mean_kernel, da, weights,
+                        input_core_dims=[list(dims), ['region'] + list(dims)],
+                        output_core_dims=[['region']],
+                        dask='parallelized',
+                        output_dtypes=[float])
+    if names is None:
+        return aw.isel(region=0, drop=True)
+    aw['region'] = names
+    return aw
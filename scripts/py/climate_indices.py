@@ -0,0 +1,232 @@
+"""
+Climate Indices
+---------------
+
+One loader for the climate index time series that the regression and
+composite scripts use as predictors:
+
+- NPGO : our own EOF procedure, NPGO.full_ensemble.1920-2015.nc if it exists,
+  otherwise one NPGO.<ens>.1920-2015.nc per member.
+- NPH  : the Northeast Pacific box index, NPH.full_ensemble.192001-201512.nc.
+- anything else (PDO, NINO34, AMO, SAM, AMOC, ...) : Adam Phillip's climate
+  diagnostics output, cvdp_detrended_BGC.nc (AMOC's TIME renamed to time).
+
+An index built by index_builder.py (indices/<NAME>/<NAME>.full_ensemble.
+192001-201512.nc, the same layout as NPH) is used over any of these.
+
+Each index is converted once into a plain (ensemble, time) array and saved
+as .npy files in the shared cache directory (ebus_regions.CACHE_DIR), keyed
+by the source files' paths and modification times, so nothing is written
+into the data directories themselves. Later calls (and later jobs)
+memory-map those instead of re-parsing the netCDF, and within a process
+every index is only loaded once. Time axes are cached CF-encoded (numbers
+plus units and calendar), so cftime (e.g. noleap) axes round-trip without
+pickling.
+
+Also has the smoothing and lag helpers that the scripts share, so every
+script trims and pairs time series the same way.
+
+Import this from a script in the same directory, e.g.
+`from climate_indices import load_index`.
+"""
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+from xarray.coding.times import encode_cf_datetime, decode_cf_datetime
+from ebus_regions import CACHE_DIR, load_cached_array, save_cached_array
+
+# Default work directory the index sources live under (composite_nonEOF.py
+# and overhead_spatial_correlation_anyvar.py read theirs from
+# /glade/work/rbrady/).
+WORK_DIR = '/glade/p/work/rbrady/'
+
+ens_str = ['001', '002', '009', '010', '011', '012', '013', '014', '015', '016',
+           '017', '018', '019', '020', '021', '022', '023', '024', '025', '026',
+           '027', '028', '029', '030', '031', '032', '033', '034', '035', '101',
+           '102', '103', '104', '105']
+
+# In-process copies of every index that has been loaded.
+_cache = {}
+
+
+def built_index_path(name, work=WORK_DIR, years='192001-201512'):
+    """
+    Where index_builder.py saves (and load_index looks for) a full-ensemble
+    index file.
+    """
+    return (work + 'EBUS_BGC_Variability/indices/' + name + '/' + name +
+            '.full_ensemble.' + years + '.nc')
+
+
+def _sources(name, work):
+    """
+    Returns the source file(s) and variable name for an index.
+    """
+    built = built_index_path(name, work)
+    if os.path.exists(built):
+        return [built], name
+    if name == 'NPGO':
+        filepath = work + 'EBUS_BGC_Variability/NPGO/'
+        # Written by create_NPGO_index.py all 1920 2015.
+        full = filepath + 'NPGO.full_ensemble.1920-2015.nc'
+        if os.path.exists(full):
+            return [full], 'pc'
+        files = [filepath + 'NPGO.' + e + '.1920-2015.nc' for e in ens_str]
+        return files, 'pc'
+    elif name == 'NPH':
+        filepath = work + 'EBUS_BGC_Variability/indices/NPH/'
+        return [filepath + 'NPH.full_ensemble.192001-201512.nc'], 'NPH'
+    else:
+        filepath = work + 'cesmLE_CVDP/processed/'
+        return [filepath + 'cvdp_detrended_BGC.nc'], name.lower()
+
+
+def _read_sources(files, var):
+    """
+    Reads an index from its netCDF source(s) as an (ensemble, time) array.
+    """
+    if len(files) > 1:
+        ds = xr.open_mfdataset(files, concat_dim='ensemble', combine='nested')
+    else:
+        ds = xr.open_dataset(files[0])
+    da = ds[var]
+    if 'TIME' in da.dims:
+        # Account for the time dimension labeling (AMOC).
+        da = da.rename({'TIME': 'time'})
+    return da.transpose('ensemble', 'time').load()
+
+
+def _cache_prefix(name, files):
+    h = hashlib.sha1()
+    for f in files:
+        h.update(f.encode())
+        h.update(str(os.path.getmtime(f)).encode())
+    return CACHE_DIR + 'indices/' + name + '.' + h.hexdigest()[:12]
+
+
+def _save_time(prefix, time):
+    """
+    Caches a time axis as CF numbers plus [units, calendar], so datetime64
+    and cftime axes are both stored as plain (non-object) arrays.
+    """
+    time = np.asarray(time)
+    if time.dtype.kind in 'OM':
+        num, units, calendar = encode_cf_datetime(time)
+    else:
+        num, units, calendar = time, '', ''
+    save_cached_array(prefix + '.time.npy', np.asarray(num))
+    save_cached_array(prefix + '.time_units.npy', np.array([units, calendar]))
+
+
+def _load_time(prefix):
+    """
+    Time axis saved by _save_time, or None if it isn't cached.
+    """
+    num = load_cached_array(prefix + '.time.npy')
+    encoding = load_cached_array(prefix + '.time_units.npy')
+    if num is None or encoding is None:
+        return None
+    units, calendar = [str(e) for e in encoding]
+    if not units:
+        return num
+    return decode_cf_datetime(num, units, calendar)
+
+
+def load_index(name, work=WORK_DIR):
+    """
+    Returns the climate index `name` (e.g. 'NPGO', 'PDO', 'AMOC') for the
+    full ensemble as an (ensemble, time) DataArray. `work` is the work
+    directory the sources live under.
+    """
+    key = (name, work)
+    if key not in _cache:
+        files, var = _sources(name, work)
+        prefix = _cache_prefix(name, files)
+        values = load_cached_array(prefix + '.values.npy', mmap_mode='r')
+        time = _load_time(prefix)
+        if values is not None and time is not None:
+            da = xr.DataArray(values, dims=('ensemble', 'time'),
+                              coords={'time': time})
+        else:
+            da = _read_sources(files, var)
+            try:
+                save_cached_array(prefix + '.values.npy', da.values)
+                _save_time(prefix, da['time'].values)
+            except (IOError, OSError):
+                pass # No cache directory; just keep it in memory.
+            da = xr.DataArray(da.values, dims=('ensemble', 'time'),
+                              coords={'time': da['time'].values})
+        _cache[key] = da
+    # Shallow copy so callers can relabel/rename without touching the cache.
+    da = _cache[key].copy(deep=False)
+    da.name = name
+    return da
+
+
+def load_indices(names, work=WORK_DIR):
+    """
+    Stacks several indices that share a time axis into one
+    (index, ensemble, time) DataArray.
+    """
+    da = xr.concat([load_index(n, work=work) for n in names], dim='index')
+    da['index'] = list(names)
+    return da
+
+
+def _prefix_sums(da, dim):
+    """
+    Running sums along dim of da (centered on its mean to keep the sums
+    well conditioned, with NaNs counted separately), plus that mean.
+    """
+    da = da.astype('float64')
+    valid = da.notnull()
+    offset = da.mean(dim)
+    total = (da - offset).where(valid, 0).cumsum(dim)
+    nbad = (~valid).astype(int).cumsum(dim)
+    return total, nbad, offset
+
+
+def moving_averages(da, windows, dim='time'):
+    """
+    Running means of da over every window in `windows` (in steps), all from
+    one cumulative sum over the whole field, so each window costs a single
+    difference of prefix sums no matter how long it is.
+
+    Returns a dict of window -> running mean, labeled by the last step of
+    each window and trimmed (by position) to steps with a full window, just
+    like `da.rolling(time=window).mean()` with the leading NaNs cut off. Any
+    NaN inside a window makes that mean NaN (land cells stay NaN).
+    """
+    out = {}
+    windows = [int(w) for w in windows]
+    if any(w > 1 for w in windows):
+        total, nbad, offset = _prefix_sums(da, dim)
+    for window in windows:
+        if window <= 1:
+            out[window] = da
+            continue
+        mean = (total - total.shift({dim: window}).fillna(0)) / window
+        bad = (nbad - nbad.shift({dim: window}).fillna(0)) > 0
+        mean = (mean + offset).where(~bad)
+        mean = mean.isel({dim: slice(window - 1, None)})
+        out[window] = mean.transpose(*da.dims).astype(
+            np.result_type(da.dtype, np.float32))
+    return out
+
+
+def moving_average(da, window, dim='time'):
+    """
+    Running mean of da over `window` steps (see moving_averages). A window of
+    0 or 1 leaves da unchanged.
+    """
+    return moving_averages(da, [window], dim=dim)[int(window)]
+
+
+def lag_pair(x, y, lag, dim='time'):
+    """
+    Pairs x leading y by `lag` steps: x[:-lag] with y[lag:].
+    """
+    if lag == 0:
+        return x, y
+    return x.isel({dim: slice(None, -lag)}), y.isel({dim: slice(lag, None)})
@@ -0,0 +1,131 @@
+"""
+Climatology
+-----------
+
+Grid-wide monthly climatology kernels. Rather than grouping one gridcell at a
+time by `time.month`, the whole (time, nlat, nlon) array is reshaped to
+(..., year, month) and reduced over the year axis in a single array op.
+
+NaN land cells stay NaN, and isolated NaNs in an ocean time series are
+skipped when averaging (same as xarray's groupby mean). Records don't need to
+start in January or cover whole years; the reshape pads with NaN as needed.
+
+Import this from a script in the same directory, e.g.
+`from climatology import remove_seasonal_cycle`.
+"""
+import warnings
+import numpy as np
+import xarray as xr
+from vectorized_stats import polyfit_residuals
+
+
+def _first_month(da, dim):
+    """
+    Zero-based calendar month (0 = January) of the first time step. Falls
+    back to January if the time axis isn't decoded to datetimes.
+    """
+    if np.issubdtype(da[dim].dtype, np.datetime64):
+        return int(da[dim].dt.month[0]) - 1
+    else:
+        return 0
+
+
+def _to_year_month(x, start):
+    """
+    Reshapes the last (time) axis of x to (year, month), padding with NaN so
+    that the first time step lands in calendar month `start`.
+    """
+    n = x.shape[-1]
+    nyears = -(-(start + n) // 12)
+    padded = np.full(x.shape[:-1] + (nyears * 12,), np.nan)
+    padded[..., start:start + n] = x
+    return padded.reshape(x.shape[:-1] + (nyears, 12))
+
+
+def _nanmean(x, axis, keepdims=False):
+    """
+    np.nanmean that quietly returns NaN for all-NaN (land) cells.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(x, axis=axis, keepdims=keepdims)
+
+
+def _climatology_kernel(x, start):
+    return _nanmean(_to_year_month(x, start), axis=-2)
+
+
+def _anomaly_kernel(x, start):
+    n = x.shape[-1]
+    ym = _to_year_month(x, start)
+    anom = ym - _nanmean(ym, axis=-2, keepdims=True)
+    anom = anom.reshape(x.shape[:-1] + (-1,))
+    return anom[..., start:start + n]
+
+
+def monthly_climatology(da, dim='time'):
+    """
+    Monthly mean of da over every other coordinate at once. Returns a
+    DataArray with a `month` dimension (1..12) in place of `dim`.
+    """
+    start = _first_month(da, dim)
+    clim = xr.apply_ufunc(_climatology_kernel, da,
+                          input_core_dims=[[dim]],
+                          output_core_dims=[['month']],
+                          kwargs={'start': start},
+                          dask='parallelized',
+                          output_dtypes=[float],
+                          dask_gufunc_kwargs={'output_sizes': {'month': 12}})
+    clim['month'] = np.arange(1, 13)
+    return clim
+
+
+def seasonal_amplitude(clim, dim='month'):
+    """
+    Magnitude of the seasonal cycle (max minus min) of a monthly climatology.
+    """
+    return clim.max(dim) - clim.min(dim)
+
+
+def seasonal_magnitude(da, dim='time'):
+    """
+    Grid-wide version of et.ufunc.seasonal_magnitude: the max minus min of
+    the monthly climatology at every gridcell.
+    """
+    return seasonal_amplitude(monthly_climatology(da, dim=dim))
+
+
+def remove_seasonal_cycle(da, dim='time'):
+    """
+    Removes the monthly climatology from every gridcell at once, returning
+    anomalies with the same shape and coordinates as da.
+    """
+    start = _first_month(da, dim)
+    anom = xr.apply_ufunc(_anomaly_kernel, da,
+                          input_core_dims=[[dim]],
+                          output_core_dims=[[dim]],
+                          kwargs={'start': start},
+                          dask='parallelized',
+                          output_dtypes=[float])
+    return anom.transpose(*da.dims)
+
+
+def _detrend_anomaly_kernel(x, start, order):
+    return _anomaly_kernel(polyfit_residuals(x, order), start)
+
+
+def remove_trend_and_seasonal_cycle(da, order=4, dim='time'):
+    """
+    Removes a polynomial fit of the given order and then the monthly
+    climatology from every gridcell, fused into one pass over the data
+    (one kernel call per block instead of detrending the whole field and
+    then deseasoning it again).
+    """
+    start = _first_month(da, dim)
+    anom = xr.apply_ufunc(_detrend_anomaly_kernel, da,
+                          input_core_dims=[[dim]],
+                          output_core_dims=[[dim]],
+                          kwargs={'start': start, 'order': order},
+                          dask='parallelized',
+                          output_dtypes=[float])
+    return anom.transpose(*da.dims)
@@ -0,0 +1,327 @@
+"""
+CO2calc
+-------
+
+The surface carbonate chemistry of scripts/f90/marbl_co2calc_mod.F90
+(comp_co2calc_coeffs, comp_htotal, drtsafe, total_alkalinity) in NumPy, for
+whole (ensemble, time, nlat, nlon) arrays at once, so pCO2 can be recomputed
+from DIC/ALK/TEMP/SALT (e.g. forced signal + residuals) for every gridcell
+without leaving Python.
+
+The H+ solve is MARBL's safeguarded Newton iteration (Newton steps, falling
+back to bisection when a step leaves the bracket or isn't shrinking fast
+enough), vectorized over every cell. Like MARBL's num_active_elements, cells
+drop out of the active set as soon as they converge, and each iteration only
+evaluates the alkalinity function on the cells that are still active. Cells
+with a missing input (land) never enter it. Cells whose pH bracket can't be
+found, or that don't converge in MAXIT iterations, come out as NaN (MARBL
+aborts on these).
+
+The Revelle factor follows scripts/mat/+csys/revelle_factor.m (Zeebe and
+Wolf-Gladrow) with the MARBL equilibrium constants.
+
+Inputs are in POP units: DIC, ALK, PO4 and SiO3 in mmol/m^3, TEMP in degC
+and SALT in psu. co2calc takes DataArrays (chunked with dask or not) and
+works block by block through xr.apply_ufunc.
+
+Import this from a script in the same directory, e.g.
+`from co2calc import co2calc`.
+"""
+import numpy as np
+import xarray as xr
+
+# MARBL constants (marbl_constants_mod and marbl_co2calc_mod).
+T0_KELVIN = 273.15
+RHO_SW = 1.026 # density of seawater (g/cm^3)
+XACC = 1e-10
+MAX_BRACKET_GROW_IT = 3
+MAXIT = 100
+SALT_MIN = 0.1
+DIC_MIN = SALT_MIN / 35.0 * 1944.0
+ALK_MIN = SALT_MIN / 35.0 * 2225.0
+
+# (mmol/m^3) -> (mol/kg)
+VOL_TO_MASS = 1.0 / (1e6 * RHO_SW)
+
+OUTPUTS = ['pH', 'H', 'pCO2', 'CO2STAR', 'CO3', 'revelle']
+
+
+def co2_solubility(temp, salt):
+    """
+    Solubility of CO2 (ff in MARBL, mol/kg/atm) from Weiss and Price
+    (1980), including the fugacity correction. temp in degC, salt in psu.
+    """
+    salt = np.maximum(salt, SALT_MIN)
+    tk100 = (T0_KELVIN + temp) * 1e-2
+    tk1002 = tk100 * tk100
+    return np.exp(-162.8301 + 218.2968 / tk100 + 90.9241 * np.log(tk100) -
+                  1.47696 * tk1002 +
+                  salt * (.025695 - .025225 * tk100 + 0.0049867 * tk1002))
+
+
+def co2calc_coeffs(temp, salt):
+    """
+    Equilibrium constants and total boron, sulfate, and fluoride at the
+    surface (no pressure correction), as in comp_co2calc_coeffs. Returns a
+    dict of arrays broadcast over temp and salt.
+    """
+    salt = np.maximum(salt, SALT_MIN)
+    tk = T0_KELVIN + temp
+    tk100 = tk * 1e-2
+    tk1002 = tk100 * tk100
+    invtk = 1.0 / tk
+    dlogtk = np.log(tk)
+    ionic = 19.924 * salt / (1000.0 - 1.005 * salt)
+    ionic2 = ionic * ionic
+    sqrtis = np.sqrt(ionic)
+    sqrts = np.sqrt(salt)
+    s2 = salt * salt
+    scl = salt / 1.80655
+    log_1_m_1p005em3_s = np.log(1.0 - 0.001005 * salt)
+    c = {}
+    c['ff'] = co2_solubility(temp, salt)
+    c['k0'] = np.exp(93.4517 / tk100 - 60.2409 +
+                     23.3585 * (dlogtk + np.log(1e-2)) +
+                     salt * (.023517 - 0.023656 * tk100 + 0.0047036 * tk1002))
+    # Mehrbach et al. (1973) refit by Lueker et al. (2000), pH total scale.
+    c['k1'] = np.exp(-np.log(10.0) * (3633.86 * invtk - 61.2172 +
+                                      9.67770 * dlogtk - 0.011555 * salt +
+                                      0.0001152 * s2))
+    c['k2'] = np.exp(-np.log(10.0) * (471.78 * invtk + 25.9290 -
+                                      3.16967 * dlogtk - 0.01781 * salt +
+                                      0.0001122 * s2))
+    c['kb'] = np.exp((-8966.90 - 2890.53 * sqrts - 77.942 * salt +
+                      1.728 * salt * sqrts - 0.0996 * s2) * invtk +
+                     (148.0248 + 137.1942 * sqrts + 1.62142 * salt) +
+                     (-24.4344 - 25.085 * sqrts - 0.2474 * salt) * dlogtk +
+                     0.053105 * sqrts * tk)
+    c['k1p'] = np.exp(-4576.752 * invtk + 115.525 - 18.453 * dlogtk +
+                      (-106.736 * invtk + 0.69171) * sqrts +
+                      (-0.65643 * invtk - 0.01844) * salt)
+    c['k2p'] = np.exp(-8814.715 * invtk + 172.0883 - 27.927 * dlogtk +
+                      (-160.340 * invtk + 1.3566) * sqrts +
+                      (0.37335 * invtk - 0.05778) * salt)
+    c['k3p'] = np.exp(-3070.75 * invtk - 18.141 +
+                      (17.27039 * invtk + 2.81197) * sqrts +
+                      (-44.99486 * invtk - 0.09984) * salt)
+    c['ksi'] = np.exp(-8904.2 * invtk + 117.385 - 19.334 * dlogtk +
+                      (-458.79 * invtk + 3.5913) * sqrtis +
+                      (188.74 * invtk - 1.5998) * ionic +
+                      (-12.1652 * invtk + 0.07871) * ionic2 +
+                      log_1_m_1p005em3_s)
+    c['kw'] = np.exp(-13847.26 * invtk + 148.9652 - 23.6521 * dlogtk +
+                     (118.67 * invtk - 5.977 + 1.0495 * dlogtk) * sqrts -
+                     0.01615 * salt)
+    c['ks'] = np.exp(-4276.1 * invtk + 141.328 - 23.093 * dlogtk +
+                     (-13856.0 * invtk + 324.57 - 47.986 * dlogtk) * sqrtis +
+                     (35474.0 * invtk - 771.54 + 114.723 * dlogtk) * ionic -
+                     2698.0 * invtk * ionic * sqrtis +
+                     1776.0 * invtk * ionic2 +
+                     log_1_m_1p005em3_s)
+    c['kf'] = np.exp(1590.2 * invtk - 12.641 + 1.525 * sqrtis +
+                     log_1_m_1p005em3_s +
+                     np.log(1.0 + (0.1400 / 96.062) * scl / c['ks']))
+    c['bt'] = 0.000232 / 10.811 * scl
+    c['st'] = 0.14 / 96.062 * scl
+    c['ft'] = 0.000067 / 18.9984 * scl
+    return c
+
+
+def _total_alkalinity(x, c, idx):
+    """
+    MARBL's total_alkalinity: the alkalinity residual fn(x) and dfn/dx for
+    H+ concentrations x at the (flat) cells idx of the coefficient and state
+    arrays in c (everything in mol/kg).
+    """
+    k1, k2 = c['k1'][idx], c['k2'][idx]
+    k1p, k2p, k3p = c['k1p'][idx], c['k2p'][idx], c['k3p'][idx]
+    kb, ksi, kw = c['kb'][idx], c['ksi'][idx], c['kw'][idx]
+    ks, kf = c['ks'][idx], c['kf'][idx]
+    bt, st, ft = c['bt'][idx], c['st'][idx], c['ft'][idx]
+    dic, ta = c['dic'][idx], c['ta'][idx]
+    pt, sit = c['pt'][idx], c['sit'][idx]
+    x_r = 1.0 / x
+    x2 = x * x
+    x2_r = x_r * x_r
+    x3 = x2 * x
+    k12 = k1 * k2
+    k12p = k1p * k2p
+    k123p = k12p * k3p
+    a = x3 + k1p * x2 + k12p * x + k123p
+    a_r = 1.0 / a
+    a2_r = a_r * a_r
+    da = 3.0 * x2 + 2.0 * k1p * x + k12p
+    b = x2 + k1 * x + k12
+    b_r = 1.0 / b
+    b2_r = b_r * b_r
+    db = 2.0 * x + k1
+    c_tmp = 1.0 + st / ks
+    c_r = 1.0 / c_tmp
+    kb_p_x_r = 1.0 / (kb + x)
+    ksi_p_x_r = 1.0 / (ksi + x)
+    c1_p_c_ks_x_r_r = 1.0 / (1.0 + c_tmp * ks * x_r)
+    c1_p_kf_x_r_r = 1.0 / (1.0 + kf * x_r)
+    # fn = hco3+co3+borate+oh+hpo4+2*po4+silicate-hfree-hso4-hf-h3po4-ta
+    fn = (k1 * dic * x * b_r + 2.0 * dic * k12 * b_r +
+          bt * kb * kb_p_x_r + kw * x_r +
+          pt * k12p * x * a_r + 2.0 * pt * k123p * a_r +
+          sit * ksi * ksi_p_x_r - x * c_r -
+          st * c1_p_c_ks_x_r_r - ft * c1_p_kf_x_r_r -
+          pt * x3 * a_r - ta)
+    df = (k1 * dic * (b - x * db) * b2_r - 2.0 * dic * k12 * db * b2_r -
+          bt * kb * kb_p_x_r * kb_p_x_r - kw * x2_r +
+          (pt * k12p * (a - x * da)) * a2_r - 2.0 * pt * k123p * da * a2_r -
+          sit * ksi * ksi_p_x_r * ksi_p_x_r - c_r -
+          st * c1_p_c_ks_x_r_r * c1_p_c_ks_x_r_r * (c_tmp * ks * x2_r) -
+          ft * c1_p_kf_x_r_r * c1_p_kf_x_r_r * kf * x2_r -
+          pt * x2 * (3.0 * a - x * da) * a2_r)
+    return fn, df
+
+
+def _drtsafe(c, x1, x2, active, xacc=XACC, maxit=MAXIT):
+    """
+    Vectorized drtsafe: H+ (mol/kg) at every flat cell in `active`, from
+    the bracket [x1, x2]. Brackets whose ends have the same sign are widened
+    (at most MAX_BRACKET_GROW_IT times); cells that still aren't bracketed,
+    or that haven't converged after maxit iterations, are left NaN.
+    """
+    soln = np.full(x1.shape, np.nan)
+    x1, x2 = x1.copy(), x2.copy()
+    flo = np.full(x1.shape, np.nan)
+    fhi = np.full(x1.shape, np.nan)
+    # Bracket the root at each location.
+    todo = active
+    for it in range(MAX_BRACKET_GROW_IT + 1):
+        flo[todo], _ = _total_alkalinity(x1[todo], c, todo)
+        fhi[todo], _ = _total_alkalinity(x2[todo], c, todo)
+        same = (((flo[todo] > 0) & (fhi[todo] > 0)) |
+                ((flo[todo] < 0) & (fhi[todo] < 0)))
+        todo = todo[same]
+        if todo.size == 0:
+            break
+        if it == MAX_BRACKET_GROW_IT:
+            # Bounding bracket for pH solution not found.
+            active = np.setdiff1d(active, todo)
+            break
+        dx = np.sqrt(x2[todo] / x1[todo])
+        x2[todo] = x2[todo] * dx
+        x1[todo] = x1[todo] / dx
+    # Set up the first iteration on the compacted active set.
+    idx = active
+    up = flo[idx] < 0
+    xlo = np.where(up, x1[idx], x2[idx])
+    xhi = np.where(up, x2[idx], x1[idx])
+    x = 0.5 * (xlo + xhi)
+    dxold = np.abs(xlo - xhi)
+    dx = dxold.copy()
+    f, df = _total_alkalinity(x, c, idx)
+    # Iterate, dropping cells from the active set once they converge.
+    for it in range(maxit):
+        leave_bracket = ((x - xhi) * df - f) * ((x - xlo) * df - f) >= 0
+        dx_decrease = np.abs(2.0 * f) <= np.abs(dxold * df)
+        bisect = leave_bracket | ~dx_decrease
+        dxold = dx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dx = np.where(bisect, 0.5 * (xhi - xlo), -f / df)
+        new = np.where(bisect, xlo + dx, x + dx)
+        done = (np.where(bisect, xlo == new, x == new) |
+                (np.abs(dx) < xacc))
+        x = new
+        soln[idx[done]] = x[done]
+        keep = ~done
+        if not keep.any():
+            return soln
+        idx, x, xlo, xhi = idx[keep], x[keep], xlo[keep], xhi[keep]
+        dx, dxold = dx[keep], dxold[keep]
+        f, df = _total_alkalinity(x, c, idx)
+        low = f < 0
+        xlo = np.where(low, x, xlo)
+        xhi = np.where(low, xhi, x)
+    # Lack of convergence in drtsafe.
+    return soln
+
+
+def _revelle_factor(c, h, co2, dic):
+    """
+    Revelle factor (with gamma = 0) as in revelle_factor.m, with H+, CO2*
+    and DIC in mol/kg.
+    """
+    k1, k2 = c['k1'], c['k2']
+    k1k2 = k1 * k2
+    h2 = h * h
+    h3 = h2 * h
+    Ds = 1 + k1 / h + k1k2 / h2
+    Dh = -co2 * (k1 / h2 + 2 * k1k2 / h3)
+    As = k1 / h + 2 * k1k2 / h2
+    Ah = (-co2 * (k1 / h2 + 4 * k1k2 / h3) -
+          c['kb'] * c['bt'] / (c['kb'] + h) ** 2 - c['kw'] / h2 - 1)
+    d = Dh * As - Ds * Ah
+    return -(dic / co2) * (Ah / d)
+
+
+def _co2calc_kernel(dic, alk, temp, salt, po4, sio3, phlo, phhi, xacc):
+    """
+    Carbonate system for NumPy arrays (broadcast against each other) in
+    POP units. Returns pH, H+ (mol/kg), pCO2 (uatm), CO2* and CO3
+    (mmol/m^3), and the Revelle factor, each with the broadcast shape.
+    """
+    arrays = np.broadcast_arrays(dic, alk, temp, salt, po4, sio3)
+    shape = arrays[0].shape
+    dic, alk, temp, salt, po4, sio3 = [np.asarray(a, dtype='float64')
+                                       .reshape(-1) for a in arrays]
+    valid = (np.isfinite(dic) & np.isfinite(alk) & np.isfinite(temp) &
+             np.isfinite(salt) & np.isfinite(po4) & np.isfinite(sio3))
+    c = co2calc_coeffs(temp, salt)
+    # Convert tracer units to per mass.
+    c['dic'] = np.maximum(dic, DIC_MIN) * VOL_TO_MASS
+    c['ta'] = np.maximum(alk, ALK_MIN) * VOL_TO_MASS
+    c['pt'] = np.maximum(po4, 0) * VOL_TO_MASS
+    c['sit'] = np.maximum(sio3, 0) * VOL_TO_MASS
+    x1 = np.full(dic.shape, 10.0 ** (-phhi))
+    x2 = np.full(dic.shape, 10.0 ** (-phlo))
+    h = _drtsafe(c, x1, x2, np.flatnonzero(valid), xacc=xacc)
+    # [CO2*] as in DOE Methods Handbook 1994 Ver.2 (Ch 2 p 10, Eq A.49).
+    h2 = h * h
+    denom = 1.0 / (h2 + c['k1'] * h + c['k1'] * c['k2'])
+    co3 = c['dic'] * c['k1'] * c['k2'] * denom
+    co2star = c['dic'] * h2 * denom
+    pco2 = co2star / c['ff']
+    revelle = _revelle_factor(c, h, co2star, c['dic'])
+    out = [-np.log10(h), h, pco2 * 1e6, co2star / VOL_TO_MASS,
+           co3 / VOL_TO_MASS, revelle]
+    return tuple(o.reshape(shape) for o in out)
+
+
+def carbonate_arrays(DIC, ALK, TEMP, SALT, PO4=0.5, SiO3=10.0, phlo=6.0,
+                     phhi=10.0, xacc=XACC):
+    """
+    The same as co2calc for plain NumPy arrays. Returns a dict of OUTPUTS.
+    """
+    return dict(zip(OUTPUTS, _co2calc_kernel(DIC, ALK, TEMP, SALT, PO4, SiO3,
+                                             phlo, phhi, xacc)))
+
+
+def co2calc(DIC, ALK, TEMP, SALT, PO4=0.5, SiO3=10.0, phlo=6.0, phhi=10.0,
+            xacc=XACC):
+    """
+    Surface carbonate system from DIC and ALK (mmol/m^3), TEMP (degC), and
+    SALT (psu), like marbl_co2calc_surf, for DataArrays of any shape (they
+    are broadcast against each other) at once. PO4 and SiO3 (mmol/m^3) can
+    be fields or constants. [phlo, phhi] is the initial pH bracket.
+
+    Works lazily block by block on dask-backed inputs.
+
+    Returns a Dataset of pH, H (mol/kg), pCO2 (uatm), CO2STAR and CO3
+    (mmol/m^3), and the Revelle factor.
+    """
+    out = xr.apply_ufunc(_co2calc_kernel, DIC, ALK, TEMP, SALT, PO4, SiO3,
+                         kwargs={'phlo': phlo, 'phhi': phhi, 'xacc': xacc},
+                         output_core_dims=[[]] * len(OUTPUTS),
+                         dask='parallelized',
+                         output_dtypes=[float] * len(OUTPUTS))
+    ds = xr.Dataset(dict(zip(OUTPUTS, out)))
+    ds['H'].attrs['units'] = 'mol/kg'
+    ds['pCO2'].attrs['units'] = 'uatm'
+    ds['CO2STAR'].attrs['units'] = 'mmol/m^3'
+    ds['CO3'].attrs['units'] = 'mmol/m^3'
+    return ds
@@ -0,0 +1,176 @@
+"""
+Composites
+----------
+
+Event composites of a gridded (ensemble, time, ...) field on one or more
+climate indices, for composite_nonEOF.py and full_ensemble_composite_map.py.
+
+Every (ensemble, time) sample of each index is classified once into a
+positive (index >= sigma * std), negative (index <= -sigma * std), or neutral
+event for every sigma threshold. The field is then streamed through block by
+block and each block is reduced into the per-category sums and counts of
+every index and threshold at once, as a single (category, sample) x (sample,
+cell) product. So compositing on several indices and thresholds costs one
+read of the field rather than one .where().mean() pass per category.
+
+There are two ways to weight the events:
+    'time' (default) : the published `.where(events).mean('ensemble')
+        .mean('time')`, i.e. the ensemble mean over the members with an
+        event at each time step, averaged over those time steps. The field
+        is streamed a block of time steps (every member) at a time.
+    'event' : the mean over every event (sum / count), so each event counts
+        equally however many members share its time step. The field is
+        streamed a few ensemble members at a time.
+
+The per-month counts are how many events of each category fall in each
+calendar month (1-12), over the whole ensemble.
+
+Import this from a script in the same directory, e.g.
+`from composites import event_composites`.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+CATEGORIES = ['pos', 'neg', 'neu']
+
+
+def event_masks(index, sigmas=(2,)):
+    """
+    Classifies an (index, ensemble, time) DataArray of climate indices into
+    events. Returns a boolean (index, sigma, category, ensemble, time)
+    DataArray. Thresholds are sigma times each index's standard deviation
+    over the whole ensemble. Missing index values fall in no category.
+    """
+    index = index.transpose('index', 'ensemble', 'time')
+    sigmas = [float(s) for s in sigmas]
+    threshold = index.std(['ensemble', 'time']) * xr.DataArray(sigmas,
+                                                               dims='sigma')
+    masks = xr.concat([index >= threshold,
+                       index <= -threshold,
+                       (index < threshold) & (index > -threshold)],
+                      dim='category')
+    masks['category'] = CATEGORIES
+    masks['sigma'] = sigmas
+    return masks.transpose('index', 'sigma', 'category', 'ensemble', 'time')
+
+
+def month_counts(masks, months):
+    """
+    Number of events in each calendar month from event_masks output, given
+    the month (1-12) of every time step.
+    """
+    months = np.asarray(months)
+    per_time = masks.sum('ensemble').values
+    counts = np.stack([per_time[..., months == m].sum(-1)
+                       for m in range(1, 13)], axis=-1)
+    dims = masks.dims[:-2] + ('month',)
+    coords = dict((d, masks[d]) for d in masks.dims[:-2])
+    coords['month'] = np.arange(1, 13)
+    return xr.DataArray(counts, dims=dims, coords=coords)
+
+
+def _time_weighted(da, weights, ncell, block):
+    """
+    Sums over time of the per-time-step ensemble mean of every row of
+    weights (row, ensemble, time), and the number of time steps in each,
+    plus the event counts. Streams da (ensemble, time, ...) a block of time
+    steps at a time.
+    """
+    nrow, nens, ntime = weights.shape
+    sums = np.zeros((nrow, ncell))
+    steps = np.zeros((nrow, ncell))
+    counts = np.zeros((nrow, ncell))
+    for t in range(0, ntime, block):
+        x = da.isel(time=slice(t, t + block)).values
+        x = x.reshape(nens, -1, ncell).astype('float64')
+        valid = np.isfinite(x)
+        w = weights[:, :, t:t + block]
+        # (row, time, cell) sums and counts over the ensemble.
+        s = np.einsum('ret,etc->rtc', w, np.where(valid, x, 0))
+        n = np.einsum('ret,etc->rtc', w, valid.astype('float64'))
+        has = n > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sums += np.where(has, s / n, 0).sum(axis=1)
+        steps += has.sum(axis=1)
+        counts += n.sum(axis=1)
+    return sums, steps, counts
+
+
+def _event_weighted(da, weights, ncell, block):
+    """
+    Sums and counts of every row of weights (row, ensemble, time) over all
+    of its events. Streams da (ensemble, time, ...) a block of members at a
+    time.
+    """
+    nrow, nens, ntime = weights.shape
+    sums = np.zeros((nrow, ncell))
+    counts = np.zeros((nrow, ncell))
+    for i in range(0, nens, block):
+        x = da.isel(ensemble=slice(i, i + block)).values
+        x = x.reshape(-1, ncell).astype('float64')
+        valid = np.isfinite(x)
+        w = weights[:, i:i + block].reshape(nrow, -1)
+        sums += w.dot(np.where(valid, x, 0))
+        counts += w.dot(valid)
+    return sums, counts, counts
+
+
+def event_composites(da, index, sigmas=(2,), weighting='time', block=None):
+    """
+    Composites da (with 'ensemble' and 'time' dimensions plus any spatial
+    ones) on every index and sigma threshold in one pass over da.
+
+    index : (ensemble, time) DataArray, or (index, ensemble, time) to
+        composite on several at once. Lined up with da by position, so it
+        must have the same ensemble and time lengths.
+    sigmas : thresholds in standard deviations of each index.
+    weighting : 'time' (the published composites) or 'event' (see above).
+    block : number of time steps ('time', default 120) or ensemble members
+        ('event', default 1) loaded at a time.
+
+    Returns a Dataset with pos/neg/neu_composite (the mean of da over each
+    category's events), pos/neg/neu_count (events that went into each
+    cell's mean) and pos/neg/neu_months (events per calendar month, from
+    da's time). All have leading (index, sigma) dimensions.
+    """
+    if 'index' not in index.dims:
+        index = index.expand_dims('index')
+    if (index.sizes['ensemble'] != da.sizes['ensemble'] or
+            index.sizes['time'] != da.sizes['time']):
+        raise ValueError('Index is ' + str(dict(index.sizes)) + ' but the ' +
+                         'field is ' + str(dict(da.sizes)) + '.')
+    masks = event_masks(index, sigmas=sigmas)
+    months = month_counts(masks, pd.DatetimeIndex(da['time'].values).month)
+    nens, ntime = da.sizes['ensemble'], da.sizes['time']
+    space = [d for d in da.dims if d not in ('ensemble', 'time')]
+    da = da.transpose('ensemble', 'time', *space)
+    shape = [da.sizes[d] for d in space]
+    ncell = int(np.prod(shape))
+    # Every (index, sigma, category) is a row of weights over the samples.
+    weights = masks.values.reshape(-1, nens, ntime).astype('float64')
+    if weighting == 'time':
+        sums, n, counts = _time_weighted(da, weights, ncell, block or 120)
+    elif weighting == 'event':
+        sums, n, counts = _event_weighted(da, weights, ncell, block or 1)
+    else:
+        raise ValueError("weighting must be 'time' or 'event'.")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        composite = np.where(n > 0, sums / n, np.nan)
+    dims = masks.dims[:3] + tuple(space)
+    coords = dict((d, masks[d]) for d in masks.dims[:3])
+    for name in da.coords:
+        if set(da[name].dims) <= set(space):
+            coords[name] = da[name]
+    lead = list(masks.shape[:3])
+    composite = xr.DataArray(composite.reshape(lead + shape), dims=dims,
+                             coords=coords)
+    counts = xr.DataArray(counts.reshape(lead + shape).astype(int),
+                          dims=dims, coords=coords)
+    ds = xr.Dataset()
+    for c in CATEGORIES:
+        ds[c + '_composite'] = composite.sel(category=c, drop=True).astype(
+            np.result_type(da.dtype, np.float32))
+        ds[c + '_count'] = counts.sel(category=c, drop=True)
+        ds[c + '_months'] = months.sel(category=c, drop=True)
+    return ds
@@ -12,9 +12,11 @@ netCDF of the ensemble mean for the box and the ensemble residuals for that box.
 This script depends on EBUS_Extraction.py already having been run on the given
 variable for the California Current.
 
-NOTE: Currently, this script is defaulted to taking either "onshore" or "offshore"
-as the argument. These are the boxes that were created for the PDO/ENSO correlation
-for the California Current. You can modify this script to accept any box dimensions.
+The boxes are the named ones in subboxes.BOXES (currently "onshore" and
+"offshore", which were created for the PDO/ENSO correlation for the California
+Current). Add new ones there (index bounds, lat/lon bounds, or polygons). Every
+requested box and variable is done in one pass over each variable's ensemble
+store (see subboxes.py), so there's no need to call this once per box.
 
 ONSHORE:
 nlon (18:20)
@@ -24,71 +26,47 @@ OFFSHORE:
 nlon (13:15)
 nlat (27:30)
 
-INPUT 1: Variable (str)
-INPUT 2: "Onshore" or "Offshore"
+INPUT 1: Variable (str), or a comma-separated list (e.g. FG_CO2,SST)
+INPUT 2: "Onshore" or "Offshore", a comma-separated list of box names, or "all"
+INPUT 3: (Optional) EBUS with boxes defined in subboxes.BOXES (default CalCS)
 """
 import sys
 import os
-import glob
-import xarray as xr
-
-def get_indices(str):
-    """
-    Given a string ("offshore" or "onshore"), returns the x0, x1, y0, and y1
-    indices for slicing to the desired box.
-    """
-    if str.lower() == 'offshore':
-        x0,x1,y0,y1 = [13,15,27,30]
-    elif str.lower() == 'onshore':
-        x0,x1,y0,y1 = [18,20,22,25]
-    else:
-        raise ValueError("Incorrect box declaration. Need to pass either" +
-              "'offshore' or 'onshore'")
-    return x0,x1,y0,y1
-
-def drop_ensemble_dim(ds, x):
-    """
-    Since we load in the full ensemble of separate netCDF files, xArray
-    automatically pops an 'ensemble' dimension onto the coordinate variables,
-    which makes for frustrating indexing. This simply strips those away. HumCS
-    is clarified here, because for some reason, TLONG doesn't have those
-    dimensions. Who knows.
-    """
-    ds[x] = (('nlat', 'nlon'), ds[x][0])
-    return ds
+from subboxes import BOXES, extract_subboxes
 
 def main():
-    VAR = sys.argv[1]
-    REG = sys.argv[2]
-    print("Creating " + REG.lower() + " time series for " + VAR + " in the CalCS...")
-    filepath = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' + VAR + '/CalCS/')
-    ds = xr.open_mfdataset(filepath + '*.nc', concat_dim='ensemble')
-    ds = drop_ensemble_dim(ds, 'TLAT')
-    ds = drop_ensemble_dim(ds, 'TLONG')
-    ds = drop_ensemble_dim(ds, 'TAREA')
-    # Slice into designated box
-    x0,x1,y0,y1 = get_indices(REG)
-    ds = ds.isel(nlon=slice(x0,x1+1), nlat=slice(y0,y1+1))
-    # Area-weight into one time series
-    area = ds['TAREA']
-    da = ds[VAR]
-    da = ((da * area).sum('nlat').sum('nlon'))/area.sum()
-    da.name = VAR
-    ds = da.to_dataset()
-    # Create ensemble mean and residuals.
-    ds_forced = ds.mean('ensemble')
-    ds_residuals = ds[VAR] - ds_forced
+    VARS = sys.argv[1].split(',')
+    EBU = sys.argv[3] if len(sys.argv) > 3 else 'CalCS'
+    if sys.argv[2] == 'all':
+        REGS = list(BOXES[EBU].keys())
+    else:
+        REGS = [r.lower() for r in sys.argv[2].split(',')]
+    for REG in REGS:
+        if REG not in BOXES[EBU]:
+            raise ValueError("Incorrect box declaration. Need to pass one of " +
+                             ", ".join(BOXES[EBU].keys()))
+    print("Creating " + ", ".join(REGS) + " time series for " +
+          ", ".join(VARS) + " in the " + EBU + "...")
+    boxes = dict((REG, BOXES[EBU][REG]) for REG in REGS)
+    # Area-weight every box into its own time series and create the
+    # ensemble mean and residuals for each.
+    forced, residuals = extract_subboxes(
+        EBU, VARS, boxes, base='/glade/p/work/rbrady/EBUS_BGC_Variability/')
     # Save out.
-    directory = ('/glade/p/work/rbrady/EBUS_BGC_Variability/CalCS_Boxes/' +
-                 REG.lower() + '/' + VAR + '/')
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    print("Saving forced signal to NetCDF...")
-    ds_forced.to_netcdf(directory + 'CalCS.' + VAR + '.' + REG.lower() +
-                        '.forced-signal.nc')
-    print("Saving residuals to NetCDF...")
-    ds_residuals.to_netcdf(directory + 'CalCS.' + VAR + '.' + REG.lower() +
-                        '.residuals.nc')
+    for REG in REGS:
+        for VAR in VARS:
+            ds_forced = forced[[VAR]].sel(region=REG, drop=True)
+            ds_residuals = residuals[[VAR]].sel(region=REG, drop=True)
+            directory = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' + EBU +
+                         '_Boxes/' + REG + '/' + VAR + '/')
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            print("Saving " + REG + " " + VAR + " forced signal to NetCDF...")
+            ds_forced.to_netcdf(directory + EBU + '.' + VAR + '.' + REG +
+                                '.forced-signal.nc')
+            print("Saving " + REG + " " + VAR + " residuals to NetCDF...")
+            ds_residuals.to_netcdf(directory + EBU + '.' + VAR + '.' + REG +
+                                   '.residuals.nc')
 
 if __name__ == '__main__':
     main()
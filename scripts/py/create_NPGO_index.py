@@ -5,7 +5,14 @@ Date: 10/05/2017
 
 For a given ensemble member, this script computes the NPGO index.
 
-INPUT 1: Str indicating the ensemble member.
+Passing "all" for the ensemble member computes the NPGO for every member at
+once: only the NE Pacific window is read from each member, the EOFs for all
+members come from one stacked SVD (see ensemble_eofs in vectorized_stats.py),
+and a single NPGO.full_ensemble.<sYear>-<eYear>.nc with an ensemble
+dimension is written out. (index_builder.py can also build the NPGO, along
+with any other declared index, straight into the indices/ directory.)
+
+INPUT 1: Str indicating the ensemble member (or "all").
 INPUT 2: Starting year for NPGO index (e.g. 1920)
 INPUT 3: Ending year for NPGO index (e.g. 2015)
 
@@ -21,58 +28,42 @@ Letters, in review.
 import numpy as np
 import pandas as pd
 import xarray as xr
-import esmtools as et
-from eofs.xarray import Eof
+from index_builder import INDICES, eof_index
+from climate_indices import ens_str
 import sys
 
-def main():
-    ens = sys.argv[1]
-    sYear = sys.argv[2]
-    eYear = sys.argv[3]
-    if int(sYear) < 1920:
-        raise ValueError("Starting year must be 1920 or later.")
-    if int(eYear) > 2100:
-        raise ValueError("End year must be 2100 or earlier.")
-    print("Computing NPGO for ensemble number " + ens + "...")
+def load_window(ens, sYear, eYear):
+    """
+    Reads only the Northeast Pacific window (25-62N, 180-250E) of the
+    remapped global SST residuals for one ensemble member over the given
+    years.
+    """
     filepath = ('/glade/scratch/rbrady/EBUS_BGC_Variability/' +
         'global_residuals/SST/remapped/remapped.SST.' + ens + 
         '.192001-210012.nc')
-    print("Global residuals loaded...")
-    ds = xr.open_dataset(filepath)
-    ds = ds['SST'].squeeze()
-    # Make time dimension readable through xarray.
-    ds['time'] = pd.date_range('1920-01', '2101-01', freq='M')
-    # Reduce to time period of interest.
-    ds = ds.sel(time=slice(sYear + '-01', eYear + '-12'))
-    # Slice down to Northeast Pacific domain.
-    ds = ds.sel(lat=slice(25, 62), lon=slice(180,250))
-    # Take annual JFM means.
-    month = ds['time.month']
-    JFM = (month <= 3)
-    ds_winter = ds.where(JFM).resample('A', 'time')
-    # Compute EOF
-    coslat = np.cos(np.deg2rad(ds_winter.lat.values))
-    wgts = np.sqrt(coslat)[..., np.newaxis]
-    solver = Eof(ds_winter, weights=wgts, center=False)
-    print("NPGO computed.")
-    eof = solver.eofsAsCorrelation(neofs=2)
-    variance = solver.varianceFraction(neigs=2)
+    with xr.open_dataset(filepath) as ds:
+        ds = ds['SST'].squeeze()
+        # Make time dimension readable through xarray.
+        ds['time'] = pd.date_range('1920-01', '2101-01', freq='M')
+        # Reduce to time period of interest.
+        ds = ds.sel(time=slice(sYear + '-01', eYear + '-12'))
+        # Slice down to Northeast Pacific domain.
+        ds = ds.sel(lat=slice(25, 62), lon=slice(180,250))
+        return ds.load()
+
+def compute_NPGO(ds):
+    """
+    NPGO for every member along the ensemble dimension of the monthly SST
+    residuals (ds) at once: the second EOF of annual JFM means (weighted by
+    sqrt(cos(lat)), uncentered), with the monthly field projected onto it.
+    """
+    # Second EOF of annual JFM means, declared in index_builder.INDICES.
     # Since you used Manu's method of constructing the EOF with JFM annual
     # averages, you need to reconstruct the monthly index of SSTa by 
-    # projecting those values onto the EOF.
-    pseudo_pc = solver.projectField(ds, neofs=2, eofscaling=1)
-    # Set up as dataset.
-    ds = eof.to_dataset()
-    ds['pc'] = pseudo_pc
-    ds['variance_fraction'] = variance
-    ds = ds.rename({'eofs': 'eof'})
-    ds = ds.sel(mode=1)
-    # Invert to the proper values for the bullseye.
-    if ds.sel(lat=45.5, lon=210).eof > 0:
-        pass
-    else:
-        ds['eof'] = ds['eof'] * -1
-        ds['pc'] = ds['pc'] * -1
+    # projecting those values onto the EOF. The pattern is made positive
+    # for the bullseye at 45.5N, 210E.
+    ds = eof_index(ds, INDICES['NPGO'])
+    print("NPGO computed.")
     # Change some attributes for the variables.
     ds['eof'].attrs['long_name'] = 'Correlation between PC and JFM SSTa'
     ds['pc'].attrs['long_name'] = 'Principal component for NPGO'
@@ -81,8 +72,32 @@ def main():
     ds.attrs['anomalies'] = 'Anomalies were computed by removing the ensemble mean at each grid cell.'
     ds.attrs['weighting'] = ('The native grid was regridded to a standard 1deg x 1deg (180x360) grid.' +
                              'Weighting was computed via the sqrt of the cosine of latitude.')
+    return ds
+
+def main():
+    ens = sys.argv[1]
+    sYear = sys.argv[2]
+    eYear = sys.argv[3]
+    if int(sYear) < 1920:
+        raise ValueError("Starting year must be 1920 or later.")
+    if int(eYear) > 2100:
+        raise ValueError("End year must be 2100 or earlier.")
+    if ens == 'all':
+        print("Computing NPGO for the full ensemble...")
+        ds = xr.concat([load_window(e, sYear, eYear) for e in ens_str],
+                       dim='ensemble')
+        ds['ensemble'] = ens_str
+        print("Global residuals loaded...")
+        ds = compute_NPGO(ds)
+        out = 'full_ensemble'
+    else:
+        print("Computing NPGO for ensemble number " + ens + "...")
+        ds = load_window(ens, sYear, eYear)
+        print("Global residuals loaded...")
+        ds = compute_NPGO(ds)
+        out = ens
     print("Saving to netCDF...")
-    ds.to_netcdf('/glade/p/work/rbrady/NPGO/NPGO.' + ens + '.' + str(sYear) +
+    ds.to_netcdf('/glade/p/work/rbrady/NPGO/NPGO.' + out + '.' + str(sYear) +
                  '-' + str(eYear) + '.nc')
 
 if __name__ == '__main__':
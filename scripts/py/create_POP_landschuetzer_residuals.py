@@ -7,21 +7,10 @@ by detrending (4th order polynomial) and removing monthly climatology.
 import numpy as np
 import pandas as pd
 import xarray as xr
-import esmtools as et
 import sys
+from climatology import remove_trend_and_seasonal_cycle
 
 
-def remove_seasonal_cycle(x):
-    """
-    Remove the monthly climatology for a given grid cell.
-    """
-    if x.min().isnull():
-        return xr.DataArray(np.nan)
-    else:
-        clim = x.groupby('time.month').mean('time')
-        anom = x.groupby('time.month') - clim
-        return anom
-
 def main():
     filepath = '/glade/p/work/rbrady/Landschuetzer_pCO2/'
     filename = 'spco2_1982-2015_MPI_SOM-FFN_v2016_on_POP_gx1v6.conserve.nc'
@@ -29,14 +18,10 @@ def main():
     ds = xr.open_dataset(filepath + filename)
     ds = ds['fgco2_raw']
     ds['time'] = pd.date_range('1982-01', '2016-01', freq='M')
-    # Detrend via 4th-order polynomial
-    print("Detrending...")
-    ds = ds.stack(points=['nlat', 'nlon']).groupby('points') \
-        .apply(et.ufunc.remove_polynomial_fit).unstack('points') 
-    # Remove monthly climatology
-    print("Removing monthly climatology...")
-    ds = ds.stack(points=['nlat', 'nlon']).groupby('points') \
-        .apply(remove_seasonal_cycle).unstack('points')
+    # Detrend via 4th-order polynomial and remove monthly climatology in
+    # one pass over the grid.
+    print("Detrending and removing monthly climatology...")
+    ds = remove_trend_and_seasonal_cycle(ds, order=4)
     ds.name = 'FG_CO2a'
     # Save out file
     print("Saving to netCDF...")
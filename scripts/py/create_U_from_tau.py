@@ -2,19 +2,55 @@
 Creates regional U10 on the ocean grid from TAUX and TAUY, using the conversion 
 function from Nikki's 2007 paper.
 
-I'm aware this is embarassingly parallel, but .apply() in xarray doesn't seem 
-to be parallelizing it. Perhaps this is better off a Matlab script with parfor 
-loops. I used .apply() and it seemed ~20min per simulation and wasn't 
-coming out with the right answers. This will do for now.
+This used to loop over every gridcell calling esmtools' stress_to_speed (which
+runs np.roots once per time step), at ~20min per simulation. The cubic always
+has exactly one real root, so it is now solved in closed form for whole
+(time, nlat, nlon) blocks at once under dask, which takes seconds per member.
 
-INPUT 1: Str for ensemble number.
-INPUT 2: Identifier for upwelling system.
+INPUT 1: Str for ensemble number, or "all" for every member.
+INPUT 2: Identifier for upwelling system, or "all" for all four EBUS.
 """
 import numpy as np
 import xarray as xr
 import sys
 import os
-from esmtools.physics import stress_to_speed
+from ebus_regions import EBUS
+from climate_indices import ens_str
+
+def stress_to_speed(taux, tauy):
+    """
+    Vectorized version of esmtools.physics.stress_to_speed (and
+    speedfromstress.m). Converts wind stress (dyn/cm2) to 10m wind speed by
+    solving
+
+        0.0000764*U^3 + 0.000142*U^2 + 0.0027*U = |tau| / rho_air
+
+    for every element at once. The cubic is monotonic (positive derivative
+    everywhere), so it has a single real root, which we get from Cardano's
+    formula instead of np.roots.
+    """
+    a, b, c = 0.0000764, 0.000142, 0.0027
+    # Stress magnitude over rho_air (1.2 kg/m3), converted to m2/s2.
+    d = -1 * np.sqrt(taux**2 + tauy**2) / 1.2 * 100**2 / 1e5
+    # Depressed cubic t^3 + p*t + q = 0 with U = t - b/(3a).
+    p = (3*a*c - b**2) / (3*a**2)
+    q = (2*b**3 - 9*a*b*c + 27*a**2*d) / (27*a**3)
+    disc = np.sqrt((q/2)**2 + (p/3)**3)
+    return np.cbrt(-q/2 + disc) + np.cbrt(-q/2 - disc) - b/(3*a)
+
+def wind_speed(taux, tauy):
+    """
+    Applies stress_to_speed over a full (time, nlat, nlon) field with dask.
+    Land cells (NaN for the whole record) stay NaN. Ocean cells with
+    pointwise NaNs in the time series (e.g. member 033) have those time
+    steps set to zero stress, which gives zero wind speed.
+    """
+    ocean = taux.notnull().any('time')
+    taux = taux.fillna(0).where(ocean)
+    tauy = tauy.fillna(0).where(ocean)
+    return xr.apply_ufunc(stress_to_speed, taux, tauy,
+                          dask='parallelized',
+                          output_dtypes=[float])
 
 def open_ebus_variable(v, en, eb):
     """
@@ -22,34 +58,19 @@ def open_ebus_variable(v, en, eb):
     """
     filepath = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' + v + '/' + eb + '/' + v + '.' + en +
                 '.' + eb + '.192001-201512.nc')
-    ds = xr.open_dataset(filepath)
+    ds = xr.open_dataset(filepath, chunks={'time': 120})
     return ds
 
-def main():
-    ens = sys.argv[1]
-    ebu = sys.argv[2]
-    x = open_ebus_variable('TAUX', ens, ebu)
-    y = open_ebus_variable('TAUY', ens, ebu)
+def create_U(en, eb):
+    """
+    Converts TAUX/TAUY to U for one ensemble member and upwelling system and
+    saves it out.
+    """
+    x = open_ebus_variable('TAUX', en, eb)
+    y = open_ebus_variable('TAUY', en, eb)
     name = 'U'
-    _ = np.zeros([x['nlat'].size, x.nlon.size, x.time.size])
-    _[:] = np.nan
-    ds = xr.DataArray(_, dims=['nlat','nlon','time'], coords=[x.nlat, x.nlon, x.time])
-    for i in range(ds.nlat.size):
-        for j in range(ds.nlon.size):
-            xtemp = x['TAUX'].isel(nlat=i, nlon=j)
-            ytemp = y['TAUY'].isel(nlat=i, nlon=j)
-            if xtemp.min().isnull():
-                continue
-            else:
-                # Check to see if there is any pointwise NaN in the time series (e.g. member 033)
-                if xtemp.isnull().any():
-                    nan_idx = np.where(xtemp.isnull())[0][0]
-                    timestamp = xtemp['time'][nan_idx].values
-                    # Replace with 0 so the script will run.
-                    xtemp.loc[dict(time=timestamp)] = 0
-                    ytemp.loc[dict(time=timestamp)] = 0
-                utemp = stress_to_speed(xtemp, ytemp)
-                ds[i,j,:] = utemp
+    ds = wind_speed(x['TAUX'], y['TAUY'])
+    ds = ds.transpose('nlat', 'nlon', 'time')
     ds.name = name
     ds = ds.to_dataset()
     # Add back in important coordinates.
@@ -60,12 +81,21 @@ def main():
     ds['REGION_MASK'] = x['REGION_MASK']
     ds['TAREA'] = x['TAREA']
     ds['UAREA'] = x['UAREA']
-    OUT_DIR = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' + name + '/' + ebu + '/')
+    OUT_DIR = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' + name + '/' + eb + '/')
     if not os.path.exists(OUT_DIR):
         os.makedirs(OUT_DIR)
-    OUT_FILE = (OUT_DIR + name + '.' + ens + '.' + ebu + '.192001-201512.nc')
-    print("Saving " + ens + " to netCDF...")
+    OUT_FILE = (OUT_DIR + name + '.' + en + '.' + eb + '.192001-201512.nc')
+    print("Saving " + en + " for the " + eb + " to netCDF...")
     ds.to_netcdf(OUT_FILE)
 
+def main():
+    ens = sys.argv[1]
+    ebu = sys.argv[2]
+    ens_list = ens_str if ens == 'all' else [ens]
+    ebu_list = EBUS if ebu == 'all' else [ebu]
+    for eb in ebu_list:
+        for en in ens_list:
+            create_U(en, eb)
+
 if __name__ == '__main__':
     main()
@@ -13,10 +13,20 @@ I have done some pre-processing here to integrate over the upper 100m for DIC
 and SALT for all large ensemble simulations. This is what is being loaded in
 to the script.
 
+The tendency is computed with the same centered differences (and one-sided
+differences at the first/last time step) as np.gradient, but as a single
+chunked operation along time that streams through dask, rather than one
+np.gradient call per gridcell.
+
 INPUT 1: (Int) Simulation number (0..33)
+INPUT 2: (Optional) "fused" to compute (DIC/SALT)*35 inside the gradient
+         blocks, so the intermediate sDIC field is never built as its own
+         array. Otherwise sDIC is normalized first (lazily) and then
+         differentiated.
 """
 import numpy as np
 import xarray as xr
+import dask.array as dsa
 import sys
 
 ens_str = ['001', '002', '009', '010', '011', '012', '013', '014', '015', '016',
@@ -24,23 +34,60 @@ ens_str = ['001', '002', '009', '010', '011', '012', '013', '014', '015', '016',
            '027', '028', '029', '030', '031', '032', '033', '034', '035', '101',
             '102', '103', '104', '105']
 
+def _block_gradient(x, salt=None):
+    """
+    np.gradient along the last axis of a block, optionally salinity
+    normalizing it first.
+    """
+    if salt is not None:
+        x = (x / salt) * 35
+    return np.gradient(x, axis=-1)
+
+def _gradient(x, salt=None):
+    """
+    Runs _block_gradient over a NumPy or dask array. For dask, each time
+    chunk gets a one-step halo from its neighbors, so interior chunk edges
+    use centered differences and only the true start/end of the record are
+    one-sided, exactly like np.gradient on the full series.
+    """
+    if isinstance(x, dsa.Array):
+        arrays = [x] if salt is None else [x, salt]
+        return dsa.map_overlap(_block_gradient, *arrays,
+                               depth={x.ndim - 1: 1}, boundary='none',
+                               dtype=float)
+    else:
+        return _block_gradient(x, salt)
+
+def time_gradient(da, dim='time', salt=None):
+    """
+    Approximates the time rate of change of da (per time step) along dim.
+    If salt is given, differentiates (da/salt)*35 in the same pass.
+    """
+    args = [da] if salt is None else [da, salt]
+    grad = xr.apply_ufunc(_gradient, *args,
+                          input_core_dims=[[dim]] * len(args),
+                          output_core_dims=[[dim]],
+                          dask='allowed')
+    return grad.transpose(*da.dims)
+
 def main():
     ENS = int(sys.argv[1])
+    FUSED = (len(sys.argv) > 2) and (sys.argv[2] == 'fused')
     DIC_filepath = ('/glade/scratch/rbrady/EBUS_BGC_Variability/DIC_int100m_monthly/')
     SALT_filepath = ('/glade/scratch/rbrady/EBUS_BGC_Variability/SALT_int100m_monthly/')
     da1 = xr.open_dataarray(DIC_filepath + 'DIC_int100m.' + ens_str[ENS] +
-        '.192001-210012.nc', decode_times=False)
+        '.192001-210012.nc', decode_times=False, chunks={'time': 120})
     da2 = xr.open_dataarray(SALT_filepath + 'SALT_int100m.' + ens_str[ENS] +
-        '.192001-210012.nc', decode_times=False)
-    # Salinity normalize to create sDIC over upper 100m.
-    ds = (da1/da2) * 35
-    del da1
-    del da2
-    ds.name = 'sDIC_int100m'
+        '.192001-210012.nc', decode_times=False, chunks={'time': 120})
     # Compute gradient to approxmate dsDIC/dt
     print("Computing gradient...")
-    ds = ds.stack(points=['nlat','nlon']).groupby('points') \
-            .apply(np.gradient).unstack('points')
+    if FUSED:
+        ds = time_gradient(da1, salt=da2)
+    else:
+        # Salinity normalize to create sDIC over upper 100m.
+        ds = (da1/da2) * 35
+        ds.name = 'sDIC_int100m'
+        ds = time_gradient(ds)
     # Save to netCDF
     ds.name = 'sDIC_int100m_tendency'
     ds.attrs['Description'] = ('DIC and SALT were integrated over the upper ' +
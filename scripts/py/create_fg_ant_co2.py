@@ -15,18 +15,15 @@ import sys
 import numpy as np
 import pandas as pd
 import xarray as xr
+from ensemble_store import open_member
 
 def main():
     ensNum = sys.argv[1]
     EBUS = sys.argv[2]
-    conDir = ('/glade/u/home/rbrady/work/EBUS_BGC_Variability/FG_CO2/' + EBUS +  
-    '/')
-    conFile = 'FG_CO2.' + ensNum + '.' + EBUS + '.192001-201512.nc'
-    natDir = ('/glade/u/home/rbrady/work/EBUS_BGC_Variability/FG_ALT_CO2/' + 
-    EBUS + '/')
-    natFile = 'FG_ALT_CO2.' + ensNum + '.' + EBUS + '.192001-201512.nc'
-    ds_con = xr.open_dataset(conDir + conFile)
-    ds_nat = xr.open_dataset(natDir + natFile)
+    # Reads from the consolidated ensemble stores if they've been built.
+    base = '/glade/u/home/rbrady/work/EBUS_BGC_Variability/'
+    ds_con = open_member('FG_CO2', EBUS, ensNum, base=base)
+    ds_nat = open_member('FG_ALT_CO2', EBUS, ensNum, base=base)
     ds_ant = ds_con['FG_CO2'] - ds_nat['FG_ALT_CO2']
     ds_ant.name = 'FG_ANT_CO2'
     ds_ant = ds_ant.to_dataset()
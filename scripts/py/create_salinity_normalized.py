@@ -8,15 +8,15 @@ INPUT 3: Identifier for upwelling system.
 import xarray as xr
 import sys
 import os
+from ensemble_store import open_member
 
 def open_ebus_variable(v, en, eb):
     """
-    Opens the ensemble member dataset that has been extracted already.
+    Opens the ensemble member dataset that has been extracted already (from
+    the consolidated ensemble store if it's been built).
     """
-    filepath = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' + v + '/' + eb + '/' + v + '.' + en +
-                '.' + eb + '.192001-201512.nc')
-    ds = xr.open_dataset(filepath)
-    return ds
+    return open_member(v, eb, en,
+                       base='/glade/p/work/rbrady/EBUS_BGC_Variability/')
 
 def main():
     var = sys.argv[1]
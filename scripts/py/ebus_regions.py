@@ -0,0 +1,293 @@
+"""
+EBUS Regions
+------------
+
+One place for the EBUS region definitions and the index/mask lookups that
+used to be repeated in every script:
+
+- detect_EBUS: lat/lon bounds for extracting each EBUS from the global grid.
+- chavez_bounds: the 10 degree latitude bands from Chavez 2009.
+- composite_domain: lat/lon domains for the composite maps.
+
+Looking up nlat/nlon slices for these bounds (a brute-force nanargmin over
+the POP grid) and building the distance-to-coast field for the offshore
+filter (a reversed cumsum of DXT) only needs to happen once per grid. The
+results are kept in memory for the life of the process and persisted to a
+small on-disk cache keyed by a hash of the grid arrays, so every later script
+(or later call) gets them back straight away. Cache files are written to a
+temporary file and moved into place, so jobs running in parallel never read
+a partial file, and an entry that can't be read is just recomputed.
+
+Import this from a script in the same directory, e.g.
+`from ebus_regions import region_slices`.
+"""
+import os
+import json
+import tempfile
+import hashlib
+import numpy as np
+
+EBUS = ['CalCS', 'HumCS', 'CanCS', 'BenCS']
+
+CACHE_DIR = '/glade/work/rbrady/EBUS_BGC_Variability/region_cache/'
+
+# In-process copies of everything that has been looked up or read from disk.
+_slice_cache = {}
+_distance_cache = {}
+
+
+def detect_EBUS(x):
+    """
+    Will return latitude and longitude boundings for the selected region.
+    x should be a string from the following:
+        CalCS : California Current
+        BenCS : Benguela Current
+        CanCS : Canary Current
+        HumCS : Humboldt Current
+    """
+    if x == "CalCS":
+        lat1 = 25
+        lat2 = 46
+        lon1 = 215
+        lon2 = 260
+    elif x == "BenCS":
+        lat1 = -30
+        lat2 = -16
+        lon1 = 0
+        lon2 = 20
+    elif x == "CanCS":
+        lat1 = 19
+        lat2 = 33
+        lon1 = 330
+        lon2 = 359
+    elif x == "HumCS":
+        lat1 = -20
+        lat2 = 0
+        lon1 = 260
+        lon2 = 290
+    else:
+        raise ValueError('\n' + 'Must select from the following EBUS strings:'
+                         + '\n' + 'CalCS' + '\n' + 'CanCS' + '\n' + 'BenCS' +
+                         '\n' + 'HumCS')
+    return lat1, lat2, lon1, lon2
+
+
+def chavez_bounds(x):
+    """
+    Returns the appropriate 10 degree latitude bounds from the Chavez 2009 EBUS
+    comparison paper. These are the bounds used for equal region comparisons
+    across the EBUS.
+    """
+    if x == "CalCS":
+        lat1 = 34
+        lat2 = 44
+    elif x == "CanCS":
+        lat1 = 21
+        lat2 = 31
+    elif x == "BenCS":
+        lat1 = -28
+        lat2 = -18
+    elif x == "HumCS":
+        lat1 = -16
+        lat2 = -6
+    else:
+        raise ValueError('\n' + 'Must select from the following EBUS strings:'
+                         + '\n' + 'CalCS' + '\n' + 'CanCS' + '\n' + 'BenCS' +
+                         '\n' + 'HumCS')
+    return lat1, lat2
+
+
+def composite_domain(ebus):
+    """
+    Returns longitude and latitude coordinates (x0, x1, y0, y1) for slicing
+    out the composite domain.
+    """
+    if ebus == 'HumCS':
+        x0 = 100
+        x1 = 300
+        y0 = -60
+        y1 = 30
+    elif ebus == 'CalCS':
+        x0 = 145
+        x1 = 260
+        y0 = -10
+        y1 = 60
+    elif ebus == 'CanCS':
+        x0 = 280
+        x1 = 30
+        y0 = -20
+        y1 = 60
+    else:
+        raise Exception("Need to add composite domain for other EBUS.")
+    return x0, x1, y0, y1
+
+
+def find_indices(latGrid, lonGrid, latPoint, lonPoint):
+    """
+    Returns the (nlat, nlon) index of the gridcell closest to the given
+    point, measured as |dlat| + |dlon|.
+    """
+    dx = lonGrid - lonPoint
+    dy = latGrid - latPoint
+    reducedGrid = abs(dx) + abs(dy)
+    min_ix = np.nanargmin(reducedGrid)
+    i, j = np.unravel_index(min_ix, reducedGrid.shape)
+    return int(i), int(j)
+
+
+def wrap_longitude(lon):
+    """
+    Converts a 0 to 360 longitude grid to -180 to 180, which is needed to
+    slice regions that straddle the prime meridian (e.g. the BenCS).
+    """
+    lon = np.array(lon, dtype=float)
+    mask = (lon > 180)
+    lon[mask] = lon[mask] - 360
+    return lon
+
+
+def grid_hash(*arrays):
+    """
+    Short hash of the raw bytes (and shapes) of the given arrays, used to key
+    the on-disk cache to a specific grid.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(np.asarray(a, dtype=float))
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()[:16]
+
+
+def _atomic_write(path, write):
+    """
+    Calls write(f) on a temporary file next to path and then moves it into
+    place, so readers see either the old file or the complete new one.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_cached_array(path, mmap_mode=None):
+    """
+    Array saved by save_cached_array, or None if it is missing or
+    unreadable.
+    """
+    try:
+        return np.load(path, mmap_mode=mmap_mode)
+    except (IOError, OSError, ValueError, EOFError):
+        return None
+
+
+def save_cached_array(path, array):
+    _atomic_write(path, lambda f: np.save(f, array))
+
+
+def _read_json(path):
+    """
+    Contents of a JSON cache file, or None if it is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_json(path, d):
+    text = json.dumps(d, indent=1, sort_keys=True)
+    _atomic_write(path, lambda f: f.write(text.encode()))
+
+
+def region_slices(TLAT, TLONG, ebus, kind='detect'):
+    """
+    Returns a dict of nlat/nlon slices that cover the given EBUS on the
+    grid defined by TLAT/TLONG (0 to 360 longitudes), for use in
+    `ds.isel(**region_slices(...))`.
+
+    kind picks the bounds:
+        'detect'    : detect_EBUS extraction box (BenCS uses -180 to 180).
+        'composite' : composite_domain.
+    """
+    TLAT = np.asarray(TLAT)
+    TLONG = np.asarray(TLONG)
+    # One cache file per grid, EBUS and kind, so parallel jobs working on
+    # different EBUS never rewrite each other's entries.
+    key = grid_hash(TLAT, TLONG) + '.' + ebus + '.' + kind
+    path = CACHE_DIR + key + '.slices.json'
+    if key not in _slice_cache:
+        _slice_cache[key] = _read_json(path)
+    if _slice_cache[key] is None:
+        if kind == 'detect':
+            lat1, lat2, lon1, lon2 = detect_EBUS(ebus)
+            if ebus == 'BenCS':
+                TLONG = wrap_longitude(TLONG)
+        elif kind == 'composite':
+            lon1, lon2, lat1, lat2 = composite_domain(ebus)
+        else:
+            raise ValueError("kind must be 'detect' or 'composite'.")
+        a, c = find_indices(TLAT, TLONG, lat1, lon1)
+        b, d = find_indices(TLAT, TLONG, lat2, lon2)
+        _slice_cache[key] = [a, b, c, d]
+        try:
+            _write_json(path, _slice_cache[key])
+        except (IOError, OSError):
+            pass # No cache directory; just keep it in memory.
+    a, b, c, d = _slice_cache[key]
+    return {'nlat': slice(a, b), 'nlon': slice(c, d)}
+
+
+def distance_to_coast(TLAT, DXT, REGION_MASK, ocean, ebus):
+    """
+    Distance (km) from each ocean gridcell to the coast, accumulated along
+    nlon from the eastern edge of an extracted EBUS grid, within the
+    chavez_bounds latitude band. This is the field generate_regional_residuals
+    filters on for the 800km offshore cutoff.
+
+    DXT should be in cm (native POP units) and ocean is a boolean array of
+    gridcells that have data. Rows without any land (REGION_MASK == 0) in
+    the band have no coastline to reference and come out as NaN, as do
+    cells outside the band or over land.
+    """
+    TLAT = np.asarray(TLAT, dtype=float)
+    DXT = np.asarray(DXT, dtype=float)
+    REGION_MASK = np.asarray(REGION_MASK, dtype=float)
+    ocean = np.asarray(ocean, dtype=bool)
+    key = grid_hash(TLAT, DXT, REGION_MASK, ocean) + '.' + ebus
+    if key in _distance_cache:
+        return _distance_cache[key]
+    path = CACHE_DIR + key + '.distance.npy'
+    dist = load_cached_array(path)
+    if dist is None:
+        lat1, lat2 = chavez_bounds(ebus)
+        inband = (TLAT >= lat1) & (TLAT <= lat2)
+        has_coast = ((REGION_MASK == 0) & inband).any(axis=1)
+        valid = ocean & inband & has_coast[:, np.newaxis]
+        dxt_km = np.where(valid, DXT / 100 / 1000, 0)
+        dist = np.cumsum(dxt_km[:, ::-1], axis=1)[:, ::-1]
+        dist = np.where(valid, dist, np.nan)
+        try:
+            save_cached_array(path, dist)
+        except (IOError, OSError):
+            pass # No cache directory; just keep it in memory.
+    _distance_cache[key] = dist
+    return dist
+
+
+def offshore_mask(TLAT, DXT, REGION_MASK, ocean, ebus, offshore=800):
+    """
+    Boolean mask of gridcells within `offshore` km of the coast inside the
+    chavez_bounds band for the EBUS (see distance_to_coast). Any offshore
+    distance comes from the same cached distance field.
+    """
+    with np.errstate(invalid='ignore'):
+        return distance_to_coast(TLAT, DXT, REGION_MASK, ocean, ebus) <= offshore
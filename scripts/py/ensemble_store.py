@@ -0,0 +1,152 @@
+"""
+Ensemble Store
+--------------
+
+Consolidated per-EBUS ensemble stores for the variables written out by
+EBUS_extraction.py.
+
+EBUS_extraction.py leaves one netCDF per ensemble member in
+<VAR>/<EBU>/. Opening those with `open_mfdataset(concat_dim='ensemble')`
+scans the metadata of all 34 files on every open, and stacks the static grid
+variables along `ensemble` too, which every script then has to strip off
+again with drop_ensemble_dim. The ingest step here writes each <VAR>/<EBU>
+collection into a single chunked Zarr store (with consolidated metadata)
+where:
+
+- every time-varying field has a real `ensemble` dimension labeled by the
+  member string ('001', '002', ...), chunked one member at a time with the
+  full time record and regional window in each chunk.
+- static grid variables (TAREA, DXT, TLAT, TLONG, REGION_MASK, ...) are
+  stored once, without an ensemble dimension.
+
+open_ensemble/open_member are the loaders the downstream scripts use. If a
+store hasn't been built yet they fall back to the per-member netCDFs and hand
+back the same layout, so scripts work either way.
+
+To build stores (e.g. after running EBUS_extraction.py):
+    python ensemble_store.py FG_ALT_CO2 all
+    python ensemble_store.py SST,SALT CalCS,HumCS
+
+INPUT 1: Variable name(s), comma-separated.
+INPUT 2: EBUS identifier(s), comma-separated, or "all".
+"""
+import os
+import sys
+import glob
+import xarray as xr
+from ebus_regions import EBUS
+
+BASE_DIR = '/glade/work/rbrady/EBUS_BGC_Variability/'
+
+
+def member_files(VAR, EBU, base=BASE_DIR):
+    """
+    Sorted list of the per-member netCDFs from EBUS_extraction.py.
+    """
+    return sorted(glob.glob(base + VAR + '/' + EBU + '/' + VAR + '.*.' + EBU +
+                            '.*.nc'))
+
+
+def store_path(VAR, EBU, base=BASE_DIR):
+    """
+    Location of the consolidated store, next to the member files.
+    """
+    return base + VAR + '/' + EBU + '/' + VAR + '.' + EBU + '.ensemble.zarr'
+
+
+def _member_label(filename):
+    """
+    Pulls the ensemble member string out of VAR.ENS.EBU.192001-201512.nc.
+    """
+    return os.path.basename(filename).split('.')[-4]
+
+
+def _is_member_field(da):
+    return ('time' in da.dims) and ('nlat' in da.dims) and ('nlon' in da.dims)
+
+
+def combine_members(files):
+    """
+    Lazily combines per-member files into one Dataset with time-varying
+    fields stacked on a labeled `ensemble` dimension, and everything else
+    (grid variables, time_bound, ...) taken once from the first member.
+    """
+    members = [xr.open_dataset(f, chunks={}) for f in files]
+    first = members[0]
+    # Remember which grid variables were coordinates so they come back that
+    # way, but combine everything as plain variables.
+    grid_coords = [c for c in first.coords if c not in first.dims]
+    members = [m.reset_coords() for m in members]
+    fields = [v for v in members[0].data_vars
+              if _is_member_field(members[0][v])]
+    static = members[0].drop_vars(fields)
+    stacked = xr.concat([m[fields] for m in members], dim='ensemble')
+    stacked['ensemble'] = [_member_label(f) for f in files]
+    ds = xr.merge([stacked, static])
+    ds = ds.set_coords([c for c in grid_coords if c in ds])
+    ds.attrs = first.attrs
+    return ds
+
+
+def build_store(VAR, EBU, base=BASE_DIR):
+    """
+    Writes (or rewrites) the consolidated Zarr store for VAR in the EBU.
+    """
+    files = member_files(VAR, EBU, base=base)
+    if not files:
+        raise IOError('No member files found for ' + VAR + ' in the ' + EBU +
+                      '. Run EBUS_extraction.py first.')
+    ds = combine_members(files)
+    # One member per chunk, with the whole (small) regional record in it,
+    # which is how the residual and regression scripts read them.
+    ds = ds.chunk({'ensemble': 1, 'time': -1})
+    for v in ds.variables:
+        ds[v].encoding = {}
+    ds.to_zarr(store_path(VAR, EBU, base=base), mode='w', consolidated=True)
+
+
+def open_ensemble(VAR, EBU, base=BASE_DIR):
+    """
+    Opens the full ensemble for VAR in the EBU with a real `ensemble`
+    dimension and the static grid variables stored once. Uses the
+    consolidated store if it exists, and otherwise combines the member files.
+    """
+    path = store_path(VAR, EBU, base=base)
+    if os.path.exists(path):
+        return xr.open_zarr(path, consolidated=True)
+    files = member_files(VAR, EBU, base=base)
+    if not files:
+        raise IOError('No member files or store found for ' + VAR + ' in the '
+                      + EBU + '.')
+    return combine_members(files)
+
+
+def open_member(VAR, EBU, ens, base=BASE_DIR):
+    """
+    Opens a single ensemble member (e.g. '001') for VAR in the EBU, laid out
+    the same way as the per-member file from EBUS_extraction.py.
+    """
+    path = store_path(VAR, EBU, base=base)
+    if os.path.exists(path):
+        ds = xr.open_zarr(path, consolidated=True)
+        return ds.sel(ensemble=ens).drop_vars('ensemble')
+    filename = (base + VAR + '/' + EBU + '/' + VAR + '.' + ens + '.' + EBU +
+                '.192001-201512.nc')
+    return xr.open_dataset(filename)
+
+
+def main():
+    VARS = sys.argv[1].split(',')
+    if sys.argv[2] == 'all':
+        EBUS_NAMES = EBUS
+    else:
+        EBUS_NAMES = sys.argv[2].split(',')
+    for VAR in VARS:
+        for EBU in EBUS_NAMES:
+            print("Building ensemble store for " + VAR + " in the " + EBU +
+                  "...")
+            build_store(VAR, EBU)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Flux Decomposition
+------------------
+
+Decomposes anomalies in the natural sea-air CO2 flux into gas transfer
+velocity, solubility, density, dpCO2 and sea ice contributions, ported from
+scripts/mat/CO2_decomposition.m to run on every gridcell and ensemble member
+at once.
+
+The flux is treated as the product
+
+    F = xkw * (1 - ifrac) * sol * rho * dpCO2
+
+so each term is its linear sensitivity at the time-mean state of the cell
+times the anomaly of that factor, e.g. the xkw term is
+(1 - ifrac_bar) * sol_bar * rho_bar * dpCO2_bar * xkw'. 'sum' is the sum of
+the five terms, 'flux' is the anomaly of F itself, and 'residual' is
+flux - sum (the nonlinear part). Since every term is linear in its anomaly,
+the trend of a term is the trend of its factor times the sensitivity, as in
+the MATLAB.
+
+Solubility is the Weiss and Price (1980) ff from co2calc.py, computed as one
+array operation rather than looped over (t, i, j). Units follow
+EBUS_extraction.py: xkw goes from cm/s to m/yr (365.25 day years), rho from
+g/cm^3 to kg/m^3 and dpCO2 from uatm to atm, so the terms are sea-air fluxes
+in mol/m2/yr like the extracted FG_ALT_CO2.
+
+Inputs are streamed chunk by chunk through xr.apply_ufunc with each chunk
+holding whole time series (one member at a time from the ensemble stores).
+The per-term fields and their area-weighted regional means (the *_AW
+variables) come out of the same graph, so writing them computes everything
+in a single pass over the inputs.
+
+INPUT 1: EBUS ('CalCS', 'HumCS', 'CanCS', 'BenCS')
+"""
+import os
+import sys
+import numpy as np
+import xarray as xr
+from co2calc import co2_solubility
+from ebus_regions import offshore_mask
+from area_weighting import area_weighted_mean
+from ensemble_store import open_ensemble
+
+SECONDS_PER_YEAR = 3600 * 24 * 365.25
+
+# Model variable for each input, in the order _decomposition_kernel takes
+# them.
+INPUTS = {'ifrac': 'ECOSYS_IFRAC', 'xkw': 'ECOSYS_XKW',
+          'dpCO2': 'DpCO2_ALT_CO2', 'temp': 'TEMP', 'salt': 'SALT',
+          'rho': 'RHO'}
+ORDER = ['ifrac', 'xkw', 'dpCO2', 'temp', 'salt', 'rho']
+
+TERMS = ['xkw', 'sol', 'rho', 'dpCO2', 'ifrac']
+OUTPUTS = TERMS + ['sum', 'flux', 'residual']
+
+
+def flux_factors(ifrac, xkw, dpCO2, temp, salt, rho):
+    """
+    The factors of the flux in mol/m2/yr units from POP output: xkw (m/yr),
+    sol (mol/kg/atm), rho (kg/m^3), dpCO2 (atm) and ifrac. Works on arrays
+    or DataArrays.
+    """
+    return {'xkw': xkw * SECONDS_PER_YEAR / 100.0,
+            'sol': co2_solubility(temp, salt),
+            'rho': rho * 1e3,
+            'dpCO2': dpCO2 * 1e-6,
+            'ifrac': ifrac}
+
+
+def _time_mean(x):
+    """
+    NaN-aware mean over the last axis, NaN where there's no data.
+    """
+    valid = np.isfinite(x)
+    count = valid.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(valid, x, 0).sum(axis=-1, keepdims=True) / count
+
+
+def _decomposition_kernel(ifrac, xkw, dpCO2, temp, salt, rho):
+    """
+    Every flux term (see OUTPUTS) stacked along a new last axis, for inputs
+    with time as their last axis.
+    """
+    args = np.broadcast_arrays(*[np.asarray(a, dtype='float64') for a in
+                                 (ifrac, xkw, dpCO2, temp, salt, rho)])
+    f = flux_factors(*args)
+    bar = dict((k, _time_mean(v)) for k, v in f.items())
+    prime = dict((k, f[k] - bar[k]) for k in f)
+    open_water = 1 - bar['ifrac']
+    terms = {}
+    terms['xkw'] = (open_water * bar['sol'] * bar['rho'] * bar['dpCO2'] *
+                    prime['xkw'])
+    terms['sol'] = (bar['xkw'] * open_water * bar['rho'] * bar['dpCO2'] *
+                    prime['sol'])
+    terms['rho'] = (bar['xkw'] * open_water * bar['sol'] * bar['dpCO2'] *
+                    prime['rho'])
+    terms['dpCO2'] = (bar['xkw'] * open_water * bar['sol'] * bar['rho'] *
+                      prime['dpCO2'])
+    terms['ifrac'] = -(bar['xkw'] * bar['sol'] * bar['rho'] * bar['dpCO2'] *
+                       prime['ifrac'])
+    terms['sum'] = sum(terms[t] for t in TERMS)
+    flux = f['xkw'] * (1 - f['ifrac']) * f['sol'] * f['rho'] * f['dpCO2']
+    terms['flux'] = flux - _time_mean(flux)
+    terms['residual'] = terms['flux'] - terms['sum']
+    return np.stack([terms[t] for t in OUTPUTS], axis=-1)
+
+
+def decompose_flux(ds, area=None, masks=None, dims=('nlat', 'nlon'),
+                   dim='time'):
+    """
+    Decomposes the flux anomalies for every gridcell (and member, ...) of
+    ds, which holds the model variables in INPUTS (in POP units).
+
+    Returns a Dataset with one (..., time) field per term in OUTPUTS (in
+    mol/m2/yr, positive out of the ocean). If area (e.g. TAREA) is given,
+    the area-weighted mean of each term over the masks (see
+    area_weighted_mean) is added as <term>_AW.
+    """
+    inputs = []
+    for k in ORDER:
+        da = ds[INPUTS[k]]
+        if da.chunks is not None:
+            da = da.chunk({dim: -1})
+        inputs.append(da)
+    out = xr.apply_ufunc(_decomposition_kernel, *inputs,
+                         input_core_dims=[[dim]] * len(inputs),
+                         output_core_dims=[[dim, 'term']],
+                         dask='parallelized',
+                         output_dtypes=[float],
+                         dask_gufunc_kwargs={'output_sizes':
+                                             {'term': len(OUTPUTS)}})
+    out['term'] = OUTPUTS
+    order = [d for d in ds[INPUTS['dpCO2']].dims if d in out.dims]
+    fields = out.transpose(*order, ...).to_dataset('term')
+    for t in OUTPUTS:
+        fields[t].attrs['units'] = 'mol/m2/yr'
+    if area is not None:
+        regional = area_weighted_mean(out, area, masks=masks, dims=dims)
+        for t in OUTPUTS:
+            fields[t + '_AW'] = regional.sel(term=t, drop=True)
+            fields[t + '_AW'].attrs['units'] = 'mol/m2/yr'
+    return fields
+
+
+def load_flux_inputs(EBU, offshore=800):
+    """
+    Lazily opens every input for the full ensemble in the EBU (see
+    ensemble_store.py), filtered to the Chavez band within `offshore` km of
+    the coast like generate_regional_residuals.py. Returns a Dataset of the
+    model variables along with TAREA.
+    """
+    ds = xr.Dataset()
+    for k in ORDER:
+        VAR = INPUTS[k]
+        ds_var = open_ensemble(VAR, EBU)
+        ds[VAR] = ds_var[VAR]
+    for grid in ['TAREA', 'TLAT', 'DXT', 'REGION_MASK']:
+        ds[grid] = ds_var[grid]
+    ocean = ds['DpCO2_ALT_CO2'].isel(ensemble=0, time=0).notnull().values
+    mask = offshore_mask(ds['TLAT'].values, ds['DXT'].values,
+                         ds['REGION_MASK'].values, ocean, EBU,
+                         offshore=offshore)
+    mask = xr.DataArray(mask, dims=('nlat', 'nlon'))
+    for k in ORDER:
+        ds[INPUTS[k]] = ds[INPUTS[k]].where(mask)
+    return ds
+
+
+def main():
+    EBU = sys.argv[1]
+    OFFSHORE = 800
+    print("Decomposing FG_ALT_CO2 in the " + EBU + "...")
+    ds = load_flux_inputs(EBU, offshore=OFFSHORE)
+    ds_out = decompose_flux(ds, area=ds['TAREA'])
+    ds_out['TAREA'] = ds['TAREA']
+    directory = ('/glade/work/rbrady/EBUS_BGC_Variability/' +
+                 'FG_ALT_CO2_decomposition/' + EBU + '/')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    print("Saving to netCDF...")
+    ds_out.to_netcdf(directory + EBU.lower() + '-FG_ALT_CO2-decomposition-' +
+                     'chavez-' + str(OFFSHORE) + 'km.nc')
+
+
+if __name__ == '__main__':
+    main()
@@ -26,8 +26,13 @@ NOTE: This is set up to deal with EOF modes of CO2 flux in the EBUS. It can be
 modified to also work with NPGO composites, etc.
 
 INPUT 1: Str for EBUS ('CalCS', 'BenCS', 'CanCS', 'HumCS')
-INPUT 2: Int for mode number (Which EOF are you compositing?)
+INPUT 2: Int for mode number (Which EOF are you compositing?), or a
+         comma-separated list (e.g. '0,1') to composite on several in one pass
 INPUT 3: Str for variable to composite ('SSH', 'SST', etc.)
+INPUT 4: (Optional) Sigma threshold(s) for events, comma-separated (default 2)
+INPUT 5: (Optional) Event weighting, 'time' (default, the ensemble mean at each
+         event time step averaged over time) or 'event' (every event counts
+         equally; see composites.py)
 """
 import glob
 import sys
@@ -36,6 +41,7 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 from scipy import signal
+from composites import event_composites
 
 def composite_domain(ebus):
     """
@@ -51,38 +57,30 @@ def composite_domain(ebus):
         raise Exception("Need to add composite domain for other EBU's.")
     return x0, x1, y0, y1
 
-def xarray_month_count(time_index, name):
-    """
-    Takes in a time-varying field with ensemble members after filtering for the
-    two-sigma or whatever significance bounds. Converts these into a 
-    DataArray with month dimension 1-12 and values for the number of pos/neg/
-    neutral events for each month.
-    """
-    stacked_months = time_index.stack(points=['ensemble','time']) \
-                               .dropna('points')['time.month']
-    df = stacked_months.to_dataframe()
-    df = df.groupby('month').size()
-    df = df.to_xarray()
-    df.name = name
-    return df
-
 def main():
     EBU = sys.argv[1]
-    MODE = int(sys.argv[2])
+    MODES = [int(m) for m in sys.argv[2].split(',')]
     VAR = sys.argv[3]
     # Load in the region's EOF netCDF.
     filepath = ('/glade/p/work/rbrady/EBUS_BGC_Variability/regional_EOFs/' +
                 EBU + '/FG_ALT_CO2/')
     filename = 'FG_ALT_CO2.EOF.192001-201512.nc'
     ds = xr.open_dataset(filepath + filename)
-    ds = ds.sel(mode=MODE)
-    ds = ds['pc']
-    # Detrend to avoid issues with sigma classification.
-    ds = ds.to_dataset().apply(signal.detrend)
-    ds = ds['pc']
-    # 2 Sigma threshold
-    # CHANGE THIS IF YOU WANT 1 SIGMA or 3 SIGMA, etc.
-    two_sigma = ds.std() * 2 
+    ds = ds.sel(mode=MODES)
+    ds = ds['pc'].rename({'mode': 'index'})
+    # Detrend (along time, whatever the layout of pc) to avoid issues with
+    # sigma classification.
+    ds = xr.apply_ufunc(signal.detrend, ds,
+                        input_core_dims=[['time']],
+                        output_core_dims=[['time']])
+    ds = ds.transpose('index', 'ensemble', 'time')
+    # 2 Sigma threshold by default
+    # Pass INPUT 4 IF YOU WANT 1 SIGMA or 3 SIGMA, etc.
+    if len(sys.argv) > 4:
+        SIGMAS = [float(s) for s in sys.argv[4].split(',')]
+    else:
+        SIGMAS = [2]
+    WEIGHTING = sys.argv[5] if len(sys.argv) > 5 else 'time'
     
     # Load in Residual data
     if VAR == 'curl':
@@ -97,36 +95,24 @@ def main():
     # Slice out composite domain.
     x0, x1, y0, y1 = composite_domain(EBU)
     ds_var = ds_var.sel(lat=slice(y0, y1), lon=slice(x0, x1))
-    # Time index for seeing when these events occur.
-    pos_time_index = ds.where(ds >= two_sigma, drop=True)
-    neg_time_index = ds.where(ds <= two_sigma*-1, drop=True)
-    neu_time_index = ds.where( (ds < two_sigma) & (ds > two_sigma*-1), drop=True)
-    # Months when events occur.
-    pos_months = xarray_month_count(pos_time_index, 'pos_months')
-    neg_months = xarray_month_count(neg_time_index, 'neg_months')
-    neu_months = xarray_month_count(neu_time_index, 'neu_months')
-    # Actual composite map
-    pos_composite = ds_var.where(ds >= two_sigma).mean('ensemble').mean('time')
-    neg_composite = ds_var.where(ds <= two_sigma*-1).mean('ensemble').mean('time')
-    neu_composite = ds_var.where( (ds < two_sigma) & (ds > two_sigma*-1) ) \
-                          .mean('ensemble').mean('time')
-    # Rename for dataset
-    pos_composite.name = 'pos_composite'
-    neg_composite.name = 'neg_composite'
-    neu_composite.name = 'neu_composite'
+    # Positive/negative/neutral composite maps and the months when events
+    # occur, for every mode and threshold in one pass (see composites.py).
+    composites = event_composites(ds_var, ds, sigmas=SIGMAS,
+                                  weighting=WEIGHTING)
+    composites['index'] = MODES
+    if len(SIGMAS) == 1:
+        composites = composites.squeeze('sigma')
     # Save to netCDF.
-    ds = pos_composite.to_dataset()
-    ds['neg_composite'] = neg_composite
-    ds['neu_composite'] = neu_composite
-    ds['pos_months'] = pos_months
-    ds['neg_months'] = neg_months
-    ds['neu_months'] = neu_months
     directory = ('/glade/p/work/rbrady/EBUS_BGC_Variability/composites/' +
                  EBU + '/' + VAR + '/')
-    outfile = VAR + '.residuals.FG_ALT_CO2.composite.EOF' + str(MODE) + '.nc'
     if not os.path.exists(directory):
         os.makedirs(directory)
-    ds.to_netcdf(directory + outfile)
+    for MODE in MODES:
+        outfile = (VAR + '.residuals.FG_ALT_CO2.composite.EOF' + str(MODE) +
+                   '.nc')
+        if WEIGHTING == 'event':
+            outfile = outfile.replace('.nc', '.event_weighted.nc')
+        composites.sel(index=MODE, drop=True).to_netcdf(directory + outfile)
 
 
 if __name__ == '__main__':
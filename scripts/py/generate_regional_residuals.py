@@ -20,8 +20,20 @@ SIGNIFICANTLY faster upon loading in post-processed .nc files.
 # Recently moved over to Python3 from Python2. Simply updated the print portions
 # of this script to make them compatible with print as a function.
 # ----------------------
+# ----------------------
+# Update  : Incremental mode. Passing "incremental" as Input 3 keeps running
+# ensemble sums (and the gridded residuals) in a Zarr store next to the output.
+# Later runs only read what's new: members that aren't in the sums yet are
+# added, members listed in Input 4 are swapped out for their current files,
+# and a longer time record only has its new time steps read. The forced signal
+# and residual products are then rewritten from the store. Delete the store to
+# force a full rebuild.
+# ----------------------
 # Input 1 : EBU name.
 # Input 2 : Variable name.
+# Input 3 : (Optional) "incremental" to update from the running sums.
+# Input 4 : (Optional) Comma-separated members to replace (e.g. 001,034) in
+#           incremental mode.
 # NOTE: You can change the offshore distance parameter in the main script if
 # needed. I didn't make it an input option, since 800km should be pretty
 # standard for awhile.
@@ -32,110 +44,182 @@ import glob
 import numpy as np
 import pandas as pd
 import xarray as xr
+from ebus_regions import offshore_mask
+from area_weighting import area_weighted_mean
+from ensemble_store import open_ensemble
 
-def chavez_bounds(x):
+# One chunk per member holding its whole record and regional window, so that
+# every chunk is a contiguous set of full time series.
+CHUNKS = {'ensemble': 1, 'time': -1, 'nlat': -1, 'nlon': -1}
+
+def running_sums(da):
     """
-    Returns the appropriate 10 degree latitude bounds from the Chavez 2009 EBUS
-    comparison paper. These are the bounds used for equal region comparisons
-    across the EBUS.
+    NaN-aware sum and count over the ensemble, in double precision.
     """
-    if x == "CalCS":
-        lat1 = 34
-        lat2 = 44
-    elif x == "CanCS":
-        lat1 = 21 
-        lat2 = 31 
-    elif x == "BenCS":
-        lat1 = -28
-        lat2 = -18
-    elif x == "HumCS":
-        lat1 = -16
-        lat2 = -6
-    else:
-        raise ValueError('\n' + 'Must select from the following EBUS strings:'
-                         + '\n' + 'CalCS' + '\n' + 'CanCS' + '\n' + 'BenCS' +
-                         '\n' + 'HumCS')
-    return lat1, lat2
+    total = da.astype('float64').fillna(0).sum('ensemble')
+    count = da.notnull().sum('ensemble')
+    return total, count
+
+def forced_from_sums(total, count):
+    return total / count.where(count > 0)
+
+def build_state(da, path):
+    """
+    Writes the running sums and residuals for the full ensemble in da.
+    """
+    total, count = running_sums(da)
+    residuals = da.astype('float64') - forced_from_sums(total, count)
+    state = xr.Dataset({'sum': total, 'count': count,
+                        'residuals': residuals})
+    state.chunk(CHUNKS).to_zarr(path, mode='w')
 
-def drop_ensemble_dim(ds, x):
+def shift_residuals(path, delta):
     """
-    Since we load in the full ensemble of separate netCDF files, xArray
-    automatically pops an 'ensemble' dimension onto the coordinate variables,
-    which makes for frustrating indexing. This simply strips those away. HumCS
-    is clarified here, because for some reason, TLONG doesn't have those
-    dimensions. Who knows.
+    Residuals are member minus forced signal, so a change in the forced
+    signal just shifts every stored residual by the same amount. Done one
+    member chunk at a time.
     """
-    ds[x] = (('nlat','nlon'), ds[x][0])
-    return ds
+    state = xr.open_zarr(path)
+    for i in range(state.sizes['ensemble']):
+        res = state['residuals'].isel(ensemble=slice(i, i + 1)).load()
+        res = (res - delta).to_dataset(name='residuals')
+        res.reset_coords(drop=True).drop_vars(['ensemble', 'time']).to_zarr(
+            path, region={'ensemble': slice(i, i + 1)})
+
+def write_sums(path, total, count):
+    # Region writes can only carry variables on the region's dims, so the
+    # (nlat, nlon) grid coordinates (TLAT, TLONG) are dropped.
+    ds = xr.Dataset({'sum': total, 'count': count}).reset_coords(drop=True)
+    ds.drop_vars('time').to_zarr(
+        path, region={'time': slice(0, total.sizes['time'])})
+
+def add_member(x, path):
+    """
+    Folds a new member into the running sums and appends its residuals.
+    """
+    state = xr.open_zarr(path)
+    label = str(x['ensemble'].values)
+    x = x.drop_vars('ensemble').astype('float64').load()
+    total = state['sum'].load()
+    count = state['count'].load()
+    old = forced_from_sums(total, count)
+    total = total + x.fillna(0)
+    count = count + x.notnull()
+    new = forced_from_sums(total, count)
+    shift_residuals(path, new - old)
+    write_sums(path, total, count)
+    res = (x - new).expand_dims(ensemble=[label]).to_dataset(name='residuals')
+    res.reset_coords(drop=True).to_zarr(path, append_dim='ensemble')
+
+def replace_member(x, path):
+    """
+    Swaps a member's old contribution in the running sums for x. The old
+    values are recovered from its stored residuals and the forced signal,
+    so none of the other members are read.
+    """
+    state = xr.open_zarr(path)
+    labels = [str(e) for e in state['ensemble'].values]
+    i = labels.index(str(x['ensemble'].values))
+    x = x.drop_vars('ensemble').astype('float64').load()
+    total = state['sum'].load()
+    count = state['count'].load()
+    old = forced_from_sums(total, count)
+    x_old = state['residuals'].isel(ensemble=i).drop_vars('ensemble').load() + old
+    total = total + x.fillna(0) - x_old.fillna(0)
+    count = count + x.notnull().astype(int) - x_old.notnull().astype(int)
+    new = forced_from_sums(total, count)
+    shift_residuals(path, new - old)
+    write_sums(path, total, count)
+    res = (x - new).expand_dims('ensemble').to_dataset(name='residuals')
+    res.reset_coords(drop=True).drop_vars('time').to_zarr(
+        path, region={'ensemble': slice(i, i + 1)})
+
+def extend_state(tail, path):
+    """
+    Appends new time steps (for every member already in the sums).
+    """
+    total, count = running_sums(tail)
+    residuals = tail.astype('float64') - forced_from_sums(total, count)
+    state = xr.Dataset({'sum': total, 'count': count,
+                        'residuals': residuals})
+    state = state.reset_coords(drop=True).drop_vars('ensemble')
+    state.chunk(CHUNKS).to_zarr(path, append_dim='time')
+
+def incremental_update(da, path, replace=[]):
+    """
+    Brings the running sums at path up to date with da (the masked
+    ensemble) and returns the forced signal and residuals from them.
+    """
+    if not os.path.exists(path):
+        print("No running sums yet, building them from the full ensemble...")
+        build_state(da, path)
+    else:
+        state = xr.open_zarr(path)
+        labels = [str(e) for e in state['ensemble'].values]
+        ntime = state.sizes['time']
+        if da.sizes['time'] > ntime:
+            print("Adding " + str(da.sizes['time'] - ntime) +
+                  " new time steps to the running sums...")
+            extend_state(da.sel(ensemble=labels).isel(time=slice(ntime, None)),
+                         path)
+        for e in da['ensemble'].values:
+            if str(e) not in labels:
+                print("Adding member " + str(e) + " to the running sums...")
+                add_member(da.sel(ensemble=e), path)
+        for e in replace:
+            print("Replacing member " + e + " in the running sums...")
+            replace_member(da.sel(ensemble=e), path)
+    state = xr.open_zarr(path).sortby('ensemble')
+    forced = forced_from_sums(state['sum'], state['count']).astype(da.dtype)
+    residuals = state['residuals'].astype(da.dtype)
+    return forced.rename(da.name), residuals.rename(da.name)
 
 def main():
     EBU = sys.argv[1]
     VAR = sys.argv[2]
+    INCREMENTAL = (len(sys.argv) > 3) and (sys.argv[3] == 'incremental')
+    REPLACE = sys.argv[4].split(',') if len(sys.argv) > 4 else []
     print("Creating residuals for {} in the {}".format(VAR, EBU))
     OFFSHORE = 800 # distance to filter offshore EBUS bounds to.
-    fileDir = '/glade/work/rbrady/EBUS_BGC_Variability/' + VAR + '/' + EBU \
-            + '/'
-    ds = xr.open_mfdataset(fileDir + '*.nc', concat_dim='ensemble', 
-                           chunks={'time': 10}, engine='netcdf4')
-    # Reduce pesky coordinate ensemble dimension.
-    ds = drop_ensemble_dim(ds, 'DXT')
-    ds = drop_ensemble_dim(ds, 'TAREA')
-    ds = drop_ensemble_dim(ds, 'REGION_MASK')
-    ds = drop_ensemble_dim(ds, 'TLAT')
-    if EBU != "HumCS":
-        ds = drop_ensemble_dim(ds, 'TLONG')
+    # Full ensemble with a real ensemble dimension and the grid variables
+    # stored once (see ensemble_store.py).
+    ds = open_ensemble(VAR, EBU)
     del ds['DYT']
     del ds['ANGLET']
-    # Convert DXT to kilometers for easy filtering.
-    ds['DXT'] = ds['DXT'] / 100 / 1000
-    # Select latitudnal bounds
-    lat1, lat2 = chavez_bounds(EBU)
-    ds = ds.where(ds['TLAT'] >= lat1).where(ds['TLAT'] <= lat2)
-    # Create a masked array for DXT since it doesn't follow the same NaN
-    # structure.
-    data = ds[VAR].isel(ensemble=0, time=0)
-    data = np.ma.array(data, mask=np.isnan(data))
-    dxt_dat = ds['DXT']
-    dxt_dat = np.ma.array(dxt_dat, mask=np.isnan(data))
-    ds['DXT'] = (('nlat','nlon'), dxt_dat)
-    # Filter out rows without a coastline to reference (for distance to
-    # coastline)
-    regmask = ds['REGION_MASK']
-    counter = 0
-    for row in regmask:
-        conditional = 0 in row.values
-        if conditional == False:
-            ds['DXT'][counter, :] = np.nan
-        counter += 1
-    # Now create a new variable for distance to coastl.
-    x = ds['DXT'].values
-    x = np.ma.array(x, mask=np.isnan(x))
-    dxt_cum = np.cumsum(x[:, ::-1], axis=1)[:, ::-1]
-    ds['DXT_Cum'] = (('nlat', 'nlon'), dxt_cum)
-    # Filter out to within certain distance of coastline
-    ds = ds.where(ds['DXT_Cum'] <= OFFSHORE)
+    # Filter to the Chavez latitude band and to within OFFSHORE km of the
+    # coastline. The distance-to-coast field is cached per grid by
+    # ebus_regions, so it's only built the first time through.
+    ocean = ds[VAR].isel(ensemble=0, time=0).notnull().values
+    mask = offshore_mask(ds['TLAT'].values, ds['DXT'].values,
+                         ds['REGION_MASK'].values, ocean, EBU,
+                         offshore=OFFSHORE)
+    ds = ds.where(xr.DataArray(mask, dims=('nlat', 'nlon')))
+    directory = '/glade/work/rbrady/EBUS_BGC_Variability/' + VAR + '/' + \
+                EBU + '/filtered_output/'
+    if not os.path.exists(directory):
+        os.makedirs(directory)
     # GENERATE AND SAVE VARIANTS : FORCED/RESIDUALS +
     # AREA-WEIGHTED/NON-AREA-WEIGHTED
-    ds_forced = ds[VAR].mean(dim='ensemble')
-    ds_residuals = ds[VAR] - ds_forced
+    if INCREMENTAL:
+        ds_forced, ds_residuals = incremental_update(
+            ds[VAR], directory + EBU.lower() + '-' + VAR +
+            '-ensemble-sums-chavez-' + str(OFFSHORE) + 'km.zarr', REPLACE)
+    else:
+        da = ds[VAR].chunk(CHUNKS)
+        ds_forced = da.mean(dim='ensemble')
+        ds_residuals = da - ds_forced
     ds_forced['TAREA'] = ds['TAREA']
     ds_residuals['TAREA'] = ds['TAREA']
     # AREA WEIGHTING
-    ds_forced_AW = ((ds_forced * ds['TAREA']).sum(dim='nlat')
-                       .sum(dim='nlon'))/ds['TAREA'].sum()
+    ds_forced_AW = area_weighted_mean(ds_forced, ds['TAREA'])
     ds_forced_AW.name = VAR + '_AW'
     ds_forced_AW = ds_forced_AW.to_dataset()
-    ds_residuals_AW = ((ds_residuals * ds['TAREA']).sum(dim='nlat')
-                       .sum(dim='nlon'))/ds['TAREA'].sum()
+    ds_residuals_AW = area_weighted_mean(ds_residuals, ds['TAREA'])
     ds_residuals_AW.name = VAR + '_AW'
     ds_residuals_AW = ds_residuals_AW.to_dataset()
     ds_forced = ds_forced.to_dataset()
     ds_residuals = ds_residuals.to_dataset()
     # Save as NetCDF.
-    directory = '/glade/work/rbrady/EBUS_BGC_Variability/' + VAR + '/' + \
-                EBU + '/filtered_output/'
-    if not os.path.exists(directory):
-        os.makedirs(directory)
     print("Saving forced signal to NetCDF...")
     ds_forced.to_netcdf(directory + EBU.lower() + '-' + VAR +
                         '-forced-signal-chavez-' + str(OFFSHORE) + 'km.nc')
@@ -24,132 +24,157 @@ INPUT 1: Dependent variable  indicator ("CalCS", "HumCS", "CanCS", "BenCS")
          for FG_ALT_CO2, or climate index indicator ("NPGO", "PDO", etc.)
 INPUT 2: Global variable to act as predictor for EBU gas flux.
 INPUT 3: Months of lag time (global variable leads CO2 flux by this many months)
-INPUT 4: Ensemble number (int between 0 and 33 inclusive)
+         Can also be an inclusive range (e.g. "0..24"), in which case every lag
+         is computed from one load of the global field and saved to a single
+         file with a `lag` dimension.
+INPUT 4: Ensemble number (int between 0 and 33 inclusive), or "all" to regress
+         the full ensemble in one run. The output then has an `ensemble`
+         dimension plus ensemble-mean and sign agreement summaries.
 INPUT 5: Boolean for smoothing (If True, smooths for 12 months)
+         NOTE: Older versions of this script treated any value here
+         (including "False") as True and always smoothed. Only "True" smooths
+         now, so results from runs that passed "False" before were smoothed,
+         and rerunning them the same way gives unsmoothed regressions. Pass
+         "True" to reproduce those.
 """
 import sys
 import os
 import numpy as np
 import pandas as pd
 import xarray as xr
-import esmtools as et
+from climate_indices import load_index, moving_average
+from index_builder import INDICES
+from vectorized_stats import (linear_regression, lagged_linear_regression,
+                              ensemble_summary)
 
 ens_str = ['001', '002', '009', '010', '011', '012', '013', '014', '015', '016',
            '017', '018', '019', '020', '021', '022', '023', '024', '025', '026',
            '027', '028', '029', '030', '031', '032', '033', '034', '035', '101',
            '102', '103', '104', '105']
 
-def gridcell_correlations(x, y, lag, smooth):
+def parse_lags(lag_str):
     """
-    This is the main analysis part of the script. Use this on an xarray 
-    apply function to correlate the current gridcell residuals with
-    the regional area-weighted time series. This definition uses the 
-    global gridcell as the predictor, and smooths with a 12 month running
-    mean to deal with the noisiness of CO2 flux residuals.
+    Converts the lag input into either a single int or a list of lags if
+    given an inclusive range like "0..24".
+    """
+    if '..' in lag_str:
+        lag0, lag1 = lag_str.split('..')
+        return list(range(int(lag0), int(lag1) + 1))
+    else:
+        return int(lag_str)
+
+def field_correlations(x, y, lag, smooth):
+    """
+    This is the main analysis part of the script. It correlates every global
+    gridcell's residuals with the regional area-weighted time series in one
+    batched call (see vectorized_stats.py), rather than one gridcell at a
+    time. This definition uses the global gridcell as the predictor, and
+    smooths with a 12 month running mean to deal with the noisiness of CO2
+    flux residuals.
 
     The user needs to define the lag keyword which will automatically have
-    the predictor variable lead the gas flux anomalies.
+    the predictor variable lead the gas flux anomalies. If lag is a list,
+    all lags are computed in one pass and stacked on a `lag` dimension.
 
     The user also needs to define the smooth keyword to either turn on
     12 month smoothing or to keep smoothing off.
 
-    It returns a Dataset with the slope, r-value, and p-value.
+    Land cells come out as NaN. It returns a Dataset with the slope,
+    r-value, and p-value.
     """
-    # Check for NaNs.
-    if x.min().isnull():
-        return xr.Dataset({'m': np.nan, 'r': np.nan, 'p': np.nan})
-    else:
-        # Smooth by 12 months if indicated.
-        if smooth:
-            x = x.rolling(time=12).mean().dropna('time')
-            y = y.rolling(time=12).mean().dropna('time')
-        if lag == 0:
-            m, _, r, p, _ = et.stats.linear_regression(x, y)
-        else:
-            m, _, r, p, _ = et.stats.linear_regression(x[:-lag], y[lag:])
-        return xr.Dataset({'m': m, 'r': r, 'p': p})
+    # Smooth by 12 months if indicated, with running means from one prefix
+    # sum over the whole field. The leading window is trimmed by position
+    # rather than dropna, since land cells are NaN at every time step.
+    if smooth:
+        x = moving_average(x, 12)
+        y = moving_average(y, 12)
+    if isinstance(lag, list):
+        return lagged_linear_regression(x, y, lag, dim='time')
+    if lag != 0:
+        x = x.isel(time=slice(None, -lag))
+        y = y.isel(time=slice(lag, None))
+    return linear_regression(x, y, dim='time')
 
 def main():
     VARY = sys.argv[1]
     GLOBAL_VAR = sys.argv[2]
-    LAG = int(sys.argv[3])
-    ENS = int(sys.argv[4])
-    SMOOTH = sys.argv[5]
+    LAG = parse_lags(sys.argv[3])
+    LAG_STR = sys.argv[3].replace('..', '-') # For directory/file naming.
+    ENS = sys.argv[4]
+    SMOOTH = (sys.argv[5] == "True")
+    # "all" runs the full ensemble in one go with ensemble as a dimension.
+    FULL_ENSEMBLE = (ENS == 'all')
+    if FULL_ENSEMBLE:
+        ENS_LABEL = 'ensemble'
+    else:
+        ENS = int(ENS)
+        ENS_LABEL = ens_str[ENS]
     print("Working on " + GLOBAL_VAR + " regressions for simulation " +
-          ens_str[ENS] + "...")
+          ENS_LABEL + "...")
     # Load in area-weighted residuals for natural CO2 flux for the region
     # or a climate index indicator.
-    if VARY in ['SAM', 'NINO34', 'PDO', 'AMO']:
-        filepath = ('/glade/p/work/rbrady/cesmLE_CVDP/processed/')
-        filename = 'cvdp_detrended_BGC.nc'
-        ds_regional = xr.open_dataset(filepath + filename)
-        ds_regional = ds_regional[VARY.lower()][ENS]
-    elif VARY == 'NPGO':
-        filepath = '/glade/p/work/rbrady/EBUS_BGC_Variability/NPGO/'
-        filename = 'NPGO.' + ens_str[ENS] + '.1920-2015.nc'
-        ds_regional = xr.open_dataset(filepath + filename)
-        ds_regional = ds_regional['pc']
+    if VARY in ['SAM', 'NINO34', 'PDO', 'AMO', 'NPGO'] or VARY in INDICES:
+        # See climate_indices.py (and index_builder.py).
+        ds_regional = load_index(VARY)
     else:
         filedir = ('/glade/p/work/rbrady/EBUS_BGC_Variability/FG_ALT_CO2/' +
                VARY + '/filtered_output/' + VARY.lower() +
                '-FG_ALT_CO2-residuals-AW-chavez-800km.nc')
-        # This is our 1152x1 regional time series for the given simulation.
+        # This is our 34x1152 regional time series for the full ensemble.
         ds_regional = xr.open_dataset(filedir)
-        ds_regional = ds_regional['FG_ALT_CO2_AW'][ENS]
-    # Load in global residuals for this simulation.
+        ds_regional = ds_regional['FG_ALT_CO2_AW']
+    if not FULL_ENSEMBLE and 'ensemble' in ds_regional.dims:
+        ds_regional = ds_regional[ENS]
+    # Load in global residuals for this simulation (or all of them).
     GLOBAL_DIR = ('/glade/scratch/rbrady/EBUS_BGC_Variability/' + 
                   'global_residuals/' + GLOBAL_VAR + '/')
-    filedir = (GLOBAL_DIR + 'residual.' + GLOBAL_VAR + '.' + ens_str[ENS] +
-               '.192001-201512.nc')
-    # This is our 1152x384x320 da of global residuals.
-    ds_global = xr.open_dataset(filedir)
-    # Determine if ocean or atmosphere output for stacking.
-    if ds_global.dims.__contains__('nlon'):
-        OCEAN=True
+    if FULL_ENSEMBLE:
+        # This is our 34x1152x384x320 da of global residuals, chunked by
+        # member so each one is regressed in parallel by dask.
+        filenames = [GLOBAL_DIR + 'residual.' + GLOBAL_VAR + '.' + e +
+                     '.192001-201512.nc' for e in ens_str]
+        ds_global = xr.open_mfdataset(filenames, concat_dim='ensemble',
+                                      combine='nested',
+                                      chunks={'ensemble': 1})
+        # Label members identically so the predictor lines up with them.
+        ds_global['ensemble'] = ens_str
+        ds_regional['ensemble'] = ens_str
     else:
-        OCEAN=False
-    # Perform computation!
-    print("Beginning global correlations for #" + ens_str[ENS])
-    if OCEAN: # Ocean grid
-        correlation = ds_global[GLOBAL_VAR].stack(gridpoints=['nlat','nlon']) \
-                                           .groupby('gridpoints') \
-                                           .apply(gridcell_correlations, 
-                                                  y=ds_regional,
-                                                  lag=LAG,
-                                                  smooth=SMOOTH) \
-                                           .unstack('gridpoints')
-    else: # Atmospheric grid
-        correlation = ds_global[GLOBAL_VAR].stack(gridpoints=['lat','lon']) \
-                                           .groupby('gridpoints') \
-                                           .apply(gridcell_correlations,
-                                                  y=ds_regional,
-                                                  lag=LAG,
-                                                  smooth=SMOOTH) \
-                                           .unstack('gridpoints')
-    print("Finished global correlations for #" + ens_str[ENS])
+        filedir = (GLOBAL_DIR + 'residual.' + GLOBAL_VAR + '.' +
+                   ens_str[ENS] + '.192001-201512.nc')
+        # This is our 1152x384x320 da of global residuals.
+        ds_global = xr.open_dataset(filedir)
+    # Perform computation! Works the same on the ocean (nlat/nlon) and
+    # atmospheric (lat/lon) grids.
+    print("Beginning global correlations for #" + ENS_LABEL)
+    correlation = field_correlations(ds_global[GLOBAL_VAR], ds_regional,
+                                     lag=LAG, smooth=SMOOTH)
+    if FULL_ENSEMBLE:
+        correlation = ensemble_summary(correlation.compute())
+    print("Finished global correlations for #" + ENS_LABEL)
     OUT_DIR = ('/glade/p/work/rbrady/EBUS_BGC_Variability/global_regressions/' +
-               GLOBAL_VAR + '/' + VARY + '/lag' + str(LAG) + '/')
+               GLOBAL_VAR + '/' + VARY + '/lag' + LAG_STR + '/')
     if not os.path.exists(OUT_DIR):
         os.makedirs(OUT_DIR)
-    if SMOOTH == "True": # Save with smoothing in filename
+    if SMOOTH: # Save with smoothing in filename
         if VARY in ['CalCS', 'HumCS', 'CanCS', 'BenCS']:
             out_file = (OUT_DIR + GLOBAL_VAR + '.FG_ALT_CO2.' + VARY + '.' +
-                        ens_str[ENS] + '.smoothed_global_regression.lag' +
-                        str(LAG) + '.nc')
+                        ENS_LABEL + '.smoothed_global_regression.lag' +
+                        LAG_STR + '.nc')
         else:
             out_file = (OUT_DIR + GLOBAL_VAR + '.' + VARY + '.' +
-                        ens_str[ENS] + '.smoothed_global_regression.lag' +
-                        str(LAG) + '.nc')
+                        ENS_LABEL + '.smoothed_global_regression.lag' +
+                        LAG_STR + '.nc')
     else:
         if VARY in ['CalCS', 'HumCS', 'CanCS', 'BenCS']:
             out_file = (OUT_DIR + GLOBAL_VAR + '.FG_ALT_CO2.' + VARY + '.' + 
-                        ens_str[ENS] + '.unsmoothed_global_regression.lag' +
-                        str(LAG) + '.nc')
+                        ENS_LABEL + '.unsmoothed_global_regression.lag' +
+                        LAG_STR + '.nc')
         else:
             out_file = (OUT_DIR + GLOBAL_VAR + '.' + VARY + '.' +
-                        ens_str[ENS] + '.unsmoothed_global_regression.lag' +
-                        str(LAG) + '.nc')
-    print("Saving #" + ens_str[ENS] + " to netCDF...")
+                        ENS_LABEL + '.unsmoothed_global_regression.lag' +
+                        LAG_STR + '.nc')
+    print("Saving #" + ENS_LABEL + " to netCDF...")
     correlation.to_netcdf(out_file)
 
 if __name__ == '__main__':
@@ -5,72 +5,132 @@ Date : Sep. 20th, 2017
 Purpose: Given an ocean variable, this will find the magnitude of the historical
 seasonal cycle and the magnitude of internal variability over the global grid.
 It will save each magnitude as a netCDF variable.
+
+Everything is computed in a single pass over the member files. The full
+ensemble is read a few time steps at a time (all members at once, so the
+ensemble mean is known for those time steps), and running accumulators keep
+the monthly climatology of the ensemble mean and a Welford-style mean/M2 of
+each member's residuals. Memory is set by MAX_CHUNK_BYTES plus the
+accumulators, and no temporary netCDFs are written to scratch.
 """
 # INPUT 1: Variable name (str)
 import glob
 import sys
 import os
 import numpy as np
-import pandas as pd
 import xarray as xr
-import esmtools as et
+from climatology import seasonal_amplitude
+
+# Upper bound on the size of each block of (ensemble, time, nlat, nlon) data
+# read in at once.
+MAX_CHUNK_BYTES = 5e8
+# 1920-2015 is the first 1152 months of the 1920-2100 record.
+NTIME = 1152
 
 def load_ensemble(VAR):
         """
-        Loads the global full ensemble from scratch space.
+        Lazily opens the global full ensemble from scratch space. Nothing is
+        read until streaming_magnitudes pulls blocks of time steps.
         """
         fileDir = ('/glade/scratch/rbrady/EBUS_BGC_Variability/' +
                    VAR + '_monthly/')
-        ds = xr.open_mfdataset(fileDir + 'reduced*.nc', decode_times=False,
-                               concat_dim='ensemble', chunks={'time':10})
-        ds.attrs = {}
-        ds = ds[VAR].to_dataset()
-        ds['time'] = pd.date_range('1920-01', '2101-01', freq='M')
-        if (VAR == "FG_CO2") or (VAR == "FG_ALT_CO2"):
-            # Convert to intelligible units.
-            ds[VAR] = ds[VAR] * ((-1 * 3600 * 24 * 365.25) / (1000 * 100))
-        return ds
+        files = sorted(glob.glob(fileDir + 'reduced*.nc'))
+        ds = xr.open_mfdataset(files, decode_times=False,
+                               concat_dim='ensemble', combine='nested')
+        da = ds[VAR].isel(time=slice(0, NTIME))
+        return da.transpose('ensemble', 'time', ...)
+
+def _nanmean0(x):
+    """
+    Mean over the first axis skipping NaNs (NaN where there is no data),
+    without the all-NaN warnings of np.nanmean.
+    """
+    valid = np.isfinite(x)
+    n = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, np.where(valid, x, 0).sum(axis=0) / n, np.nan)
+
+def streaming_magnitudes(da, scale=1):
+    """
+    Computes the seasonal magnitude of the ensemble mean and the mean
+    (over members) standard deviation of the residuals in one traversal of
+    the (ensemble, time, nlat, nlon) data.
+
+    Each block holds every member for a few time steps, so the ensemble mean
+    and residuals for those steps are exact. Residual variances are built up
+    with Chan/Welford updates of a running mean and M2 per member, and the
+    ensemble mean is summed into monthly bins for the climatology. The
+    record is assumed to start in January.
+
+    Missing values are skipped everywhere, like the skipna means and std
+    this replaces: the ensemble mean is over the members with data, and
+    every accumulator keeps its own count per member and gridcell, so an
+    isolated NaN only drops that one value.
+
+    scale is a unit conversion applied to each block as it is read.
+    """
+    nens = da.sizes['ensemble']
+    ntime = da.sizes['time']
+    grid = da.shape[2:]
+    tchunk = max(1, int(MAX_CHUNK_BYTES // (nens * np.prod(grid) * 8)))
+    count = np.zeros((nens,) + grid)
+    mean = np.zeros((nens,) + grid)
+    m2 = np.zeros((nens,) + grid)
+    month_sum = np.zeros((12,) + grid)
+    month_count = np.zeros((12,) + grid)
+    for t0 in range(0, ntime, tchunk):
+        x = da.isel(time=slice(t0, t0 + tchunk)).values * scale
+        forced = _nanmean0(x)
+        resid = x - forced
+        valid = np.isfinite(resid)
+        # Welford/Chan update of each member's residual mean and M2, over
+        # the time steps each gridcell has data for.
+        n_b = valid.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_b = np.where(n_b > 0,
+                              np.where(valid, resid, 0).sum(axis=1) / n_b, 0)
+        m2_b = np.where(valid, resid - mean_b[:, np.newaxis], 0)
+        m2_b = (m2_b ** 2).sum(axis=1)
+        n = count + n_b
+        delta = mean_b - mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(n > 0, mean + delta * n_b / n, mean)
+            m2 = np.where(n > 0, m2 + m2_b + delta ** 2 * count * n_b / n, m2)
+        count = n
+        # Monthly sums of the ensemble mean for the climatology.
+        n_b = x.shape[1]
+        months = np.arange(t0, t0 + n_b) % 12
+        has = np.isfinite(forced)
+        np.add.at(month_sum, months, np.where(has, forced, 0))
+        np.add.at(month_count, months, has)
+        print("Processed " + str(t0 + n_b) + " of " + str(ntime) +
+              " time steps...")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clim = np.where(month_count > 0, month_sum / month_count, np.nan)
+        std = np.where(count > 0, np.sqrt(m2 / count), np.nan)
+    clim = xr.DataArray(clim, dims=('month',) + da.dims[2:])
+    s_magnitude = seasonal_amplitude(clim).values
+    r_magnitude = _nanmean0(std)
+    return s_magnitude, r_magnitude
 
 def main():
     VAR = sys.argv[1]
-    ds = load_ensemble(VAR)
-    # Extract 1920-2015
-    ds = ds.sel(time=slice('1920-01','2015-12'))
-    # Find ensemble mean
-    ds = ds.mean(dim='ensemble')
-    # Save out and load back in
-    temp_file = '/glade/scratch/rbrady/temp_' + VAR + '.nc'
-    ds.to_netcdf(temp_file)
-    del ds
-    ds = xr.open_dataset(temp_file)
-    print("Computing seasonal magnitude across grid...")
-    ds = ds[VAR].stack(allpoints=['nlat','nlon']) \
-                    .groupby('allpoints', squeeze=False) \
-                    .apply(et.ufunc.seasonal_magnitude) \
-                    .unstack('allpoints')
-    ds.name = 's_magnitude'
-    ds.attrs['long name'] = 'Magnitude of 1920-2015 seasonal cycle'
-    # Save as temporary netCDF for memory concerns.
-    seasonal_file = '/glade/scratch/rbrady/seasonal_' + VAR + '.nc'
-    ds.to_dataset().to_netcdf(seasonal_file)
-    # To save memory...
-    del ds
-    os.remove(temp_file)
-    # Find residuals
-    print("Computing residuals across grid...")
-    ds = load_ensemble(VAR)
-    ds = ds.sel(time=slice('1920-01', '2015-12'))
-    ds = ds - ds.mean(dim='ensemble')
-    ds = ds[VAR].std(dim='time').mean(dim='ensemble')
-    ds.name = 'r_magnitude'
-    ds.attrs['long name'] = 'Mean standard deviation of 1920-2015 residuals'
-    ds = ds.to_dataset()
-    # Load back in seasonal file.
-    ds2 = xr.open_dataset(seasonal_file)
-    os.remove(seasonal_file)
+    da = load_ensemble(VAR)
+    if (VAR == "FG_CO2") or (VAR == "FG_ALT_CO2"):
+        # Convert to intelligible units.
+        scale = ((-1 * 3600 * 24 * 365.25) / (1000 * 100))
+    else:
+        scale = 1
+    print("Computing seasonal and residual magnitudes across grid...")
+    s_mag, r_mag = streaming_magnitudes(da, scale=scale)
+    dims = da.dims[2:]
     variability = xr.Dataset()
-    variability['s_magnitude'] = ds2['s_magnitude']
-    variability['r_magnitude'] = ds['r_magnitude']
+    variability['s_magnitude'] = (dims, s_mag)
+    variability['s_magnitude'].attrs['long name'] = \
+        'Magnitude of 1920-2015 seasonal cycle'
+    variability['r_magnitude'] = (dims, r_mag)
+    variability['r_magnitude'].attrs['long name'] = \
+        'Mean standard deviation of 1920-2015 residuals'
     # Add in global coordinates for reference.
     coords = xr.open_dataset('/glade/p/work/rbrady/EBUS_BGC_Variability/' + 
                              'global_coordinates.nc')
@@ -0,0 +1,168 @@
+"""
+Index Builder
+-------------
+
+Builds climate indices for the full ensemble from the remapped global
+residuals, from a declaration of each index in INDICES rather than one ad hoc
+script per index (and one job per member).
+
+An index is declared as either:
+    'box' : the cos(lat)-weighted mean of a variable over a lat/lon box.
+    'eof' : a mode (0 is the leading one) of a variable's EOFs over a lat/lon
+        domain, computed from annual means of the given months (e.g. JFM)
+        weighted by sqrt(cos(lat)), with the monthly field projected onto it
+        (see ensemble_eofs in vectorized_stats.py). 'sign' is a (lat, lon)
+        point where the pattern is made positive.
+
+Every requested index is built in one streaming pass over the residuals:
+each member's file for each variable is opened once, and every index on that
+variable is computed from its own window of it before moving on to the next
+member. Each index is saved as
+<work>EBUS_BGC_Variability/indices/<NAME>/<NAME>.full_ensemble.<years>.nc with
+an (ensemble, time) variable named after the index, which is where
+climate_indices.load_index looks first, so the regression scripts can use a
+built index by name. Indices that have already been built are skipped.
+
+INPUT 1: Index names, comma-separated (e.g. 'NPGO,NINO34_SSTA'), or "all"
+INPUT 2: (Optional) Starting year (default 1920)
+INPUT 3: (Optional) Ending year (default 2015)
+INPUT 4: (Optional) "overwrite" to rebuild indices that already exist
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+import xarray as xr
+from area_weighting import area_weighted_mean
+from vectorized_stats import ensemble_eofs
+from climate_indices import WORK_DIR, ens_str, built_index_path
+
+RESIDUAL_DIR = ('/glade/scratch/rbrady/EBUS_BGC_Variability/' +
+                'global_residuals/')
+
+INDICES = {
+    'NPGO': {'kind': 'eof', 'var': 'SST', 'lat': (25, 62), 'lon': (180, 250),
+             'months': [1, 2, 3], 'mode': 1, 'sign': (45.5, 210),
+             'long_name': 'Second mode of JFM SSTa over 25-62N, 180-110W'},
+    'NINO34_SSTA': {'kind': 'box', 'var': 'SST', 'lat': (-5, 5),
+                    'lon': (190, 240),
+                    'long_name': 'SSTa averaged over 5S-5N, 170-120W'},
+}
+
+
+def residual_file(VAR, ens):
+    """
+    Path to the remapped (1x1 degree) global residuals for one member.
+    """
+    return (RESIDUAL_DIR + VAR + '/remapped/remapped.' + VAR + '.' + ens +
+            '.192001-210012.nc')
+
+
+def open_residuals(VAR, ens, sYear, eYear):
+    """
+    Lazily opens one member's remapped residuals over the given years.
+    """
+    ds = xr.open_dataset(residual_file(VAR, ens), decode_times=False)
+    da = ds[VAR].squeeze()
+    # Make time dimension readable through xarray.
+    da['time'] = pd.date_range('1920-01', '2101-01', freq='M')
+    return da.sel(time=slice(str(sYear) + '-01', str(eYear) + '-12'))
+
+
+def window(da, spec):
+    """
+    The lat/lon box or domain of an index.
+    """
+    return da.sel(lat=slice(*spec['lat']), lon=slice(*spec['lon']))
+
+
+def box_index(da, spec):
+    """
+    cos(lat)-weighted mean of da over the box, ignoring missing cells.
+    """
+    da = window(da, spec)
+    coslat = np.cos(np.deg2rad(da['lat'])) * xr.ones_like(da['lon'])
+    return area_weighted_mean(da, coslat, dims=('lat', 'lon'))
+
+
+def eof_index(da, spec):
+    """
+    EOF index of da (with or without an ensemble dimension) over the
+    domain. Returns a Dataset with the monthly projected 'pc', the 'eof'
+    pattern (as a correlation with the seasonal means), and its
+    'variance_fraction'.
+    """
+    da = window(da, spec)
+    seasonal = da.where(da['time.month'].isin(spec['months'])) \
+                 .groupby('time.year').mean('time')
+    wgts = np.sqrt(np.cos(np.deg2rad(seasonal['lat'])))
+    ds = ensemble_eofs(seasonal, neofs=spec['mode'] + 1, weights=wgts,
+                       dim='year', project=da)
+    ds = ds.sel(mode=spec['mode'])
+    if 'sign' in spec:
+        lat, lon = spec['sign']
+        sign = xr.where(ds['eof'].sel(lat=lat, lon=lon) > 0, 1, -1)
+        ds['eof'] = ds['eof'] * sign
+        ds['pc'] = ds['pc'] * sign
+    return ds
+
+
+def build_indices(names, sYear=1920, eYear=2015, work=WORK_DIR,
+                  overwrite=False):
+    """
+    Builds every index in `names` (keys of INDICES) for the full ensemble in
+    one pass over each variable's residual files, and saves each one. Returns
+    the paths of the index files.
+    """
+    years = str(sYear) + '01-' + str(eYear) + '12'
+    paths = dict((n, built_index_path(n, work, years)) for n in names)
+    todo = [n for n in names if overwrite or not os.path.exists(paths[n])]
+    VARS = sorted(set(INDICES[n]['var'] for n in todo))
+    members = dict((n, []) for n in todo)
+    for ens in ens_str:
+        print("Building indices for ensemble member " + ens + "...")
+        for VAR in VARS:
+            da = open_residuals(VAR, ens, sYear, eYear)
+            for n in todo:
+                spec = INDICES[n]
+                if spec['var'] != VAR:
+                    continue
+                # Only this index's window is read from the file.
+                sub = window(da, spec).load()
+                if spec['kind'] == 'box':
+                    ds = box_index(sub, spec).to_dataset(name=n)
+                else:
+                    ds = eof_index(sub, spec).rename({'pc': n})
+                members[n].append(ds)
+            da.close()
+    for n in todo:
+        ds = xr.concat(members[n], dim='ensemble')
+        ds['ensemble'] = ens_str
+        ds[n].attrs['long_name'] = INDICES[n]['long_name']
+        ds.attrs['description'] = ('Built by index_builder.py from the ' +
+                                   'remapped global residuals.')
+        directory = os.path.dirname(paths[n])
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        print("Saving " + n + " to netCDF...")
+        ds.to_netcdf(paths[n])
+    return [paths[n] for n in names]
+
+
+def main():
+    if sys.argv[1] == 'all':
+        names = list(INDICES.keys())
+    else:
+        names = sys.argv[1].split(',')
+    for n in names:
+        if n not in INDICES:
+            raise ValueError(n + " is not declared. Need to pass one of " +
+                             ", ".join(INDICES.keys()))
+    sYear = int(sys.argv[2]) if len(sys.argv) > 2 else 1920
+    eYear = int(sys.argv[3]) if len(sys.argv) > 3 else 2015
+    overwrite = len(sys.argv) > 4 and sys.argv[4] == 'overwrite'
+    build_indices(names, sYear, eYear, overwrite=overwrite)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,9 @@ for other single time series in the future.
 INPUT 1: Str for EBUS ('CalCS', 'CanCS', 'HumCS', 'BenCS')
 INPUT 2: Predictor climate variable for the residuals 
     ('NPGO', 'PDO', 'ENSO', 'AMO', etc.)
-INPUT 3: Int for ensemble member number (0..34)
+INPUT 3: Int for ensemble member number (0..33), or "all" to regress the full
+    ensemble in one run. The output then has an `ensemble` dimension plus
+    ensemble-mean and sign agreement summaries.
 INPUT 4: Int for number of months to lag (0 is no lag).
 INPUT 5: Int for how many months to smooth by (0 is no smoothing). 
 """
@@ -29,83 +31,78 @@ import sys
 import os
 import numpy as np
 import xarray as xr
-import esmtools as et
+from climate_indices import load_index, moving_average
+from vectorized_stats import linear_regression, ensemble_summary
 
 ens_str = ['001', '002', '009', '010', '011', '012', '013', '014', '015', '016',
            '017', '018', '019', '020', '021', '022', '023', '024', '025', '026',
            '027', '028', '029', '030', '031', '032', '033', '034', '035', '101',
            '102', '103', '104', '105']
 
-def gridcell_correlations(y, x, lag, smooth):
+def field_correlations(y, x, lag, smooth):
     """
-    This is the main analysis part of the script. use this on an xarray apply
-    function to correlate the current gridcell residuals with the climate
-    time series. This definition uses the climate time series as the predictor
-    and the EBU time series as the predicted.
+    This is the main analysis part of the script. It correlates every
+    gridcell's residuals with the climate time series in one batched call
+    (see vectorized_stats.py). This definition uses the climate time series
+    as the predictor and the EBU time series as the predicted. Both can carry
+    an `ensemble` dimension, in which case each member is regressed against
+    its own climate index.
 
     You can set a lag of N months.
 
-    Smooth is a boolean of whether or not to smooth. (In the future, you can
-    make this an int on how many months to smooth, with 0 being no smoothing)
+    Smooth is an int for how many months to smooth by (0 is no smoothing).
 
-    It returns a dataset with the slope, r-value, and p-value.
+    Coastline cells come out as NaN. It returns a dataset with the slope,
+    r-value, and p-value.
     """
-    # Check for NaNs (coastlines).
-    if y.min().isnull():
-        return xr.Dataset({'m': np.nan, 'r': np.nan, 'p': np.nan})
-    else:
-        if smooth != 0:
-            x = x.rolling(time=smooth).mean().dropna('time')
-            y = y.rolling(time=smooth).mean().dropna('time')
-        if lag == 0:
-            m, _, r, p, _ = et.stats.linear_regression(x, y)
-        else:
-            m, _, r, p, _ = et.stats.linear_regression(x[:-lag], y[lag:])
-        return xr.Dataset({'m': m, 'r': r, 'p': p})
+    # Running means from one prefix sum over the whole field, trimmed by
+    # position rather than dropna, since land cells are NaN at every time
+    # step.
+    x = moving_average(x, smooth)
+    y = moving_average(y, smooth)
+    if lag != 0:
+        x = x.isel(time=slice(None, -lag))
+        y = y.isel(time=slice(lag, None))
+    return linear_regression(x, y, dim='time')
 
 def main():
     EBU = sys.argv[1]
     VARX = sys.argv[2]
-    ENS = int(sys.argv[3])
+    ENS = sys.argv[3]
     LAG = int(sys.argv[4])
     SMOOTH = int(sys.argv[5])
-    print("Working on " + VARX + " regressions for simulation " + 
-          ens_str[ENS] + " over the " + EBU + "...")
-    if VARX == 'NPGO':
-        """
-        This was a custom EOF procedure, so the NC files are very different 
-        from the way Adam Phillips set his up.
-        """
-        filepath = '/glade/p/work/rbrady/EBUS_BGC_Variability/NPGO/'
-        filename = 'NPGO.' + ens_str[ENS] + '.1920-2015.nc'
-        ds_x = xr.open_dataset(filepath + filename)
-        # Pull out a DA of the principal component time series.
-        ds_x = ds_x['pc']
+    # "all" runs the full ensemble in one go with ensemble as a dimension.
+    FULL_ENSEMBLE = (ENS == 'all')
+    if FULL_ENSEMBLE:
+        ENS_LABEL = 'ensemble'
     else:
-        """
-        This assumes the variable can be found in Adam Phillip's climate
-        diagnostics output. Need to edit this loading if that's not the
-        case.
-        """
-        filepath = '/glade/p/work/rbrady/cesmLE_CVDP/processed/'
-        filename = 'cvdp_detrended_BGC.nc'
-        ds_x = xr.open_dataset(filepath + filename)
-        ds_x = ds_x[VARX.lower()][ENS]
+        ENS = int(ENS)
+        ENS_LABEL = ens_str[ENS]
+    print("Working on " + VARX + " regressions for simulation " + 
+          ENS_LABEL + " over the " + EBU + "...")
+    # Load in the climate index (see climate_indices.py).
+    ds_x = load_index(VARX)
+    if not FULL_ENSEMBLE:
+        ds_x = ds_x[ENS]
     # Load in the co2 flux anomalies.
     filepath = ('/glade/p/work/rbrady/EBUS_BGC_Variability/FG_CO2/' +
                 EBU + '/filtered_output/')
     filename = EBU.lower() + '-FG_CO2-residuals-chavez-800km.nc'
     ds_y = xr.open_dataset(filepath + filename)
-    ds_y = ds_y['FG_CO2'][ENS]
+    ds_y = ds_y['FG_CO2']
+    if FULL_ENSEMBLE:
+        # Chunk by member so dask regresses each one in parallel, and label
+        # members identically so the predictor lines up with them.
+        ds_y = ds_y.chunk({'ensemble': 1})
+        ds_y['ensemble'] = ens_str
+        ds_x['ensemble'] = ens_str
+    else:
+        ds_y = ds_y[ENS]
     # Run the correlation.
-    correlation = ds_y.stack(gridpoints=['nlat','nlon']) \
-                      .groupby('gridpoints') \
-                      .apply(gridcell_correlations,
-                             x=ds_x,
-                             lag=LAG,
-                             smooth=SMOOTH) \
-                      .unstack('gridpoints')
-    print("Finished regional correlations for #" + ens_str[ENS])
+    correlation = field_correlations(ds_y, ds_x, lag=LAG, smooth=SMOOTH)
+    if FULL_ENSEMBLE:
+        correlation = ensemble_summary(correlation.compute())
+    print("Finished regional correlations for #" + ENS_LABEL)
     OUT_DIR = ('/glade/p/work/rbrady/EBUS_BGC_Variability/' +
                'regional_regressions/' + EBU + '/' + VARX + '/' +
                'lag' + str(LAG) + '/')
@@ -113,13 +110,13 @@ def main():
         os.makedirs(OUT_DIR)
     if SMOOTH != 0: # Save with smoothing in file name.
         out_file = (OUT_DIR + VARX + '.FG_CO2.' + EBU + '.' +
-                    ens_str[ENS] + '.smoothed' + str(SMOOTH) + 
+                    ENS_LABEL + '.smoothed' + str(SMOOTH) + 
                     '_regional_regression.lag' + str(LAG) + '.nc')
     else:
         out_file = (OUT_DIR + VARX + '.FG_CO2.' + EBU + '.' +
-                    ens_str[ENS] + '.unsmoothed_regional_regression.lag' +
+                    ENS_LABEL + '.unsmoothed_regional_regression.lag' +
                     str(LAG) + '.nc')
-    print("Saving #" + ens_str[ENS] + " to netCDF...")
+    print("Saving #" + ENS_LABEL + " to netCDF...")
     correlation.to_netcdf(out_file)
 
 if __name__ == '__main__':
@@ -0,0 +1,268 @@
+"""
+pCO2 Taylor
+-----------
+
+Gridded Taylor-expansion decomposition of pCO2 anomalies into their SST,
+SSS, freshwater, sDIC, sALK, PO4 and SiO3 contributions, ported from
+scripts/mat/+csys/pco2taylor.m (and dpco2dx.m) to run on every gridcell and
+ensemble member at once.
+
+Given a base state Xbar (e.g. the forced signal from
+generate_regional_residuals.py, or its time mean) and anomalies dX (the
+residuals), the state Xnew = Xbar + dX and
+
+    dpCO2 ~ sum_i dF/dX_i dX_i                    (first order)
+          + sum_i 0.5 d2F/dX_i2 dX_i^2             (second order, auto)
+          + sum_i>j d2F/dX_idX_j dX_i dX_j         (second order, cross)
+
+with the DIC and ALK terms split into salinity-normalized (sdic, salk) and
+freshwater (fw) parts as in pco2taylor.m. trunc_err is the expansion minus
+the exact change in pCO2 (both pCO2 values from co2calc.py).
+
+Sensitivities are either:
+    'fd' : finite differences as in dpco2dx.m, perturbing each input by
+        DXINC of its base value (in the direction of its anomaly). Every
+        perturbed state of a block (29 of them with second order terms) is
+        solved in one call to the vectorized carbonate solver.
+    'analytic' : the approximate first-order sensitivities from the old
+        overhead-pco2-taylor script (0.0423 pCO2 for SST, pCO2/S for SSS,
+        and the DIC/ALK buffer factors). No PO4/SiO3 or second order terms.
+
+Everything goes through xr.apply_ufunc, so dask-backed inputs stay lazy and
+are decomposed chunk by chunk.
+
+INPUT 1: EBUS ('CalCS', 'HumCS', 'CanCS', 'BenCS')
+INPUT 2: (Optional) 'fd' (default) or 'analytic'
+INPUT 3: (Optional) 'mean' to expand about the time-mean forced signal
+         rather than the forced signal at each time step
+"""
+import os
+import sys
+import numpy as np
+import xarray as xr
+from co2calc import carbonate_arrays
+
+SBAR = 35.0
+DXINC = 8.6865e-05
+
+# Carbonate system inputs, in the order co2calc takes them, and the model
+# variable each one comes from.
+FIELDS = ['SALT', 'TEMP', 'DIC', 'ALK', 'PO4', 'SiO3']
+MODEL_VARS = {'SALT': 'SALT', 'TEMP': 'SST', 'DIC': 'DIC', 'ALK': 'ALK',
+              'PO4': 'PO4', 'SiO3': 'SiO3'}
+SHORT = {'SALT': 'sss', 'TEMP': 'sst', 'DIC': 'dic', 'ALK': 'alk',
+         'PO4': 'po4', 'SiO3': 'si'}
+
+FIRST_ORDER = ['sss', 'sst', 'fw', 'sdic', 'salk', 'po4', 'si']
+
+
+def _pairs():
+    """
+    (i, j) input index pairs with j <= i, in dpco2dx.m's order.
+    """
+    return [(i, j) for i in range(len(FIELDS)) for j in range(i + 1)]
+
+
+def term_names(second_order=True):
+    """
+    Names of the terms that decompose() returns, in order.
+    """
+    names = FIRST_ORDER + ['dic', 'alk']
+    if second_order:
+        for i, j in _pairs():
+            names.append(SHORT[FIELDS[i]] + '_' + SHORT[FIELDS[j]])
+        names += ['secondorder_auto', 'secondorder_cross', 'secondorder']
+    names += ['firstorder', 'total', 'exact', 'trunc_err']
+    return names
+
+
+def _pco2(states):
+    """
+    pCO2 (uatm) for a list of (SALT, TEMP, DIC, ALK, PO4, SiO3) states,
+    solved together in one call.
+    """
+    stacked = [np.stack(np.broadcast_arrays(*[s[k] for s in states]))
+               for k in range(len(FIELDS))]
+    SALT, TEMP, DIC, ALK, PO4, SiO3 = stacked
+    return carbonate_arrays(DIC, ALK, TEMP, SALT, PO4, SiO3)['pCO2']
+
+
+def _fd_sensitivities(xbar, dx, second_order, inc):
+    """
+    Base and new pCO2, and the finite-difference first (and second)
+    derivatives of pCO2 with respect to each input, as in dpco2dx.m.
+    """
+    n = len(FIELDS)
+    step = [np.sign(dx[i]) * inc * xbar[i] for i in range(n)]
+    xnew = [xbar[i] + dx[i] for i in range(n)]
+    states = [xbar, xnew]
+    for i in range(n):
+        p = list(xbar)
+        p[i] = p[i] + step[i]
+        states.append(p)
+    if second_order:
+        for i, j in _pairs():
+            p = list(xbar)
+            p[j] = p[j] + step[j]
+            p[i] = p[i] + step[i]
+            states.append(p)
+    F = _pco2(states)
+    F_bar, F_new, F_i = F[0], F[1], F[2:2 + n]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1 = [np.where(step[i] != 0, (F_i[i] - F_bar) / step[i],
+                       F_i[i] - F_bar) for i in range(n)]
+        d2 = {}
+        if second_order:
+            for k, (i, j) in enumerate(_pairs()):
+                d = (F[2 + n + k] - F_i[j]) - (F_i[i] - F_bar)
+                d = np.where(step[i] != 0, d / step[i], d)
+                d2[(i, j)] = np.where(step[j] != 0, d / step[j], d)
+    return F_bar, F_new, d1, d2
+
+
+def _analytic_sensitivities(xbar, dx):
+    """
+    Base and new pCO2, and the approximate first derivatives of pCO2 from
+    the temperature sensitivity of Takahashi et al. (1993) and the DIC/ALK
+    buffer factors of Sarmiento and Gruber (2006).
+    """
+    SALT, TEMP, DIC, ALK = xbar[:4]
+    xnew = [xbar[i] + dx[i] for i in range(len(FIELDS))]
+    F_bar, F_new = _pco2([xbar, xnew])
+    gamma_DIC = (3 * ALK * DIC - 2 * DIC ** 2) / ((2 * DIC - ALK) * (ALK - DIC))
+    gamma_ALK = (-ALK ** 2) / ((2 * DIC - ALK) * (ALK - DIC))
+    d1 = [F_bar / SALT, 0.0423 * F_bar, (F_bar / DIC) * gamma_DIC,
+          (F_bar / ALK) * gamma_ALK, 0 * F_bar, 0 * F_bar]
+    return F_bar, F_new, d1, {}
+
+
+def _taylor_kernel(*args, **kwargs):
+    """
+    Every Taylor term, stacked along a new last axis (see term_names), from
+    the base state and anomalies of SALT, TEMP, DIC, ALK, PO4, SiO3, sDIC,
+    and sALK (16 arrays: the 8 base fields then the 8 anomalies).
+    """
+    method = kwargs['method']
+    second_order = kwargs['second_order'] and method == 'fd'
+    args = [np.asarray(a, dtype='float64') for a in args]
+    xbar, dx = args[:6], args[8:14]
+    sDIC, sALK, dsDIC, dsALK = args[6], args[7], args[14], args[15]
+    if method == 'fd':
+        F_bar, F_new, d1, d2 = _fd_sensitivities(xbar, dx, second_order,
+                                                 kwargs['inc'])
+    else:
+        F_bar, F_new, d1, d2 = _analytic_sensitivities(xbar, dx)
+    dS = dx[0]
+    S_bar = xbar[0]
+    terms = {}
+    for i, f in enumerate(FIELDS):
+        terms[SHORT[f]] = d1[i] * dx[i]
+    terms['fw'] = (d1[2] * ((sDIC + dsDIC) * dS / SBAR) +
+                   d1[3] * ((sALK + dsALK) * dS / SBAR))
+    terms['sdic'] = d1[2] * (dsDIC * S_bar / SBAR)
+    terms['salk'] = d1[3] * (dsALK * S_bar / SBAR)
+    terms['firstorder'] = sum(terms[t] for t in FIRST_ORDER)
+    terms['total'] = terms['firstorder']
+    if second_order:
+        auto = 0
+        cross = 0
+        for i, j in _pairs():
+            name = SHORT[FIELDS[i]] + '_' + SHORT[FIELDS[j]]
+            if i == j:
+                terms[name] = 0.5 * d2[(i, j)] * dx[i] * dx[i]
+                auto = auto + terms[name]
+            else:
+                terms[name] = d2[(i, j)] * dx[i] * dx[j]
+                cross = cross + terms[name]
+        terms['secondorder_auto'] = auto
+        terms['secondorder_cross'] = cross
+        terms['secondorder'] = auto + cross
+        terms['total'] = terms['firstorder'] + auto + cross
+    terms['exact'] = F_new - F_bar
+    terms['trunc_err'] = terms['total'] - terms['exact']
+    shape = np.broadcast(*args).shape
+    return np.stack([np.broadcast_to(terms[t], shape)
+                     for t in term_names(second_order)], axis=-1)
+
+
+def decompose(Xbar, dX, method='fd', second_order=True, inc=DXINC):
+    """
+    Taylor decomposition of the pCO2 change from the base state Xbar to
+    Xbar + dX, for every gridcell (and member, time, ...) at once.
+
+    Xbar and dX are Datasets (or dicts of DataArrays) with SALT, TEMP, DIC,
+    ALK, PO4 and SiO3 in POP units, broadcastable against each other (e.g.
+    an (nlat, nlon) or (time, nlat, nlon) forced signal and (ensemble, time,
+    nlat, nlon) residuals). sDIC and sALK (normalized to 35 psu) are used if
+    present, and otherwise derived from DIC, ALK and SALT.
+
+    Returns a Dataset with one variable per term (see term_names).
+    """
+    Xbar = dict((k, Xbar[k]) for k in Xbar if k in FIELDS + ['sDIC', 'sALK'])
+    dX = dict((k, dX[k]) for k in dX if k in FIELDS + ['sDIC', 'sALK'])
+    for s, v in [('sDIC', 'DIC'), ('sALK', 'ALK')]:
+        if s not in Xbar:
+            Xbar[s] = Xbar[v] / Xbar['SALT'] * SBAR
+        if s not in dX:
+            dX[s] = ((Xbar[v] + dX[v]) / (Xbar['SALT'] + dX['SALT']) * SBAR -
+                     Xbar[s])
+    order = FIELDS + ['sDIC', 'sALK']
+    second_order = second_order and method == 'fd'
+    names = term_names(second_order)
+    out = xr.apply_ufunc(_taylor_kernel,
+                         *([Xbar[k] for k in order] + [dX[k] for k in order]),
+                         kwargs={'method': method, 'inc': inc,
+                                 'second_order': second_order},
+                         output_core_dims=[['term']],
+                         dask='parallelized',
+                         output_dtypes=[float],
+                         dask_gufunc_kwargs={'output_sizes':
+                                             {'term': len(names)}})
+    out['term'] = names
+    dims = [d for d in dX['DIC'].dims if d in out.dims]
+    return out.transpose(*dims, ...).to_dataset('term')
+
+
+def load_taylor_inputs(EBU, base='/glade/work/rbrady/EBUS_BGC_Variability/',
+                       offshore=800):
+    """
+    Lazily opens the forced signal and residuals of every carbonate system
+    input for an EBUS, as written by generate_regional_residuals.py.
+    Returns (Xbar, dX) Datasets keyed by FIELDS.
+    """
+    Xbar = xr.Dataset()
+    dX = xr.Dataset()
+    for f in FIELDS:
+        VAR = MODEL_VARS[f]
+        directory = base + VAR + '/' + EBU + '/filtered_output/'
+        prefix = directory + EBU.lower() + '-' + VAR
+        suffix = '-chavez-' + str(offshore) + 'km.nc'
+        Xbar[f] = xr.open_dataset(prefix + '-forced-signal' + suffix,
+                                  chunks={'time': 120})[VAR]
+        dX[f] = xr.open_dataset(prefix + '-residuals' + suffix,
+                                chunks={'ensemble': 1, 'time': 120})[VAR]
+    return Xbar, dX
+
+
+def main():
+    EBU = sys.argv[1]
+    method = sys.argv[2] if len(sys.argv) > 2 else 'fd'
+    time_mean = len(sys.argv) > 3 and sys.argv[3] == 'mean'
+    print("Decomposing pCO2 in the " + EBU + " with " + method +
+          " sensitivities...")
+    Xbar, dX = load_taylor_inputs(EBU)
+    if time_mean:
+        Xbar = Xbar.mean('time')
+    ds = decompose(Xbar, dX, method=method)
+    directory = ('/glade/work/rbrady/EBUS_BGC_Variability/pCO2_taylor/' +
+                 EBU + '/')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    out_file = (directory + EBU.lower() + '-pCO2-taylor-' + method +
+                ('-mean' if time_mean else '') + '-chavez-800km.nc')
+    print("Saving to netCDF...")
+    ds.to_netcdf(out_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Subboxes
+--------
+
+Area-weighted forced and residual time series for any number of sub-regions
+of an EBUS, generalizing the onshore/offshore CalCS boxes that used to be hard
+coded in create_CalCS_subbox.py.
+
+A box can be given as:
+    {'nlat': (y0, y1), 'nlon': (x0, x1)} : inclusive index bounds on the
+        extracted EBUS grid (how the CalCS boxes were defined).
+    {'lat': (lat0, lat1), 'lon': (lon0, lon1)} : inclusive TLAT/TLONG bounds.
+    {'polygon': [(lon, lat), ...]} : cells whose centers fall inside the
+        polygon (in the EBUS grid's TLONG convention).
+    a boolean (nlat, nlon) array or DataArray : used as is.
+
+extract_subboxes reads each variable's ensemble store once and reduces every
+box in the same pass (see area_weighting.py), so sweeping dozens of boxes and
+several variables costs one read per variable.
+
+Import this from a script in the same directory, e.g.
+`from subboxes import extract_subboxes`.
+"""
+import numpy as np
+import xarray as xr
+from area_weighting import area_weighted_mean
+from ensemble_store import open_ensemble
+
+# Named boxes (index bounds on the EBUS_extraction.py grids). These are the
+# boxes that were created for the PDO/ENSO correlation for the CalCS.
+BOXES = {'CalCS': {'onshore': {'nlon': (18, 20), 'nlat': (22, 25)},
+                   'offshore': {'nlon': (13, 15), 'nlat': (27, 30)}}}
+
+
+def polygon_mask(x, y, vertices):
+    """
+    Boolean mask of the points (x, y) that fall inside the polygon given by
+    a list of (x, y) vertices, by even-odd ray casting over every point at
+    once.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inside = np.zeros(x.shape, dtype=bool)
+    vx, vy = np.asarray(vertices, dtype=float).T
+    for i in range(len(vx)):
+        x0, y0 = vx[i - 1], vy[i - 1]
+        x1, y1 = vx[i], vy[i]
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xcross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < xcross)
+    return inside
+
+
+def box_mask(ds, box):
+    """
+    Boolean (nlat, nlon) DataArray for a box spec (see module docstring) on
+    the grid of ds.
+    """
+    shape = (ds.sizes['nlat'], ds.sizes['nlon'])
+    dims = ('nlat', 'nlon')
+    if isinstance(box, dict) and 'nlat' in box:
+        mask = np.zeros(shape, dtype=bool)
+        y0, y1 = box['nlat']
+        x0, x1 = box['nlon']
+        mask[y0:y1 + 1, x0:x1 + 1] = True
+    elif isinstance(box, dict) and 'lat' in box:
+        TLAT = ds['TLAT'].transpose(*dims).values
+        TLONG = ds['TLONG'].transpose(*dims).values
+        mask = ((TLAT >= box['lat'][0]) & (TLAT <= box['lat'][1]) &
+                (TLONG >= box['lon'][0]) & (TLONG <= box['lon'][1]))
+    elif isinstance(box, dict) and 'polygon' in box:
+        mask = polygon_mask(ds['TLONG'].transpose(*dims).values,
+                            ds['TLAT'].transpose(*dims).values,
+                            box['polygon'])
+    elif isinstance(box, xr.DataArray):
+        mask = box.transpose(*dims).values.astype(bool)
+    else:
+        mask = np.asarray(box, dtype=bool)
+    if mask.shape != shape:
+        raise ValueError('Box mask does not match the ' + str(shape) +
+                         ' EBUS grid.')
+    return xr.DataArray(mask, dims=dims)
+
+
+def extract_subboxes(EBU, VARS, boxes, base=None):
+    """
+    Area-weighted time series for every box in `boxes` (a dict of name ->
+    box spec) and every variable in VARS, from one read of each variable's
+    ensemble store.
+
+    Returns (forced, residuals): Datasets with one variable per VAR, of
+    shape (region, time) for the ensemble mean and (ensemble, region, time)
+    for the residuals from it.
+    """
+    kwargs = {} if base is None else {'base': base}
+    forced = xr.Dataset()
+    residuals = xr.Dataset()
+    for VAR in VARS:
+        ds = open_ensemble(VAR, EBU, **kwargs)
+        masks = dict((name, box_mask(ds, box)) for name, box in boxes.items())
+        aw = area_weighted_mean(ds[VAR], ds['TAREA'], masks=masks).load()
+        aw = aw.transpose('ensemble', 'region', 'time')
+        forced[VAR] = aw.mean('ensemble')
+        residuals[VAR] = aw - forced[VAR]
+    return forced, residuals
@@ -0,0 +1,48 @@
+"""
+Tests for the on-disk index cache in climate_indices.py.
+
+Run with `python -m pytest -q` from this directory.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import climate_indices
+
+cftime = pytest.importorskip('cftime')
+
+
+def _write_cvdp(work, time):
+    directory = work / 'cesmLE_CVDP' / 'processed'
+    directory.mkdir(parents=True)
+    values = np.random.default_rng(0).normal(size=(3, len(time)))
+    ds = xr.Dataset({'pdo': (('ensemble', 'time'), values)},
+                    coords={'time': time})
+    ds.to_netcdf(str(directory / 'cvdp_detrended_BGC.nc'))
+    return values
+
+
+def _no_reads(files, var):
+    raise AssertionError('index was re-read from netCDF instead of the cache')
+
+
+@pytest.mark.parametrize('time', [
+    [cftime.DatetimeNoLeap(1920 + m // 12, m % 12 + 1, 15)
+     for m in range(24)],
+    pd.date_range('1920-01', periods=24, freq='MS'),
+], ids=['noleap', 'datetime64'])
+def test_cache_round_trips_time(tmp_path, monkeypatch, time):
+    monkeypatch.setattr(climate_indices, 'CACHE_DIR',
+                        str(tmp_path / 'cache') + '/')
+    monkeypatch.setattr(climate_indices, '_cache', {})
+    work = str(tmp_path / 'work') + '/'
+    values = _write_cvdp(tmp_path / 'work', time)
+    first = climate_indices.load_index('PDO', work=work)
+    # A fresh process: nothing in memory, so this has to hit the disk cache.
+    monkeypatch.setattr(climate_indices, '_cache', {})
+    monkeypatch.setattr(climate_indices, '_read_sources', _no_reads)
+    second = climate_indices.load_index('PDO', work=work)
+    np.testing.assert_array_equal(second.values, values)
+    assert second['time'].dtype == first['time'].dtype
+    assert list(second['time'].values) == list(first['time'].values)
+    assert type(second['time'].values[0]) is type(first['time'].values[0])
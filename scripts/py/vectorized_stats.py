@@ -0,0 +1,382 @@
+"""
+Vectorized Stats
+----------------
+
+Batched versions of the statistics we otherwise run one gridcell at a time
+through `.stack().groupby().apply()`. Everything here works on whole arrays
+at once from sums along the time axis, so a 384x320 global field is one
+NumPy call rather than ~120k Python-level regressions.
+
+The results are meant to be identical to `et.stats.linear_regression` (which
+wraps `scipy.stats.linregress`) for every gridcell. Land cells (or any
+gridcell with a NaN in its time series) simply propagate NaN through the sums
+rather than being checked for and skipped.
+
+Import this from a script in the same directory, e.g.
+`from vectorized_stats import linear_regression`.
+"""
+import numpy as np
+import xarray as xr
+from scipy import stats
+
+# Same guard scipy.stats.linregress uses to avoid dividing by zero when
+# r = +/- 1.
+TINY = 1.0e-20
+
+
+def _regression_from_moments(ssxm, ssym, ssxym, n):
+    """
+    Turns the (biased) variance and covariance sums into the slope, r-value,
+    and p-value the same way linregress does. n is the number of time steps
+    that went into the sums.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = ssxym / ssxm
+        r = ssxym / np.sqrt(ssxm * ssym)
+        r = np.clip(r, -1.0, 1.0)
+        # Mirror linregress for constant series: r is 0 unless the
+        # covariance is also zero.
+        flat = (ssxm == 0) | (ssym == 0)
+        r = np.where(flat, np.where(ssxym == 0, np.nan, 0.0), r)
+        df = n - 2
+        t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+        p = 2 * stats.t.sf(np.abs(t), df)
+    return m, r, p
+
+
+def _linregress_kernel(x, y):
+    """
+    Computes slope, r-value, and p-value along the last axis of x and y. Any
+    NaN in a time series makes that gridcell NaN for all three outputs.
+    """
+    n = x.shape[-1]
+    if y.shape[-1] != n:
+        raise ValueError("x and y need the same length along the time axis.")
+    with np.errstate(invalid='ignore'):
+        xa = x - x.mean(axis=-1, keepdims=True)
+        ya = y - y.mean(axis=-1, keepdims=True)
+        ssxm = (xa * xa).mean(axis=-1)
+        ssym = (ya * ya).mean(axis=-1)
+        ssxym = (xa * ya).mean(axis=-1)
+    return _regression_from_moments(ssxm, ssym, ssxym, n)
+
+
+def _lagged_linregress_kernel(x, y, lags):
+    """
+    Same as _linregress_kernel, but regresses y[L:] onto x[:-L] for every
+    lag L in `lags` and stacks the results on a new last axis.
+
+    The one-sided sums (x, x^2, y, y^2) for every lag come from a single
+    cumulative sum over time, so only the cross term is recomputed per lag.
+    Both inputs are first centered on their full-record mean, which leaves
+    the covariances unchanged but keeps the raw-moment sums well
+    conditioned.
+    """
+    n = x.shape[-1]
+    if y.shape[-1] != n:
+        raise ValueError("x and y need the same length along the time axis.")
+    lags = np.asarray(lags)
+    if (lags < 0).any() or (lags >= n - 2).any():
+        raise ValueError("Lags must be between 0 and the record length - 3.")
+    with np.errstate(invalid='ignore'):
+        x = x - x.mean(axis=-1, keepdims=True)
+        y = y - y.mean(axis=-1, keepdims=True)
+        # Prefix sums with a leading zero so cx[..., k] = sum(x[..., :k]).
+        pad = [(0, 0)] * (x.ndim - 1) + [(1, 0)]
+        cx = np.pad(np.cumsum(x, axis=-1), pad, mode='constant')
+        cxx = np.pad(np.cumsum(x * x, axis=-1), pad, mode='constant')
+        pad = [(0, 0)] * (y.ndim - 1) + [(1, 0)]
+        cy = np.pad(np.cumsum(y, axis=-1), pad, mode='constant')
+        cyy = np.pad(np.cumsum(y * y, axis=-1), pad, mode='constant')
+        m, r, p = [], [], []
+        for lag in lags:
+            nl = n - lag
+            # x leads: x[:nl] is paired with y[lag:].
+            sx = cx[..., nl]
+            sxx = cxx[..., nl]
+            sy = cy[..., n] - cy[..., lag]
+            syy = cyy[..., n] - cyy[..., lag]
+            sxy = np.einsum('...t,...t->...', x[..., :nl], y[..., lag:])
+            xbar = sx / nl
+            ybar = sy / nl
+            ssxm = sxx / nl - xbar ** 2
+            ssym = syy / nl - ybar ** 2
+            ssxym = sxy / nl - xbar * ybar
+            M, R, P = _regression_from_moments(ssxm, ssym, ssxym, nl)
+            m.append(M)
+            r.append(R)
+            p.append(P)
+    return np.stack(m, axis=-1), np.stack(r, axis=-1), np.stack(p, axis=-1)
+
+
+def linear_regression(x, y, dim='time'):
+    """
+    Regresses y onto x along `dim` for every other coordinate at once. Either
+    input can be a single time series or a full field; they are broadcast
+    against each other. Time series are matched positionally (not by time
+    label), just like handing numpy arrays to linregress, so lagged slices
+    of x and y can be passed in directly.
+
+    Returns a Dataset with the slope (m), correlation coefficient (r), and
+    two-sided p-value (p).
+    """
+    m, r, p = xr.apply_ufunc(_linregress_kernel, x, y,
+                             input_core_dims=[[dim], [dim]],
+                             output_core_dims=[[], [], []],
+                             exclude_dims=set([dim]),
+                             dask='parallelized',
+                             output_dtypes=[float, float, float])
+    return xr.Dataset({'m': m, 'r': r, 'p': p})
+
+
+def lagged_linear_regression(x, y, lags, dim='time'):
+    """
+    Runs linear_regression for every lag in `lags` (in time steps, with x
+    leading y) from a single pass over the inputs. This is equivalent to
+    calling linear_regression(x[:-lag], y[lag:]) once per lag, but the
+    field only has to be loaded and summed once.
+
+    Returns a Dataset of m, r, and p with a new `lag` dimension.
+    """
+    lags = [int(l) for l in lags]
+    m, r, p = xr.apply_ufunc(_lagged_linregress_kernel, x, y,
+                             input_core_dims=[[dim], [dim]],
+                             output_core_dims=[['lag'], ['lag'], ['lag']],
+                             exclude_dims=set([dim]),
+                             kwargs={'lags': lags},
+                             dask='parallelized',
+                             output_dtypes=[float, float, float],
+                             dask_gufunc_kwargs={'output_sizes':
+                                                 {'lag': len(lags)}})
+    ds = xr.Dataset({'m': m, 'r': r, 'p': p})
+    ds['lag'] = lags
+    return ds
+
+
+def _lag1_autocorrelation(x):
+    """
+    Pearson correlation of x[1:] with x[:-1] along the last axis.
+    """
+    a = x[..., 1:] - x[..., 1:].mean(axis=-1, keepdims=True)
+    b = x[..., :-1] - x[..., :-1].mean(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return ((a * b).sum(axis=-1) /
+                np.sqrt((a * a).sum(axis=-1) * (b * b).sum(axis=-1)))
+
+
+def _effective_linregress_kernel(x, y):
+    """
+    Slope and r-value as in _linregress_kernel, with the p-value computed
+    from an effective sample size that accounts for the lag-1
+    autocorrelation of both series (Bretherton et al. 1999):
+
+        n_eff = floor(n * (1 - rx * ry) / (1 + rx * ry))
+
+    which matters once the series have been smoothed.
+    """
+    n = x.shape[-1]
+    m, r, _ = _linregress_kernel(x, y)
+    rxry = _lag1_autocorrelation(x) * _lag1_autocorrelation(y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_eff = np.floor(n * (1 - rxry) / (1 + rxry))
+        df = n_eff - 2
+        t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+        p = 2 * stats.t.sf(np.abs(t), df)
+    return m, r, p, n_eff
+
+
+def effective_linear_regression(x, y, dim='time'):
+    """
+    linear_regression with an autocorrelation-corrected p-value, for every
+    other coordinate (e.g. every ensemble member) at once. Replaces looping
+    over members with et.stats.linear_regression and et.stats.pearsonr.
+    Time series are matched positionally, so pass lagged slices directly.
+
+    Returns a Dataset with the slope (m), correlation coefficient (r),
+    p-value (p), and effective sample size (n_eff).
+    """
+    m, r, p, n_eff = xr.apply_ufunc(_effective_linregress_kernel, x, y,
+                                    input_core_dims=[[dim], [dim]],
+                                    output_core_dims=[[], [], [], []],
+                                    exclude_dims=set([dim]),
+                                    dask='parallelized',
+                                    output_dtypes=[float, float, float,
+                                                   float])
+    return xr.Dataset({'m': m, 'r': r, 'p': p, 'n_eff': n_eff})
+
+
+def ensemble_summary(ds, dim='ensemble', alpha=0.05):
+    """
+    Summarizes a Dataset of m/r/p that has an ensemble dimension (e.g. the
+    output of linear_regression on a full-ensemble field). Adds the
+    ensemble mean slope and correlation, the fraction of members whose
+    slope has the same sign as the ensemble mean slope, and the fraction of
+    members that are significant at `alpha`.
+
+    NaN cells (land) stay NaN in every summary variable.
+    """
+    ds = ds.copy()
+    m_mean = ds['m'].mean(dim)
+    ds['m_mean'] = m_mean
+    ds['r_mean'] = ds['r'].mean(dim)
+    agree = (np.sign(ds['m']) == np.sign(m_mean)).astype(float)
+    ds['sign_agreement'] = agree.where(ds['m'].notnull()).mean(dim)
+    significant = (ds['p'] < alpha).astype(float)
+    ds['frac_significant'] = significant.where(ds['p'].notnull()).mean(dim)
+    ds['sign_agreement'].attrs['long_name'] = ('Fraction of members with ' +
+        'the same slope sign as the ensemble mean')
+    ds['frac_significant'].attrs['long_name'] = ('Fraction of members with ' +
+        'p < ' + str(alpha))
+    return ds
+
+
+def polyfit_residuals(y, order):
+    """
+    Removes a least-squares polynomial fit along the last axis of the NumPy
+    array y for every series at once (the kernel behind
+    remove_polynomial_fit, for other kernels to build on).
+
+    Complete series share one pseudo-inverse of the Vandermonde matrix.
+    Series with gaps are fit to their valid points only, by solving their
+    (small) normal equations in one batched call. Series with no more valid
+    points than the polynomial has coefficients come out as NaN. Time is
+    rescaled to [-1, 1] to keep the Vandermonde matrix well conditioned; this
+    gives the same fitted curve as np.polyfit on 0..n-1.
+    """
+    n = y.shape[-1]
+    V = np.vander(np.linspace(-1, 1, n), order + 1)
+    flat = y.reshape(-1, n)
+    out = np.full(flat.shape, np.nan)
+    valid = np.isfinite(flat)
+    nvalid = valid.sum(axis=-1)
+    full = (nvalid == n)
+    if full.any():
+        coefs = flat[full].dot(np.linalg.pinv(V).T)
+        out[full] = flat[full] - coefs.dot(V.T)
+    gappy = (~full) & (nvalid > order)
+    if gappy.any():
+        w = valid[gappy].astype(float)
+        yg = np.where(valid[gappy], flat[gappy], 0)
+        A = np.einsum('ci,ij,ik->cjk', w, V, V, optimize=True)
+        b = (w * yg).dot(V)
+        coefs = np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+        out[gappy] = np.where(valid[gappy], yg - coefs.dot(V.T), np.nan)
+    return out.reshape(y.shape)
+
+
+def remove_polynomial_fit(da, order=4, dim='time'):
+    """
+    Grid-wide version of et.ufunc.remove_polynomial_fit. Detrends every
+    series in da along `dim` with a polynomial of the given order in one
+    batched least-squares solve, instead of one np.polyfit per gridcell (or
+    per ensemble member). NaN cells and partial gaps are handled as in
+    polyfit_residuals.
+    """
+    detrended = xr.apply_ufunc(polyfit_residuals, da,
+                               input_core_dims=[[dim]],
+                               output_core_dims=[[dim]],
+                               kwargs={'order': order},
+                               dask='parallelized',
+                               output_dtypes=[float])
+    return detrended.transpose(*da.dims)
+
+
+def _eof_kernel(x, w, neofs):
+    """
+    Uncentered EOFs of x (batch, time, cell) for every batch at once from
+    one stacked SVD, following eofs.standard.Eof(center=False) with weights
+    w (cell,). x must only hold cells that are valid at every time.
+
+    Returns the (batch, mode, cell) eigenvectors of the weighted data, the
+    (batch, mode) eigenvalues (ddof=1), the (batch, mode) variance
+    fractions, and the (batch, time, mode) PCs scaled to unit variance.
+    """
+    n = x.shape[-2]
+    u, s, vt = np.linalg.svd(x * w, full_matrices=False)
+    eigenvalues = s * s / float(n - 1)
+    fraction = (eigenvalues[..., :neofs] /
+                eigenvalues.sum(axis=-1, keepdims=True))
+    pcs = u[..., :neofs] * np.sqrt(float(n - 1))
+    return vt[..., :neofs, :], eigenvalues[..., :neofs], fraction, pcs
+
+
+def _correlation_map(pcs, x):
+    """
+    Pearson correlation over time of every (batch, time, mode) PC with
+    every (batch, time, cell) series, as (batch, mode, cell).
+    """
+    a = pcs - pcs.mean(axis=-2, keepdims=True)
+    b = x - x.mean(axis=-2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.einsum('...tm,...tc->...mc', a, b) /
+                np.sqrt(np.einsum('...tm,...tm->...m', a, a)[..., None] *
+                        np.einsum('...tc,...tc->...c', b, b)[..., None, :]))
+
+
+def ensemble_eofs(da, neofs=2, weights=None, dim='time',
+                  batch_dim='ensemble', project=None):
+    """
+    The first `neofs` EOFs of da for every member along batch_dim at once.
+    Replaces constructing one eofs.xarray.Eof solver (with center=False)
+    per ensemble member: all members are decomposed in one stacked SVD.
+    Every dimension other than dim and batch_dim is treated as space, and
+    any cell with a NaN (land) is left out of the decomposition.
+
+    weights : weights broadcastable against the space dimensions of da
+        (e.g. sqrt(cos(lat))), applied before the decomposition.
+    project : optional field with the same space dimensions (and batch_dim)
+        plus its own time dimension to project onto the EOFs in place of
+        the PCs, like
+        solver.projectField(project, neofs, eofscaling=1).
+
+    Returns a Dataset with 'eof' (batch_dim, mode, space...) as the
+    correlation between each PC and da (solver.eofsAsCorrelation), 'pc'
+    (batch_dim, time, mode) scaled to unit variance (or the projection), and
+    'variance_fraction' (batch_dim, mode).
+    """
+    squeeze = batch_dim not in da.dims
+    if squeeze:
+        da = da.expand_dims(batch_dim)
+    space = [d for d in da.dims if d not in (batch_dim, dim)]
+    da = da.transpose(batch_dim, dim, *space)
+    shape = [da.sizes[d] for d in space]
+    nbatch, ntime = da.sizes[batch_dim], da.sizes[dim]
+    x = da.values.reshape(nbatch, ntime, -1).astype('float64')
+    if weights is None:
+        w = np.ones(x.shape[-1])
+    else:
+        w = xr.DataArray(np.ones(shape), dims=space) * weights
+        w = w.transpose(*space).values.reshape(-1)
+    valid = np.isfinite(x).all(axis=(0, 1))
+    vt, eigenvalues, fraction, pcs = _eof_kernel(x[..., valid], w[valid],
+                                                 neofs)
+    eof = np.full((nbatch, neofs, x.shape[-1]), np.nan)
+    eof[..., valid] = _correlation_map(pcs, x[..., valid])
+    eof = xr.DataArray(eof.reshape([nbatch, neofs] + shape),
+                       dims=[batch_dim, 'mode'] + space)
+    for name in da.coords:
+        if set(da[name].dims) <= set(space):
+            eof.coords[name] = da[name]
+    time = da[dim]
+    if project is not None:
+        if batch_dim not in project.dims:
+            project = project.expand_dims(batch_dim)
+        # The projected field can have its own time axis (e.g. monthly
+        # values projected onto EOFs of annual means).
+        pdim = [d for d in project.dims if d not in space + [batch_dim]][0]
+        project = project.transpose(batch_dim, pdim, *space)
+        time = project[pdim]
+        field = project.values.reshape(nbatch, project.sizes[pdim], -1)
+        scaled = vt / np.sqrt(eigenvalues)[..., None]
+        pcs = np.einsum('btc,bmc->btm', field[..., valid] * w[valid], scaled)
+    pc = xr.DataArray(pcs, dims=[batch_dim, time.name, 'mode'],
+                      coords={time.name: time.values})
+    ds = xr.Dataset({'eof': eof, 'pc': pc,
+                     'variance_fraction': xr.DataArray(
+                         fraction, dims=[batch_dim, 'mode'])})
+    ds['mode'] = np.arange(neofs)
+    if batch_dim in da.coords:
+        ds[batch_dim] = da[batch_dim].values
+    if squeeze:
+        ds = ds.isel({batch_dim: 0}, drop=True)
+    return ds
@@ -1,12 +1,12 @@
 #!/bin/bash
 # Loops through to submit lags 0 through 6 months and 3 simulations as a test
-# case.
+# case. All lags for a simulation are computed in one job (global_regression_map
+# accepts an inclusive lag range), so this is one submission per simulation.
+
+LAGS=0..6
 
-for LAG in {0..6}
-do
 for N in {0..2}
 do
-    qsub -v ensemble=${N},L=${LAG} single_ens_regression.sh 
+    qsub -v ensemble=${N},L=${LAGS} single_ens_regression.sh 
     sleep 0.5 
 done
-done
@@ -13,15 +13,15 @@
 # Python script (with independent operations of course).
 source activate py36
 
-script=overhead_spatial_correlation.py
+script=overhead_spatial_correlation_anyvar.py
 EBU=HumCS
 VARX=NINO3
 VARY=FG_CO2
 LAG=0
 SMOOTH=0
 
-for ENS in {0..33}
-do
-    python ${script} ${EBU} ${VARX} ${VARY} ${ENS} ${LAG} ${SMOOTH}
-done
-wait
+# "all" regresses every member in one process (ensemble as a dimension), rather
+# than looping over {0..33} and reloading the predictor each time.
+ENS=all
+
+python ${script} ${EBU} ${VARX} ${VARY} ${ENS} ${LAG} ${SMOOTH}
@@ -20,12 +20,11 @@ source `which env_parallel.bash`
 
 script=EBUS_extraction.py
 VAR=pCO2SURF  
-EBU=HumCS
-OUT=/glade/work/rbrady/EBUS_BGC_Variability/${VAR}/${EBU}/
+EBU=all # All four EBUS come out of a single read of each file.
+# EBUS_extraction.py fills in {VAR}/{EBU} and creates the directories.
+OUT='/glade/work/rbrady/EBUS_BGC_Variability/{VAR}/{EBU}/'
 
-mkdir -p ${OUT}
-
-ls /glade/scratch/rbrady/EBUS_BGC_Variability/${VAR}_monthly/reduced*.nc | env_parallel 'echo {}; python ${script} {} ${VAR} ${EBU} ${OUT}'
+ls /glade/scratch/rbrady/EBUS_BGC_Variability/${VAR}_monthly/reduced*.nc | env_parallel 'echo {}; python ${script} {} ${VAR} ${EBU} "${OUT}"'
 
 # for INPUT in /glade/scratch/rbrady/EBUS_BGC_Variability/${VAR}_monthly/reduced*.nc
 # do